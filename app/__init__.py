@@ -1,29 +1,62 @@
 from flask import Flask
 
-from flask_sqlalchemy import SQLAlchemy
 from flask_moment import Moment
 from flask_login import LoginManager
-from config import Config
-import mistune
+from flask_migrate import Migrate
+from config import config
+from .routing import RoutingSQLAlchemy
+from .cache import TagVersions, PageCache
+from .counters import CounterBuffer
+from .render import MarkdownRenderer
+from .instrument import Instrumentation
+from .assets import Assets
+from .events import EventBroker
+from .users import UserCache
+from .static_site import StaticSite
+from .pageviews import PageViews
+from .deferred import Deferred
 
-db = SQLAlchemy()
+db = RoutingSQLAlchemy()
 login_manager = LoginManager()
 login_manager.session_protection = 'strong'
 login_manager.login_view = 'main.index'
 moment = Moment()
-markdown = mistune.Markdown()
+migrate = Migrate()
+versions = TagVersions()
+page_cache = PageCache(versions)
+counters = CounterBuffer(db, page_cache)
+markdown = MarkdownRenderer(db, page_cache)
+instrument = Instrumentation()
+assets = Assets()
+events = EventBroker()
+users = UserCache(db, versions, login_manager)
+static_site = StaticSite(db)
+pageviews = PageViews(db, page_cache)
+deferred = Deferred(db)
 
 
 def create_app(config_name):
     app = Flask(__name__)
-    app.config.from_object(Config)
-    Config.init_app(app)
+    app.config.from_object(config[config_name])
+    config[config_name].init_app(app)
 
     db.init_app(app)
     db.app = app
-    db.create_all()
+    # 表结构由 migrations/ 管理, 部署时运行 manage.py db upgrade
+    migrate.init_app(app, db)
     login_manager.init_app(app)
     moment.init_app(app)
+    versions.init_app(app)
+    page_cache.init_app(app)
+    counters.init_app(app)
+    markdown.init_app(app)
+    instrument.init_app(app)
+    assets.init_app(app)
+    events.init_app(app)
+    users.init_app(app)
+    static_site.init_app(app)
+    pageviews.init_app(app)
+    deferred.init_app(app)
 
     from .main import main as main_blueprint
     app.register_blueprint(main_blueprint)
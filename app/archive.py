@@ -0,0 +1,222 @@
+# coding=utf-8
+import io
+import json
+import os
+import re
+from collections import Counter, defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from . import db, page_cache, search, feeds
+from .models import Category, Post, Label, registrations
+from .render import render_text
+from .services import split_labels, _incr, _bump_site
+
+# manage.py import / export: 一篇文章一个 Markdown 文件, 开头是 front matter
+#
+#   ---
+#   title: "标题"
+#   summary: "摘要, 可以是多行 Markdown"
+#   category: "Python"
+#   labels: ["flask", "sqlalchemy"]
+#   timestamp: 2016-09-25 10:00:00
+#   ---
+#   正文
+#
+# 字符串值写成 JSON(同时也是合法的 YAML), 读的时候也接受不加引号的单行值, labels 还可以用逗号分隔
+
+TIMESTAMP_FORMAT = '%Y-%m-%d %H:%M:%S'
+_timestamp_formats = (TIMESTAMP_FORMAT, '%Y-%m-%dT%H:%M:%S', '%Y-%m-%dT%H:%M:%SZ', '%Y-%m-%d %H:%M', '%Y-%m-%d')
+
+
+def _value(raw):
+    raw = raw.strip()
+    if raw[:1] in ('"', '['):
+        return json.loads(raw)
+    return raw
+
+
+def _timestamp(value):
+    for fmt in _timestamp_formats:
+        try:
+            return datetime.strptime(value, fmt)
+        except ValueError:
+            pass
+    raise ValueError('bad timestamp %r' % value)
+
+
+def parse_post(text, default_title=None):
+    """解析一个文件的内容, 返回 title, summery, body, category, labels, timestamp 组成的 dict"""
+    meta = {}
+    body = text
+    lines = text.lstrip(u'\ufeff').split('\n')
+    if lines and lines[0].strip() == '---':
+        for i in range(1, len(lines)):
+            line = lines[i]
+            if line.strip() == '---':
+                body = '\n'.join(lines[i + 1:])
+                break
+            if not line.strip() or line.lstrip().startswith('#'):
+                continue
+            key, sep, raw = line.partition(':')
+            if not sep:
+                raise ValueError('bad front matter line %r' % line)
+            meta[key.strip().lower()] = _value(raw)
+        else:
+            raise ValueError('front matter is not closed')
+    labels = meta.get('labels') or []
+    if not isinstance(labels, list):
+        labels = split_labels(labels)
+    timestamp = meta.get('timestamp') or meta.get('date')
+    return {
+        'title': meta.get('title') or default_title,
+        'summery': meta.get('summary') or meta.get('summery') or '',
+        'body': body,
+        'category': meta.get('category') or None,
+        'labels': split_labels(','.join(labels)),
+        'timestamp': _timestamp(timestamp) if timestamp else None,
+    }
+
+
+def format_post(title, summery, body, category, labels, timestamp):
+    lines = ['---',
+             'title: %s' % json.dumps(title or '', ensure_ascii=False),
+             'summary: %s' % json.dumps(summery or '', ensure_ascii=False)]
+    if category:
+        lines.append('category: %s' % json.dumps(category, ensure_ascii=False))
+    lines.append('labels: %s' % json.dumps(labels, ensure_ascii=False))
+    if timestamp is not None:
+        lines.append('timestamp: %s' % timestamp.strftime(TIMESTAMP_FORMAT))
+    lines.append('---')
+    return '\n'.join(lines) + '\n' + (body or '')
+
+
+def _load_files(paths):
+    # 在子进程里读取、解析并渲染一组文件, 出错的文件返回错误信息
+    results = []
+    for path in paths:
+        try:
+            with io.open(path, encoding='utf-8') as f:
+                post = parse_post(f.read(), os.path.splitext(os.path.basename(path))[0])
+            post['body_html'] = render_text(post['body'])
+            post['summery_html'] = render_text(post['summery'])
+            results.append((path, post, None))
+        except (ValueError, UnicodeDecodeError) as e:
+            results.append((path, None, str(e)))
+    return results
+
+
+def _resolve(model, column, names):
+    # 一条 IN 查询取出已有的, 缺少的批量插入后再查一次, 返回 {名字: id}
+    names = sorted(set(names))
+    if not names:
+        return {}
+    found = dict(db.session.query(column, model.id).filter(column.in_(names)))
+    missing = [name for name in names if name not in found]
+    if missing:
+        db.session.execute(model.__table__.insert(), [{column.key: name, 'count': 0} for name in missing])
+        found.update(db.session.query(column, model.id).filter(column.in_(missing)))
+    return found
+
+
+def _add_counts(model, counts):
+    # 同样的增量合并成一条 UPDATE
+    by_delta = defaultdict(list)
+    for id, delta in counts.items():
+        by_delta[delta].append(id)
+    for delta, ids in by_delta.items():
+        _incr(model, ids, delta)
+
+
+def _insert_batch(posts):
+    categories = _resolve(Category, Category.tag, [p['category'] for p in posts if p['category']])
+    labels = _resolve(Label, Label.label, [name for p in posts for name in p['labels']])
+    now = datetime.utcnow()
+    insert = Post.__table__.insert()
+    ids, links = [], []
+    category_count, label_count = Counter(), Counter()
+    for p in posts:
+        category_id = categories.get(p['category'])
+        # 每篇一条 INSERT, id 由数据库分配(同时有人发文章也不会冲突), 从 lastrowid 读回
+        id = db.session.execute(insert, {
+            'title': p['title'], 'summery': p['summery'], 'summery_html': p['summery_html'],
+            'body': p['body'], 'body_html': p['body_html'], 'category_id': category_id,
+            'timestamp': p['timestamp'] or now, 'timestamp_update': now,
+            'comment_num': 0, 'like_num': 0}).inserted_primary_key[0]
+        ids.append(id)
+        if category_id is not None:
+            category_count[category_id] += 1
+        for name in p['labels']:
+            label_count[labels[name]] += 1
+            links.append({'post_id': id, 'label_id': labels[name]})
+    if links:
+        db.session.execute(registrations.insert(), links)
+    _add_counts(Category, category_count)
+    _add_counts(Label, label_count)
+    # 搜索索引和订阅跟着更新
+    created = Post.query.filter(Post.id.in_(ids)) \
+        .options(db.joinedload(Post.category), db.subqueryload(Post.labels)).all()
+    search.index_posts(created)
+    feeds.add_posts(created)
+    _bump_site()
+    db.session.commit()
+    page_cache.invalidate('index', 'sidebar', 'search', 'feeds')
+
+
+def import_posts(directory, batch_size=200, workers=None, errors=None):
+    """导入 directory 下所有的 .md 文件, 每批一个事务; 返回导入的文章数
+
+    文件的读取、解析和渲染在进程池里进行, 解析失败的文件跳过, (路径, 原因) 追加到 errors
+    """
+    paths = sorted(os.path.join(directory, name) for name in os.listdir(directory) if name.endswith('.md'))
+    total = 0
+    with ProcessPoolExecutor(workers) as executor:
+        for start in range(0, len(paths), batch_size):
+            batch = paths[start:start + batch_size]
+            chunk = max(1, len(batch) // ((workers or 4) * 2))
+            posts = []
+            for results in executor.map(_load_files, [batch[i:i + chunk] for i in range(0, len(batch), chunk)]):
+                for path, post, error in results:
+                    if post is None:
+                        if errors is not None:
+                            errors.append((path, error))
+                    else:
+                        posts.append(post)
+            if posts:
+                _insert_batch(posts)
+                total += len(posts)
+    return total
+
+
+_slug_re = re.compile(r'[^\w]+', re.UNICODE)
+
+
+def _filename(id, title):
+    slug = _slug_re.sub('-', (title or '').lower()).strip('-')[:60]
+    return '%d-%s.md' % (id, slug) if slug else '%d.md' % id
+
+
+def export_posts(directory, batch_size=200):
+    """按 id 分批把所有文章写成 directory 下的 Markdown 文件, 内存占用和文章总数无关; 返回导出的文章数"""
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    total = 0
+    last_id = 0
+    while True:
+        rows = db.session.query(Post.id, Post.title, Post.summery, Post.body, Post.timestamp, Category.tag) \
+            .outerjoin(Category, Category.id == Post.category_id) \
+            .filter(Post.id > last_id).order_by(Post.id).limit(batch_size).all()
+        if not rows:
+            break
+        last_id = rows[-1][0]
+        labels = defaultdict(list)
+        for post_id, label in db.session.query(registrations.c.post_id, Label.label) \
+                .join(Label, Label.id == registrations.c.label_id) \
+                .filter(registrations.c.post_id.in_([row[0] for row in rows])).order_by(Label.id):
+            labels[post_id].append(label)
+        for id, title, summery, body, timestamp, tag in rows:
+            with io.open(os.path.join(directory, _filename(id, title)), 'w', encoding='utf-8') as f:
+                f.write(format_post(title, summery, body, tag, labels[id], timestamp))
+        # 只读, 结束这一批的事务, 不在 session 里积累对象
+        db.session.rollback()
+        total += len(rows)
+    return total
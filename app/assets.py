@@ -0,0 +1,234 @@
+# coding=utf-8
+import gzip
+import hashlib
+import json
+import os
+import posixpath
+import re
+import shutil
+from flask import url_for
+
+# 静态资源构建: manage.py assets
+# 第三方库固定版本下载到 static/vendor, 和 dexcode.css/js 一起合并压缩成 bundle,
+# 所有文件复制到 static/dist 并在文件名里带上内容哈希, 同时写出 .gz(和装了 brotli 时的 .br)
+# manifest.json 记录 原路径 -> 带哈希的路径, url_for('static', ...) 按它改写, nginx 可以永久缓存 dist
+# 还没有下载到 static/vendor 的第三方库继续用同样版本的 CDN 地址, 不进 bundle
+
+DIST = 'dist'
+VENDOR = 'vendor'
+MANIFEST = 'manifest.json'
+
+# (下载地址, static/vendor 下的路径), CSS 里 url() 引用的字体和图片会一起下载
+VENDOR_FILES = [
+    ('https://cdnjs.cloudflare.com/ajax/libs/twitter-bootstrap/3.3.7/css/bootstrap.min.css',
+     'bootstrap/css/bootstrap.min.css'),
+    ('https://cdnjs.cloudflare.com/ajax/libs/twitter-bootstrap/3.3.7/js/bootstrap.min.js',
+     'bootstrap/js/bootstrap.min.js'),
+    ('https://cdnjs.cloudflare.com/ajax/libs/flat-ui/2.3.0/css/flat-ui.min.css',
+     'flat-ui/css/flat-ui.min.css'),
+    ('https://cdnjs.cloudflare.com/ajax/libs/flat-ui/2.3.0/js/flat-ui.min.js',
+     'flat-ui/js/flat-ui.min.js'),
+    ('https://cdnjs.cloudflare.com/ajax/libs/jquery/3.2.1/jquery.min.js',
+     'jquery/jquery.min.js'),
+]
+
+# 代码块高亮的样式表不下载, 由 Pygments 生成, 和 render.py 渲染时用的 Pygments 版本一致;
+# 生成的文件提交在仓库里, 升级 Pygments 之后用 manage.py assets --force 重新生成
+HIGHLIGHT_CSS = 'pygments/highlight.css'
+
+# bundle 名 -> 按顺序合并的源文件(相对 static 目录)
+BUNDLES = {
+    'site.css': ['vendor/bootstrap/css/bootstrap.min.css',
+                 'vendor/flat-ui/css/flat-ui.min.css',
+                 'vendor/' + HIGHLIGHT_CSS,
+                 'dexcode.css'],
+    'site.js': ['vendor/jquery/jquery.min.js',
+                'vendor/bootstrap/js/bootstrap.min.js',
+                'dexcode.js'],
+}
+
+# 这些类型的文件预先压缩, 图片和 woff 本身已经压缩过
+COMPRESS = ('.css', '.js', '.svg', '.ttf', '.eot', '.json', '.ico')
+
+_url_re = re.compile(r'''url\(\s*(['"]?)([^'")]+)\1\s*\)''')
+
+
+def _relative_url(url):
+    return not (url.startswith('data:') or url.startswith('#') or '//' in url or url.startswith('/'))
+
+
+def _split_url(url):
+    # 去掉 ?#iefix 之类的后缀, 改写路径之后再接回去
+    match = re.match(r'([^?#]*)(.*)', url)
+    return match.group(1), match.group(2)
+
+
+def fetch_vendor(static_folder, force=False):
+    """下载 VENDOR_FILES 到 static/vendor, 返回新下载的文件"""
+    from urllib.request import urlopen
+    from urllib.parse import urljoin
+    fetched = []
+    queue = list(VENDOR_FILES)
+    while queue:
+        url, path = queue.pop(0)
+        target = os.path.join(static_folder, VENDOR, path)
+        if force or not os.path.exists(target):
+            data = urlopen(url).read()
+            if not os.path.isdir(os.path.dirname(target)):
+                os.makedirs(os.path.dirname(target))
+            with open(target, 'wb') as f:
+                f.write(data)
+            fetched.append(path)
+        if path.endswith('.css'):
+            with open(target, 'rb') as f:
+                css = f.read().decode('utf-8')
+            for quote, ref in _url_re.findall(css):
+                ref = _split_url(ref)[0]
+                if _relative_url(ref):
+                    queue.append((urljoin(url, ref), posixpath.normpath(posixpath.join(posixpath.dirname(path), ref))))
+    target = os.path.join(static_folder, VENDOR, HIGHLIGHT_CSS)
+    if force or not os.path.exists(target):
+        from .render import highlight_css
+        if not os.path.isdir(os.path.dirname(target)):
+            os.makedirs(os.path.dirname(target))
+        with open(target, 'wb') as f:
+            f.write(highlight_css().encode('utf-8'))
+        fetched.append(HIGHLIGHT_CSS)
+    return fetched
+
+
+def vendor_cdn(static_folder=None):
+    """static 下的路径 -> CDN 地址, 给了 static_folder 时只返回本地还没有的文件"""
+    cdn = {}
+    for url, path in VENDOR_FILES:
+        path = posixpath.join(VENDOR, path)
+        if static_folder is None or not os.path.exists(os.path.join(static_folder, path)):
+            cdn[path] = url
+    return cdn
+
+
+def _hashed_name(path, data):
+    base, ext = posixpath.splitext(path)
+    return '%s.%s%s' % (base, hashlib.md5(data).hexdigest()[:10], ext)
+
+
+def _rewrite_css(css, source, manifest):
+    # 把 url() 里的相对路径换成 dist 里带哈希的文件, 再改成相对 bundle(位于 dist 根目录)的路径
+    def replace(match):
+        path, suffix = _split_url(match.group(2))
+        if not _relative_url(path):
+            return match.group(0)
+        target = posixpath.normpath(posixpath.join(posixpath.dirname(source), path))
+        if target not in manifest:
+            return match.group(0)
+        return 'url(%s%s)' % (posixpath.relpath(manifest[target], DIST), suffix)
+    return _url_re.sub(replace, css)
+
+
+def _write(dist, name, data):
+    target = os.path.join(dist, *name.split('/'))
+    if not os.path.isdir(os.path.dirname(target)):
+        os.makedirs(os.path.dirname(target))
+    with open(target, 'wb') as f:
+        f.write(data)
+    if name.endswith(COMPRESS):
+        # mtime 固定为 0, 同样的内容每次构建出同样的 .gz
+        with open(target + '.gz', 'wb') as raw:
+            with gzip.GzipFile(filename='', mode='wb', fileobj=raw, compresslevel=9, mtime=0) as f:
+                f.write(data)
+        try:
+            import brotli
+        except ImportError:
+            return
+        with open(target + '.br', 'wb') as f:
+            f.write(brotli.compress(data))
+
+
+def build(static_folder):
+    """重新生成 static/dist, 返回 manifest"""
+    from rcssmin import cssmin
+    from rjsmin import jsmin
+    dist = os.path.join(static_folder, DIST)
+    if os.path.isdir(dist):
+        shutil.rmtree(dist)
+    manifest = {}
+    sources = set(path for paths in BUNDLES.values() for path in paths)
+    missing = [path for path in sources if not os.path.exists(os.path.join(static_folder, path))]
+    cdn = vendor_cdn()
+    if [path for path in missing if path not in cdn]:
+        raise IOError('missing %s, run "manage.py assets --fetch" first'
+                      % ', '.join(sorted(path for path in missing if path not in cdn)))
+    # 先复制 bundle 之外的文件(图片、图标、字体), bundle 里的 url() 要指向它们带哈希的名字
+    for root, dirs, files in os.walk(static_folder):
+        dirs[:] = [d for d in dirs if os.path.join(root, d) != dist]
+        for filename in files:
+            path = posixpath.relpath(os.path.join(root, filename), static_folder).replace(os.sep, '/')
+            if path in sources or filename.endswith(('.gz', '.br')):
+                continue
+            with open(os.path.join(root, filename), 'rb') as f:
+                data = f.read()
+            manifest[path] = posixpath.join(DIST, _hashed_name(path, data))
+            _write(dist, _hashed_name(path, data), data)
+    for bundle, paths in sorted(BUNDLES.items()):
+        parts = []
+        for path in paths:
+            if path in missing:
+                continue
+            with open(os.path.join(static_folder, path), 'rb') as f:
+                text = f.read().decode('utf-8')
+            if bundle.endswith('.css'):
+                text = _rewrite_css(text, path, manifest)
+                parts.append(text if '.min.' in path else cssmin(text))
+            else:
+                parts.append(text if '.min.' in path else jsmin(text))
+        # 各个 JS 文件末尾不一定有分号
+        data = (';\n' if bundle.endswith('.js') else '\n').join(parts).encode('utf-8')
+        manifest[bundle] = posixpath.join(DIST, _hashed_name(bundle, data))
+        _write(dist, _hashed_name(bundle, data), data)
+    _write(dist, MANIFEST, json.dumps(manifest, indent=2, sort_keys=True).encode('utf-8'))
+    return manifest
+
+
+class Assets(object):
+    """按 static/dist/manifest.json 把静态文件的 url 换成带哈希的文件
+
+    没有构建过(开发环境)时 url 不变, bundle 展开成各个源文件;
+    static/vendor 里没有的第三方库用 CDN 地址, 排在 bundle 前面(BUNDLES 里第三方库都在前面)
+    """
+
+    def __init__(self, app=None):
+        self.manifest = {}
+        self.cdn = {}
+        self.build_id = ''
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.manifest = {}
+        data = b''
+        path = os.path.join(app.static_folder, DIST, MANIFEST)
+        if app.config.get('ASSETS_MANIFEST', True) and os.path.exists(path):
+            with open(path, 'rb') as f:
+                data = f.read()
+            self.manifest = json.loads(data.decode('utf-8'))
+        self.cdn = vendor_cdn(app.static_folder)
+        # 页面里的静态文件地址随构建结果和已下载的第三方库变化, 条件 GET 的 ETag 要带上它
+        self.build_id = hashlib.md5(data + ' '.join(sorted(self.cdn)).encode('utf-8')).hexdigest()[:10]
+        app.url_defaults(self._url_defaults)
+        app.add_template_global(self.bundle_urls)
+        app.add_template_global(self.vendor_url)
+
+    def _url_defaults(self, endpoint, values):
+        if endpoint == 'static' and values.get('filename') in self.manifest:
+            values['filename'] = self.manifest[values['filename']]
+
+    def bundle_urls(self, bundle):
+        cdn = [self.cdn[path] for path in BUNDLES[bundle] if path in self.cdn]
+        if bundle in self.manifest:
+            return cdn + [url_for('static', filename=bundle)]
+        return cdn + [url_for('static', filename=path) for path in BUNDLES[bundle] if path not in self.cdn]
+
+    def vendor_url(self, path):
+        """static/vendor 下的单个文件"""
+        path = posixpath.join(VENDOR, path)
+        return self.cdn.get(path) or url_for('static', filename=path)
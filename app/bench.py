@@ -0,0 +1,308 @@
+# coding=utf-8
+import random
+import re
+import threading
+import time
+from datetime import datetime, timedelta
+from werkzeug.security import generate_password_hash
+from forgery_py import lorem_ipsum, internet
+from . import db, page_cache, markdown
+from .models import User, Category, Post, Label, Comment, LikePost, registrations
+from .instrument import percentile
+
+# manage.py bench 用到的合成数据和压测
+# 压测在进程内用 test client 驱动真实的视图, 每个并发客户端一个线程
+
+BENCH_PASSWORD = 'bench'
+
+
+def fake_markdown(paragraphs=6):
+    # 标题、段落、列表、代码块和链接混在一起, 接近真实文章
+    parts = ['## %s' % lorem_ipsum.title()]
+    for i in range(paragraphs):
+        kind = random.random()
+        if kind < 0.15:
+            parts.append('\n'.join('- %s' % lorem_ipsum.sentence() for j in range(random.randint(2, 6))))
+        elif kind < 0.3:
+            lines = ['def %s(%s):' % (lorem_ipsum.word(), lorem_ipsum.word())]
+            lines += ['    %s = %d' % (lorem_ipsum.word(), random.randint(0, 1000)) for j in range(random.randint(2, 12))]
+            parts.append('```python\n%s\n```' % '\n'.join(lines))
+        elif kind < 0.4:
+            parts.append('### %s' % lorem_ipsum.title())
+        else:
+            text = lorem_ipsum.sentences(random.randint(3, 8))
+            parts.append(text.replace(' ', ' [%s](http://example.com/) ' % lorem_ipsum.word(), 1))
+    return '\n\n'.join(parts)
+
+
+def _insert(model_or_table, rows, batch_size=1000):
+    table = getattr(model_or_table, '__table__', model_or_table)
+    for i in range(0, len(rows), batch_size):
+        db.session.execute(table.insert(), rows[i:i + batch_size])
+
+
+def _max_id(model):
+    return db.session.query(db.func.max(model.id)).scalar() or 0
+
+
+def seed(users=50, categories=8, labels=40, posts=500, comments=10, likes=5, big_thread=1000):
+    """批量插入合成数据, 在已有数据之后追加, 计数列和插入的行保持一致
+
+    big_thread 条评论集中在一篇文章上, 用来测评论很多的文章页; 返回插入的文章 id
+    """
+    if User.query.get(1) is None:
+        # 管理员 Dexter 的 id 必须是 1, 见 User.is_dexter
+        db.session.add(User(id=1, username='Dexter', password=BENCH_PASSWORD))
+        db.session.commit()
+    first_user = _max_id(User) + 1
+    # 密码哈希很慢, 所有压测用户共用同一个
+    password_hash = generate_password_hash(BENCH_PASSWORD)
+    user_rows = [{'id': first_user + i, 'username': '%s%d' % (internet.user_name(), first_user + i),
+                  'password_hash': password_hash} for i in range(users)]
+    _insert(User, user_rows)
+    user_ids = [1] + [row['id'] for row in user_rows]
+
+    first_category = _max_id(Category) + 1
+    category_ids = list(range(first_category, first_category + categories))
+    _insert(Category, [{'id': id, 'tag': 'bench-%d' % id, 'count': 0} for id in category_ids])
+    first_label = _max_id(Label) + 1
+    label_ids = list(range(first_label, first_label + labels))
+    _insert(Label, [{'id': id, 'label': 'bench-%d' % id, 'count': 0} for id in label_ids])
+
+    first_post = _max_id(Post) + 1
+    post_ids = list(range(first_post, first_post + posts))
+    now = datetime.utcnow()
+    post_rows, links = [], []
+    category_count = dict.fromkeys(category_ids, 0)
+    label_count = dict.fromkeys(label_ids, 0)
+    for i, id in enumerate(post_ids):
+        body = fake_markdown(random.randint(3, 20))
+        summery = lorem_ipsum.sentences(3)
+        category_id = random.choice(category_ids)
+        category_count[category_id] += 1
+        post_rows.append({'id': id, 'title': lorem_ipsum.title(), 'body': body, 'body_html': markdown(body),
+                          'summery': summery, 'summery_html': markdown(summery), 'category_id': category_id,
+                          'timestamp': now - timedelta(minutes=posts - i), 'comment_num': 0, 'like_num': 0})
+        for label_id in random.sample(label_ids, min(len(label_ids), random.randint(1, 4))):
+            label_count[label_id] += 1
+            links.append({'post_id': id, 'label_id': label_id})
+    comment_rows = []
+    comment_num = dict.fromkeys(post_ids, 0)
+    first_comment = _max_id(Comment) + 1
+    targets = [random.choice(post_ids) for i in range(posts * comments)] + [post_ids[-1]] * big_thread
+    for i, post_id in enumerate(targets):
+        text = lorem_ipsum.sentences(random.randint(1, 4))
+        comment_num[post_id] += 1
+        comment_rows.append({'id': first_comment + i, 'comment': text, 'comment_html': markdown(text),
+                             'post_id': post_id, 'user_id': random.choice(user_ids),
+                             'timestamp': now - timedelta(seconds=len(targets) - i),
+                             'like_num': 0, 'dislike_num': 0})
+    like_rows = []
+    like_num = dict.fromkeys(post_ids, 0)
+    for post_id in post_ids:
+        for user_id in random.sample(user_ids, min(len(user_ids), random.randint(0, likes * 2))):
+            like_num[post_id] += 1
+            like_rows.append({'post_id': post_id, 'user_id': user_id})
+    for row in post_rows:
+        row['comment_num'] = comment_num[row['id']]
+        row['like_num'] = like_num[row['id']]
+    for id, count in category_count.items():
+        Category.query.filter_by(id=id).update({'count': count}, synchronize_session=False)
+    for id, count in label_count.items():
+        Label.query.filter_by(id=id).update({'count': count}, synchronize_session=False)
+    _insert(Post, post_rows)
+    _insert(registrations, links)
+    _insert(Comment, comment_rows)
+    _insert(LikePost, like_rows)
+    db.session.commit()
+    # 每个缓存页面都带有 sidebar tag, 借它让所有页面缓存失效
+    page_cache.invalidate('sidebar', 'index')
+    return post_ids
+
+
+_queries_re = re.compile(r'desc="(\d+) queries"')
+
+
+class Scenario(object):
+    """一类请求: weight 是在混合负载里的比例, request(client, rnd) 发出一个请求并返回响应"""
+
+    def __init__(self, name, weight, request, login=None):
+        self.name = name
+        self.weight = weight
+        self.request = request
+        self.login = login
+
+
+def default_scenarios(post_ids, category_tags, big_post, per_page):
+    deepest = max(1, len(post_ids) // per_page)
+
+    def write(client, rnd):
+        return client.post('/write', data={'title': lorem_ipsum.title(), 'summery': lorem_ipsum.sentence(),
+                                           'body': fake_markdown(4), 'category': rnd.choice(category_tags),
+                                           'labels': 'bench-write,%s' % lorem_ipsum.word()})
+    return [
+        Scenario('index', 20, lambda c, rnd: c.get('/')),
+        Scenario('index_deep', 10, lambda c, rnd: c.get('/?page=%d' % rnd.randint(deepest // 2, deepest))),
+        Scenario('category', 15, lambda c, rnd: c.get('/category/%s' % rnd.choice(category_tags))),
+        Scenario('post', 30, lambda c, rnd: c.get('/post/%d' % rnd.choice(post_ids))),
+        Scenario('post_big_thread', 10, lambda c, rnd: c.get('/post/%d?page=%d' % (big_post, rnd.randint(1, 20)))),
+        Scenario('like_post', 10, lambda c, rnd: c.get('/like_post?post_id=%d' % rnd.choice(post_ids)),
+                 login='user'),
+        Scenario('write', 1, write, login='dexter'),
+    ]
+
+
+def _login(client, username):
+    client.post('/', data={'username': username, 'password': BENCH_PASSWORD})
+
+
+def run(app, scenarios, clients=8, requests=2000, usernames=()):
+    """clients 个线程并发发出共 requests 个请求, 返回各场景的吞吐、延迟分位数和每个请求的查询数"""
+    total_weight = float(sum(s.weight for s in scenarios))
+    results = dict((s.name, {'latency': [], 'queries': [], 'errors': 0, 'hits': 0}) for s in scenarios)
+    lock = threading.Lock()
+    remaining = [requests]
+
+    def worker(n):
+        rnd = random.Random(n)
+        # 每个线程为需要登录的场景各准备一个已登录的 client
+        sessions = {None: app.test_client(), 'dexter': app.test_client(), 'user': app.test_client()}
+        _login(sessions['dexter'], 'Dexter')
+        if usernames:
+            _login(sessions['user'], usernames[n % len(usernames)])
+        while True:
+            with lock:
+                if remaining[0] <= 0:
+                    return
+                remaining[0] -= 1
+            pick = rnd.random() * total_weight
+            for scenario in scenarios:
+                pick -= scenario.weight
+                if pick <= 0:
+                    break
+            start = time.time()
+            response = scenario.request(sessions[scenario.login], rnd)
+            elapsed = time.time() - start
+            match = _queries_re.search(response.headers.get('Server-Timing', ''))
+            with lock:
+                result = results[scenario.name]
+                result['latency'].append(elapsed)
+                if match:
+                    result['queries'].append(int(match.group(1)))
+                if response.status_code >= 400:
+                    result['errors'] += 1
+                if response.headers.get('X-Page-Cache') == 'HIT':
+                    result['hits'] += 1
+
+    threads = [threading.Thread(target=worker, args=(n,)) for n in range(clients)]
+    start = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.time() - start
+    report = {'clients': clients, 'requests': requests, 'seconds': round(elapsed, 2),
+              'rps': round(requests / elapsed, 1), 'scenarios': {}}
+    for name, result in results.items():
+        latency = sorted(result['latency'])
+        if not latency:
+            continue
+        report['scenarios'][name] = {
+            'requests': len(latency),
+            'errors': result['errors'],
+            'cache_hits': result['hits'],
+            'p50_ms': round(percentile(latency, 0.5) * 1000, 2),
+            'p95_ms': round(percentile(latency, 0.95) * 1000, 2),
+            'p99_ms': round(percentile(latency, 0.99) * 1000, 2),
+            'queries': round(sum(result['queries']) / float(len(result['queries'])), 1)
+            if result['queries'] else None,
+        }
+    return report
+
+
+def compare(report, baseline):
+    """和之前保存的结果比较, 返回每行一项的文字说明; 变慢或查询变多超过 10% 的行标出 !"""
+    lines = ['rps %.1f -> %.1f' % (baseline['rps'], report['rps'])]
+    for name, now in sorted(report['scenarios'].items()):
+        before = baseline['scenarios'].get(name)
+        if before is None:
+            lines.append('%s: new' % name)
+            continue
+        worse = now['p95_ms'] > before['p95_ms'] * 1.1 or \
+            (now['queries'] or 0) > (before['queries'] or 0) * 1.1
+        lines.append('%s %s: p50 %.1f -> %.1f ms, p95 %.1f -> %.1f ms, queries %s -> %s' % (
+            '!' if worse else ' ', name, before['p50_ms'], now['p50_ms'], before['p95_ms'], now['p95_ms'],
+            before['queries'], now['queries']))
+    return lines
+
+
+def sse_bench(host, port, post_id, listeners, events, publish, interval=0.5, timeout=30):
+    """打开 listeners 个 /post/<id>/events 长连接, 通过 publish(post_id, event, payload) 发出 events 个事件,
+    统计连上的连接数和每个事件从发布到各个连接收到的延迟"""
+    import json
+    import selectors
+    import socket
+    selector = selectors.DefaultSelector()
+    request = ('GET /post/%d/events HTTP/1.1\r\nHost: %s\r\nAccept: text/event-stream\r\n\r\n'
+               % (post_id, host)).encode('ascii')
+    buffers = {}
+    failed = 0
+    for i in range(listeners):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        try:
+            sock.connect((host, port))
+            sock.sendall(request)
+        except socket.error:
+            failed += 1
+            sock.close()
+            continue
+        sock.setblocking(False)
+        selector.register(sock, selectors.EVENT_READ)
+        buffers[sock] = b''
+    latency = []
+    connected = set()
+
+    def poll(seconds):
+        for key, mask in selector.select(seconds):
+            sock = key.fileobj
+            try:
+                data = sock.recv(65536)
+            except socket.error:
+                data = b''
+            if not data:
+                selector.unregister(sock)
+                sock.close()
+                buffers.pop(sock, None)
+                connected.discard(sock)
+                continue
+            buffers[sock] += data
+            if b'retry:' in buffers[sock]:
+                connected.add(sock)
+            # 只解析完整的事件, 剩下的留到下次
+            *events_, buffers[sock] = buffers[sock].split(b'\n\n')
+            now = time.time()
+            for event in events_:
+                for line in event.split(b'\n'):
+                    if line.startswith(b'data: ') and b'"sent"' in line:
+                        latency.append(now - json.loads(line[6:].decode('utf-8'))['sent'])
+
+    deadline = time.time() + timeout
+    while len(connected) < len(buffers) and time.time() < deadline:
+        poll(0.1)
+    for i in range(events):
+        publish(post_id, 'bench', {'sent': time.time(), 'n': i})
+        end = time.time() + interval
+        while time.time() < end:
+            poll(0.05)
+    end = time.time() + 2
+    while len(latency) < len(connected) * events and time.time() < end:
+        poll(0.05)
+    latency.sort()
+    for sock in list(buffers):
+        sock.close()
+    return {'listeners': listeners, 'connected': len(connected), 'failed': failed + listeners - len(buffers),
+            'events': events, 'delivered': len(latency), 'expected': len(connected) * events,
+            'p50_ms': round(percentile(latency, 0.5) * 1000, 2),
+            'p95_ms': round(percentile(latency, 0.95) * 1000, 2),
+            'p99_ms': round(percentile(latency, 0.99) * 1000, 2),
+            'max_ms': round(latency[-1] * 1000, 2) if latency else 0.0}
@@ -0,0 +1,195 @@
+# coding=utf-8
+import os
+import re
+import mmap
+import fcntl
+import struct
+import threading
+import time
+import zlib
+from collections import OrderedDict
+from functools import wraps
+from flask import request, g, session, make_response
+from flask_login import current_user
+from flask_wtf.csrf import generate_csrf
+from .routing import replica_settled
+
+
+class TagVersions(object):
+    """跨 worker 共享的 tag 版本号
+
+    tag 经过 crc32 映射到固定数量的槽位上, 槽位保存在一个 mmap 的本地文件中,
+    读取一个版本号只是一次内存访问, 递增时用 flock 加锁。不同 tag 落在同一个槽位
+    只会造成多余的失效, 不会读到旧数据。版本号后面是每个槽位最近一次递增的时间(秒)
+    """
+    SLOTS = 4096
+    _fmt = struct.Struct('<I')
+
+    def __init__(self, app=None):
+        self._mm = None
+        self._fd = None
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        cache_dir = app.config.get('CACHE_DIR')
+        size = 2 * self.SLOTS * self._fmt.size
+        if cache_dir:
+            if not os.path.isdir(cache_dir):
+                os.makedirs(cache_dir)
+            path = os.path.join(cache_dir, 'tag_versions')
+            self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+            if os.fstat(self._fd).st_size < size:
+                os.ftruncate(self._fd, size)
+            self._mm = mmap.mmap(self._fd, size)
+        else:
+            # 没有配置 CACHE_DIR 时退化为进程内版本号
+            self._mm = mmap.mmap(-1, size)
+
+    def slot(self, tag):
+        return (zlib.crc32(tag.encode('utf-8')) & 0xffffffff) % self.SLOTS
+
+    def get(self, tag):
+        return self._fmt.unpack_from(self._mm, self.slot(tag) * self._fmt.size)[0]
+
+    def bumped_within(self, tags, seconds):
+        # 这些 tag 里有没有在最近 seconds 秒内失效过的; 时间只精确到秒, 宁可多算一秒
+        now = time.time()
+        for tag in tags:
+            bumped = self._fmt.unpack_from(self._mm, (self.SLOTS + self.slot(tag)) * self._fmt.size)[0]
+            if now - bumped < seconds + 1:
+                return True
+        return False
+
+    def snapshot(self):
+        # 请求开始时拷贝一份全部版本号, 写入缓存时以此为准, 避免读写交错丢失失效
+        return self._mm[:self.SLOTS * self._fmt.size]
+
+    def snapshot_get(self, snapshot, tag):
+        return self._fmt.unpack_from(snapshot, self.slot(tag) * self._fmt.size)[0]
+
+    def bump(self, *tags):
+        self._bump_slots(set(self.slot(tag) for tag in tags))
+
+    def bump_all(self):
+        # 所有 tag 一起失效, 比如测试里换了一个新的数据库
+        self._bump_slots(range(self.SLOTS))
+
+    def _bump_slots(self, slots):
+        if not slots:
+            return
+        with self._lock:
+            if self._fd is not None:
+                fcntl.flock(self._fd, fcntl.LOCK_EX)
+            try:
+                now = int(time.time())
+                for slot in slots:
+                    offset = slot * self._fmt.size
+                    version = self._fmt.unpack_from(self._mm, offset)[0]
+                    self._fmt.pack_into(self._mm, offset, (version + 1) & 0xffffffff)
+                    self._fmt.pack_into(self._mm, (self.SLOTS + slot) * self._fmt.size, now)
+            finally:
+                if self._fd is not None:
+                    fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+
+class PageCache(object):
+    """渲染结果缓存, 以 路由 + 查询参数 + 登录状态 为 key, 以 tag 版本号判断是否过期
+
+    页面里有不通过 tag 失效的内容(比如浏览数)时, 视图用 max_age 限定缓存的时间
+    """
+    # 页面中的 CSRF token 是和 session 绑定的, 缓存时抹掉, 命中时再填上当前的 token
+    _csrf_re = re.compile(r'(<input[^>]*name="csrf_token"[^>]*value=")[^"]*(")')
+    _csrf_marker = '__CSRF_TOKEN__'
+
+    def __init__(self, versions, app=None):
+        self.versions = versions
+        self.enabled = False
+        self.max_size = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.enabled = app.config.get('PAGE_CACHE_ENABLED', False)
+        self.max_size = app.config.get('PAGE_CACHE_SIZE', 1024)
+
+    @staticmethod
+    def _key():
+        user = current_user.get_id() if current_user.is_authenticated else 'anon'
+        return request.endpoint, request.full_path, user
+
+    @staticmethod
+    def _cacheable():
+        # 有待显示的 flash 消息时页面内容和 session 相关, 不能缓存; 静态导出的页面内容不同, 也不缓存
+        return request.method == 'GET' and not session.get('_flashes') and not g.get('static_export')
+
+    def tag(self, *tags):
+        # 只有在 cached 视图里且本次请求会写入缓存时才记录 tag
+        if 'page_cache_tags' in g:
+            g.page_cache_tags.update(tags)
+
+    def max_age(self, seconds):
+        # 和 tag 一样, 只在本次请求会写入缓存时记录, 取最小的一个
+        if 'page_cache_tags' in g:
+            g.page_cache_max_age = min(seconds, g.get('page_cache_max_age') or seconds)
+
+    def invalidate(self, *tags):
+        self.versions.bump(*tags)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def _get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            self._entries.move_to_end(key)
+        if entry[2] is not None and entry[2] < time.time():
+            return None
+        for tag, version in entry[0]:
+            if self.versions.get(tag) != version:
+                return None
+        return entry
+
+    def _set(self, key, entry):
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def cached(self, *tags):
+        def decorator(func):
+            @wraps(func)
+            def decorated_function(*args, **kwargs):
+                if not self.enabled or not self._cacheable():
+                    return func(*args, **kwargs)
+                key = self._key()
+                entry = self._get(key)
+                if entry is not None:
+                    body = entry[1].replace(self._csrf_marker, generate_csrf())
+                    response = make_response(body)
+                    response.headers['X-Page-Cache'] = 'HIT'
+                    return response
+                snapshot = self.versions.snapshot()
+                g.page_cache_tags = set(tags)
+                g.page_cache_tags.add('sidebar')
+                g.page_cache_max_age = None
+                response = make_response(func(*args, **kwargs))
+                if response.status_code == 200 and self._cacheable() \
+                        and replica_settled(self.versions, g.page_cache_tags):
+                    body = self._csrf_re.sub(r'\g<1>%s\g<2>' % self._csrf_marker,
+                                             response.get_data(as_text=True))
+                    versions = tuple((tag, self.versions.snapshot_get(snapshot, tag))
+                                     for tag in g.page_cache_tags)
+                    expires = time.time() + g.page_cache_max_age if g.page_cache_max_age else None
+                    self._set(key, (versions, body, expires))
+                    response.headers['X-Page-Cache'] = 'MISS'
+                return response
+            return decorated_function
+        return decorator
@@ -0,0 +1,94 @@
+# coding=utf-8
+import hashlib
+import time
+from datetime import datetime
+from functools import wraps
+from flask import request, session, current_app, make_response
+from flask_login import current_user
+from . import db, sidebar, assets, pageviews
+from .models import Post
+from .likes import post_likes
+from .render import RENDERER_VERSION
+
+# 条件 GET: 用几条很便宜的元数据查询算出 ETag 和 Last-Modified,
+# 客户端带着 If-None-Match / If-Modified-Since 来时直接返回 304, 不再查询文章列表和渲染模板
+
+
+def _latest(*timestamps):
+    timestamps = [ts for ts in timestamps if ts is not None]
+    return max(timestamps).replace(microsecond=0) if timestamps else None
+
+
+def _common_parts():
+    # 页面里有和 session 绑定、会过期的 CSRF token, 每过半个有效期换一次 ETag,
+    # 浏览器缓存里的页面不会带着过期的 token
+    limit = current_app.config.get('WTF_CSRF_TIME_LIMIT', 3600)
+    csrf = int(time.time()) // max(limit // 2, 1) \
+        if current_app.config.get('WTF_CSRF_ENABLED', True) and limit else 0
+    user = current_user.get_id() if current_user.is_authenticated else 'anon'
+    # 换了 Markdown 渲染器或者重新构建了静态文件, 页面内容也会变
+    return [request.endpoint, request.full_path, user, csrf, sidebar.site_version()[0],
+            RENDERER_VERSION, assets.build_id]
+
+
+def _views_period():
+    # 页面上的浏览数不会让 ETag 变化, 和页面缓存一样接受最多 VIEW_CACHE_TTL 秒的旧数字:
+    # 每过 VIEW_CACHE_TTL 秒换一次 ETag, Last-Modified 也推到这一段的开始, 之后的验证请求会拿到新的浏览数
+    if not pageviews.enabled:
+        return None
+    ttl = max(pageviews.cache_ttl, 1)
+    return datetime.utcfromtimestamp(int(time.time()) // ttl * ttl)
+
+
+def list_validators(*args, **kwargs):
+    """首页和分类页: 全站版本号 + 所有文章里最新的修改时间(走 timestamp_update 索引)"""
+    updated = db.session.query(db.func.max(Post.timestamp_update)).scalar()
+    last_modified = _latest(updated, sidebar.site_version()[1], _views_period())
+    return _common_parts() + [last_modified], last_modified
+
+
+def post_validators(id, **kwargs):
+    """文章页: 全站版本号 + 这篇文章的修改时间, 登录用户再加上是否点过赞"""
+    row = db.session.query(Post.timestamp_update).filter_by(id=id).first()
+    if row is None:
+        return None
+    parts = _common_parts() + [row[0]]
+    if current_user.is_authenticated:
+        parts.append(id in post_likes.states(current_user.id, [id]))
+    last_modified = _latest(row[0], sidebar.site_version()[1], _views_period())
+    return parts + [last_modified], last_modified
+
+
+def conditional(validators):
+    """validators(*args, **kwargs) 返回 (组成 ETag 的值, Last-Modified), 返回 None 时不做条件 GET"""
+    def decorator(func):
+        @wraps(func)
+        def decorated_function(*args, **kwargs):
+            if not current_app.config.get('CONDITIONAL_GET', True) or request.method != 'GET' \
+                    or session.get('_flashes'):
+                return func(*args, **kwargs)
+            result = validators(*args, **kwargs)
+            if result is None:
+                return func(*args, **kwargs)
+            parts, last_modified = result
+            etag = hashlib.sha1(repr(parts).encode('utf-8')).hexdigest()
+            # 有 If-None-Match 时忽略 If-Modified-Since
+            if request.if_none_match:
+                not_modified = request.if_none_match.contains(etag)
+            else:
+                not_modified = last_modified is not None and request.if_modified_since is not None \
+                    and request.if_modified_since >= last_modified
+            if not_modified:
+                response = current_app.response_class(status=304)
+            else:
+                response = make_response(func(*args, **kwargs))
+                if response.status_code != 200:
+                    return response
+            response.set_etag(etag)
+            if last_modified is not None:
+                response.last_modified = last_modified
+            # 浏览器可以缓存, 但每次使用前都要带着 ETag 来验证
+            response.headers['Cache-Control'] = 'private, no-cache'
+            return response
+        return decorated_function
+    return decorator
@@ -0,0 +1,93 @@
+# coding=utf-8
+import atexit
+import threading
+from collections import defaultdict
+from datetime import datetime
+
+
+class CounterBuffer(object):
+    """在进程内合并计数列的增量, 到时间或者攒够一定数量之后批量写回数据库
+
+    热门文章的点赞不再每次都去锁 posts 表的那一行, 写回时一个事务里
+    每个 (列, id) 只执行一次 UPDATE ... SET x = x + n
+    """
+
+    def __init__(self, db, page_cache, app=None):
+        self.db = db
+        self.page_cache = page_cache
+        self.app = None
+        self.interval = 5
+        self.threshold = 100
+        self._pending = defaultdict(int)
+        self._tags = set()
+        self._touched = set()
+        self._hits = 0
+        self._timer = None
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        self.interval = app.config.get('COUNTER_FLUSH_INTERVAL', 5)
+        self.threshold = app.config.get('COUNTER_FLUSH_SIZE', 100)
+        # worker 正常退出时把没写回的增量写掉
+        atexit.register(self.flush)
+
+    def add(self, column, id, delta, tag=None, touch=None):
+        # tag: 写回之后需要失效的页面缓存 tag
+        # touch: (model, id), 写回时同时更新这一行的 timestamp_update, 比如评论所在的文章
+        with self._lock:
+            self._pending[(column, id)] += delta
+            if tag is not None:
+                self._tags.add(tag)
+            if touch is not None:
+                self._touched.add(touch)
+            self._hits += 1
+            flush_now = self._hits >= self.threshold
+            if not flush_now and self._timer is None:
+                self._timer = threading.Timer(self.interval, self.flush)
+                self._timer.daemon = True
+                self._timer.start()
+        if flush_now:
+            self.flush()
+
+    def pending(self, column, id):
+        with self._lock:
+            return self._pending.get((column, id), 0)
+
+    def flush(self):
+        with self._lock:
+            pending, self._pending = self._pending, defaultdict(int)
+            tags, self._tags = self._tags, set()
+            touched, self._touched = self._touched, set()
+            self._hits = 0
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+        pending = dict((key, delta) for key, delta in pending.items() if delta)
+        if not pending or self.app is None:
+            return
+        try:
+            with self.app.app_context():
+                with self.db.engine.begin() as conn:
+                    for (column, id), delta in sorted(pending.items(), key=lambda item: (item[0][0].key, item[0][1])):
+                        table = column.class_.__table__
+                        values = {column.key: column + delta}
+                        # 带修改时间的表(posts)同时更新修改时间
+                        if 'timestamp_update' in table.c:
+                            values['timestamp_update'] = datetime.utcnow()
+                        conn.execute(table.update().where(table.c.id == id).values(values))
+                    for model, id in sorted(touched, key=lambda item: (item[0].__tablename__, item[1])):
+                        table = model.__table__
+                        conn.execute(table.update().where(table.c.id == id)
+                                     .values(timestamp_update=datetime.utcnow()))
+        except Exception:
+            # 写回失败时把增量放回去, 下次再写
+            with self._lock:
+                for key, delta in pending.items():
+                    self._pending[key] += delta
+                self._tags.update(tags)
+                self._touched.update(touched)
+            raise
+        self.page_cache.invalidate(*tags)
@@ -1,6 +1,6 @@
 # coding=utf-8
 from functools import wraps
-from flask import abort
+from flask import abort, g, request
 from flask_login import current_user
 
 
@@ -12,3 +12,13 @@ def dexter_required(func):
             abort(403)
         return func(*args, **kwargs)
     return decorated_function
+
+
+def replica_reads(func):
+    # 只读的 GET 请求可以读从库, 见 routing.py
+    @wraps(func)
+    def decorated_function(*args, **kwargs):
+        if request.method == 'GET':
+            g.replica_reads = True
+        return func(*args, **kwargs)
+    return decorated_function
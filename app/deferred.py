@@ -0,0 +1,80 @@
+# coding=utf-8
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, wait
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+
+class Deferred(object):
+    """写操作提交之后在后台线程里做的派生数据维护(Atom / sitemap 文档、相关文章)
+
+    写操作的事务里只登记 func 和参数, 提交之后才交给后台线程, 回滚时丢弃;
+    参数都是集合, 同一个 func 还没开始执行时再登记会并到一起, 连续的写操作只重建一次.
+    只有一个后台线程, 任务按提交的顺序执行, 每个任务读的都是已经提交的数据, 自己提交一次事务
+    """
+
+    def __init__(self, db, app=None):
+        self.db = db
+        self.app = None
+        self._executor = None
+        self._queued = OrderedDict()
+        self._futures = set()
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(1)
+        if not event.contains(Session, 'after_commit', self._after_commit):
+            event.listen(Session, 'after_commit', self._after_commit)
+            event.listen(Session, 'after_soft_rollback', self._after_rollback)
+
+    def after_commit(self, func, *args):
+        """当前事务提交之后执行 func(*args), 在写操作的事务里调用"""
+        jobs = self.db.session().info.setdefault('deferred', OrderedDict())
+        merged = jobs.get(func)
+        if merged is None:
+            jobs[func] = [set(arg) for arg in args]
+        else:
+            for target, arg in zip(merged, args):
+                target.update(arg)
+
+    def _after_commit(self, session):
+        for func, args in session.info.pop('deferred', {}).items():
+            with self._lock:
+                queued = self._queued.get(func)
+                if queued is not None:
+                    for target, arg in zip(queued, args):
+                        target.update(arg)
+                    continue
+                self._queued[func] = args
+                future = self._executor.submit(self._run, func)
+                self._futures.add(future)
+                future.add_done_callback(self._futures.discard)
+
+    def _after_rollback(self, session, previous_transaction):
+        session.info.pop('deferred', None)
+
+    def _run(self, func):
+        with self._lock:
+            args = self._queued.pop(func)
+        try:
+            with self.app.app_context():
+                try:
+                    func(*args)
+                finally:
+                    self.db.session.remove()
+        except Exception:
+            self.app.logger.exception('deferred %s failed', func.__name__)
+
+    def wait(self):
+        # 等已经交给后台线程的任务都执行完, 测试和命令行里用
+        while True:
+            with self._lock:
+                futures = list(self._futures)
+            if not futures:
+                return
+            wait(futures)
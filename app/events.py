@@ -0,0 +1,147 @@
+# coding=utf-8
+import errno
+import glob
+import json
+import os
+import queue
+import socket
+import threading
+import time
+
+# 文章页的实时事件(新评论、评论删除、点赞数变化), 通过 server-sent events 推给正在看这篇文章的读者
+# 每个 worker 在 CACHE_DIR/events 下绑定一个 unix datagram socket, 发布时把事件发给目录里所有的 socket,
+# 各 worker 的接收线程再分发给本进程里订阅这篇文章的连接; 订阅者只是一个队列, 空闲连接几乎不占资源,
+# 但需要 gevent 之类的协程 worker, 由单独的 gunicorn 提供, 见 conf/gunicorn_events.py;
+# 两个 gunicorn 要用同一个 CACHE_DIR, 普通 worker 里发布的事件才能送到 events worker
+
+
+class EventBroker(object):
+    def __init__(self, app=None):
+        self.app = None
+        self.max_subscribers = 0
+        self.heartbeat = 15
+        self._dir = None
+        self._sock = None
+        self._path = None
+        self._pid = None
+        self._subscribers = {}
+        self._count = 0
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        self.max_subscribers = app.config.get('EVENTS_MAX_SUBSCRIBERS', 5000)
+        self.heartbeat = app.config.get('EVENTS_HEARTBEAT', 15)
+        cache_dir = app.config.get('CACHE_DIR')
+        self._dir = os.path.join(cache_dir, 'events') if cache_dir else None
+
+    def _bind(self):
+        # gunicorn 在 fork 之后才有各自的 worker, 所以第一次订阅时才绑定 socket 并启动接收线程
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._subscribers = {}
+            self._count = 0
+            self._sock = None
+            if self._dir is not None:
+                if not os.path.isdir(self._dir):
+                    os.makedirs(self._dir)
+                path = os.path.join(self._dir, '%d.sock' % os.getpid())
+                if os.path.exists(path):
+                    os.unlink(path)
+                sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+                sock.bind(path)
+                self._sock, self._path = sock, path
+                thread = threading.Thread(target=self._receive, args=(sock,))
+                thread.daemon = True
+                thread.start()
+            self._pid = os.getpid()
+
+    def _receive(self, sock):
+        while True:
+            try:
+                data = sock.recv(1 << 20)
+            except socket.error:
+                return
+            try:
+                post_id, event, payload = json.loads(data.decode('utf-8'))
+            except ValueError:
+                continue
+            self._dispatch(post_id, event, payload)
+
+    def _dispatch(self, post_id, event, payload):
+        with self._lock:
+            subscribers = list(self._subscribers.get(post_id, ()))
+        for q in subscribers:
+            try:
+                q.put_nowait((event, payload))
+            except queue.Full:
+                # 读得太慢的连接丢掉事件, 客户端可以刷新页面补上
+                pass
+
+    def publish(self, post_id, event, payload):
+        """把事件发给所有 worker 里订阅了 post_id 的连接, 在事务提交之后调用"""
+        if self._dir is None:
+            self._dispatch(post_id, event, payload)
+            return
+        data = json.dumps([post_id, event, payload]).encode('utf-8')
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        # 某个 worker 的接收缓冲区满了就丢掉这条事件, 不能阻塞发布者
+        sock.setblocking(False)
+        try:
+            for path in glob.glob(os.path.join(self._dir, '*.sock')):
+                try:
+                    sock.sendto(data, path)
+                except socket.error as e:
+                    if e.errno in (errno.ECONNREFUSED, errno.ENOENT):
+                        # worker 已经退出, 清理它留下的 socket 文件
+                        try:
+                            os.unlink(path)
+                        except OSError:
+                            pass
+                    elif e.errno == errno.EMSGSIZE and event == 'comment':
+                        # 内容太长时只通知有新评论, 不带 HTML
+                        self.publish(post_id, event, dict(payload, html=None))
+                        return
+                    elif e.errno != errno.EAGAIN:
+                        raise
+        finally:
+            sock.close()
+
+    def subscribe(self, post_id):
+        """返回一个队列, 满了(达到 EVENTS_MAX_SUBSCRIBERS)时返回 None"""
+        self._bind()
+        q = queue.Queue(100)
+        with self._lock:
+            if self._count >= self.max_subscribers:
+                return None
+            self._subscribers.setdefault(post_id, set()).add(q)
+            self._count += 1
+        return q
+
+    def unsubscribe(self, post_id, q):
+        with self._lock:
+            subscribers = self._subscribers.get(post_id)
+            if subscribers is not None and q in subscribers:
+                subscribers.discard(q)
+                self._count -= 1
+                if not subscribers:
+                    del self._subscribers[post_id]
+
+    def stream(self, post_id, q):
+        """SSE 响应体: 事件一条一条地写出, 空闲时定期发注释行保持连接"""
+        try:
+            yield 'retry: 5000\n\n'
+            while True:
+                try:
+                    event, payload = q.get(timeout=self.heartbeat)
+                except queue.Empty:
+                    yield ': %d\n\n' % int(time.time())
+                    continue
+                yield 'event: %s\ndata: %s\n\n' % (event, json.dumps(payload))
+        finally:
+            self.unsubscribe(post_id, q)
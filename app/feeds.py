@@ -0,0 +1,245 @@
+# coding=utf-8
+import hashlib
+import threading
+from datetime import datetime
+from xml.sax.saxutils import escape, quoteattr
+from flask import current_app
+from werkzeug.urls import url_parse
+from . import db, versions, deferred
+from .routing import replica_settled
+from .models import Post, Category, Label, FeedEntry, FeedDocument, registrations
+
+# Atom 订阅和 sitemap
+# 每篇文章的 <entry> 和 <url> 片段预先生成存在 feed_entries 里, 拼好的完整文档存在 feed_documents 里,
+# 文章增删改时在同一个事务里只重新生成这篇文章的片段, 受影响的文档在提交之后由后台线程重新生成(见 deferred.py);
+# 请求时直接返回存好的文档, 每个 worker 缓存一份, 用 feeds tag 的版本号判断是否过期
+
+FEED_SIZE = 20
+# 每个 sitemap 文件包含 id 在同一区间内的文章, 修改一篇文章只重新生成它所在的那个文件
+SITEMAP_CHUNK = 10000
+
+
+def _urls():
+    # 生成绝对地址不依赖请求上下文, 命令行里也能用
+    site = url_parse(current_app.config.get('SITE_URL') or 'http://localhost')
+    return current_app.url_map.bind(site.netloc, script_name=site.path or '/', url_scheme=site.scheme)
+
+
+def _url(endpoint, **values):
+    return _urls().build(endpoint, values, force_external=True)
+
+
+def _iso(timestamp):
+    return (timestamp or datetime.utcnow()).strftime('%Y-%m-%dT%H:%M:%SZ')
+
+
+def entry_atom(post, url):
+    categories = ([post.category.tag] if post.category is not None else []) + [l.label for l in post.labels]
+    summary = post.summery_html if post.summery_html is not None else escape(post.summery or '')
+    return ''.join([
+        '<entry>',
+        '<title>%s</title>' % escape(post.title or ''),
+        '<link href=%s/>' % quoteattr(url),
+        '<id>%s</id>' % escape(url),
+        '<published>%s</published>' % _iso(post.timestamp),
+        '<updated>%s</updated>' % _iso(post.timestamp_update or post.timestamp),
+        ''.join('<category term=%s/>' % quoteattr(term) for term in categories),
+        '<summary type="html">%s</summary>' % escape(summary),
+        '</entry>',
+    ])
+
+
+def entry_sitemap(post, url):
+    return '<url><loc>%s</loc><lastmod>%s</lastmod></url>' % (
+        escape(url), _iso(post.timestamp_update or post.timestamp))
+
+
+def _save(name, body, updated):
+    body = body.encode('utf-8')
+    etag = hashlib.sha1(body).hexdigest()
+    document = FeedDocument.query.get(name)
+    if document is None:
+        document = FeedDocument(name=name)
+        db.session.add(document)
+    elif document.etag == etag:
+        return
+    document.body = body
+    document.etag = etag
+    document.updated = updated or datetime.utcnow()
+
+
+def _atom(name, title, self_url, query):
+    rows = query.join(FeedEntry, FeedEntry.post_id == Post.id) \
+        .with_entities(FeedEntry.atom, Post.timestamp_update) \
+        .order_by(Post.timestamp.desc(), Post.id.desc()).limit(FEED_SIZE).all()
+    updated = max([row[1] for row in rows if row[1] is not None] or [None])
+    body = ''.join([
+        '<?xml version="1.0" encoding="utf-8"?>\n',
+        '<feed xmlns="http://www.w3.org/2005/Atom">',
+        '<title>%s</title>' % escape(title),
+        '<link href=%s/>' % quoteattr(_url('main.index')),
+        '<link rel="self" href=%s/>' % quoteattr(self_url),
+        '<id>%s</id>' % escape(self_url),
+        '<updated>%s</updated>' % _iso(updated),
+        ''.join(row[0] for row in rows),
+        '</feed>',
+    ])
+    _save(name, body, updated)
+
+
+def _sitemap_chunk(chunk):
+    rows = db.session.query(FeedEntry.sitemap, Post.timestamp_update) \
+        .join(Post, Post.id == FeedEntry.post_id) \
+        .filter(FeedEntry.post_id >= chunk * SITEMAP_CHUNK, FeedEntry.post_id < (chunk + 1) * SITEMAP_CHUNK) \
+        .order_by(FeedEntry.post_id).all()
+    name = 'sitemap:%d' % chunk
+    if not rows:
+        FeedDocument.query.filter_by(name=name).delete(synchronize_session=False)
+        return
+    updated = max([row[1] for row in rows if row[1] is not None] or [None])
+    _save(name, ''.join(['<?xml version="1.0" encoding="utf-8"?>\n',
+                         '<urlset xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">',
+                         ''.join(row[0] for row in rows), '</urlset>']), updated)
+
+
+def _sitemap_index():
+    # 首页和分类页单独一个 sitemap, 再加上各个文章区间的 sitemap
+    updated = db.session.query(db.func.max(Post.timestamp_update)).scalar()
+    pages = ['<url><loc>%s</loc><lastmod>%s</lastmod></url>' % (escape(_url('main.index')), _iso(updated))]
+    pages += ['<url><loc>%s</loc></url>' % escape(_url('main.category', category=tag))
+              for tag, in db.session.query(Category.tag).order_by(Category.id)]
+    _save('sitemap:pages', ''.join(['<?xml version="1.0" encoding="utf-8"?>\n',
+                                    '<urlset xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">',
+                                    ''.join(pages), '</urlset>']), updated)
+    db.session.flush()
+    chunks = db.session.query(FeedDocument.name, FeedDocument.updated) \
+        .filter(FeedDocument.name.like('sitemap:%')).all()
+    items = []
+    for name, chunk_updated in sorted(chunks):
+        part = name.split(':', 1)[1]
+        url = _url('main.sitemap_part', part=part)
+        items.append('<sitemap><loc>%s</loc><lastmod>%s</lastmod></sitemap>' % (escape(url), _iso(chunk_updated)))
+    _save('sitemap', ''.join(['<?xml version="1.0" encoding="utf-8"?>\n',
+                              '<sitemapindex xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">',
+                              ''.join(items), '</sitemapindex>']), updated)
+
+
+def _document_names(post_ids, category_ids, label_ids):
+    names = ['atom', 'sitemap', 'sitemap:pages']
+    names += ['atom:category:%d' % id for id in category_ids]
+    names += ['atom:label:%d' % id for id in label_ids]
+    names += ['sitemap:%d' % chunk for chunk in set(post_id // SITEMAP_CHUNK for post_id in post_ids)]
+    return sorted(names)
+
+
+def _rebuild_documents(post_ids, category_ids, label_ids):
+    db.session.flush()
+    _atom('atom', 'DexCode', _url('main.feed'), Post.query)
+    for category_id in set(category_ids):
+        category = Category.query.get(category_id)
+        if category is not None:
+            _atom('atom:category:%d' % category.id, 'DexCode - %s' % category.tag,
+                  _url('main.category_feed', category=category.tag), Post.query.filter_by(category_id=category.id))
+    for label_id in set(label_ids):
+        label = Label.query.get(label_id)
+        if label is not None:
+            _atom('atom:label:%d' % label.id, 'DexCode - %s' % label.label,
+                  _url('main.label_feed', label=label.label),
+                  Post.query.join(registrations, registrations.c.post_id == Post.id)
+                  .filter(registrations.c.label_id == label.id))
+    for chunk in set(post_id // SITEMAP_CHUNK for post_id in post_ids):
+        _sitemap_chunk(chunk)
+    _sitemap_index()
+
+
+def _write_entry(post):
+    url = _url('main.post', id=post.id)
+    entry = FeedEntry.query.get(post.id)
+    if entry is None:
+        entry = FeedEntry(post_id=post.id)
+        db.session.add(entry)
+    entry.atom = entry_atom(post, url)
+    entry.sitemap = entry_sitemap(post, url)
+
+
+def rebuild_documents(post_ids, category_ids, label_ids):
+    """写操作提交之后在后台线程里执行: 重新生成受影响的文档并提交"""
+    # 先按名字顺序锁住这些文档, 几个 worker 同时重建时后开始的一个读到的是最新的片段, 不会被先开始的覆盖
+    FeedDocument.query.filter(FeedDocument.name.in_(_document_names(post_ids, category_ids, label_ids))) \
+        .order_by(FeedDocument.name).with_for_update().with_entities(FeedDocument.name).all()
+    _rebuild_documents(post_ids, category_ids, label_ids)
+    db.session.commit()
+    versions.bump('feeds')
+
+
+def update_post(post, old_label_ids=()):
+    """文章新增或修改之后调用, 片段在调用者的事务里写入, 由调用者提交; 文档在提交之后重新生成"""
+    db.session.flush()
+    _write_entry(post)
+    deferred.after_commit(rebuild_documents, [post.id], [post.category_id] if post.category_id else [],
+                          set(old_label_ids) | set(l.id for l in post.labels))
+
+
+def add_posts(posts):
+    """批量导入的新文章: 片段一次插入, 受影响的文档只重新生成一次"""
+    if not posts:
+        return
+    db.session.add_all(FeedEntry(post_id=post.id, atom=entry_atom(post, _url('main.post', id=post.id)),
+                                 sitemap=entry_sitemap(post, _url('main.post', id=post.id))) for post in posts)
+    _rebuild_documents([post.id for post in posts], [post.category_id for post in posts if post.category_id],
+                       set(l.id for post in posts for l in post.labels))
+
+
+def remove_post(post_id, category_id, label_ids):
+    """文章删除时调用, 文章那一行删掉之前调用"""
+    FeedEntry.query.filter_by(post_id=post_id).delete(synchronize_session=False)
+    deferred.after_commit(rebuild_documents, [post_id], [category_id] if category_id else [], label_ids)
+
+
+def update_pages():
+    # 新增 Category 之后更新 sitemap
+    deferred.after_commit(rebuild_documents, [], [], [])
+
+
+def rebuild(batch_size=500):
+    """重新生成全部片段和文档, 返回处理的文章数"""
+    FeedEntry.query.delete(synchronize_session=False)
+    FeedDocument.query.delete(synchronize_session=False)
+    db.session.commit()
+    total = 0
+    last_id = 0
+    while True:
+        posts = Post.query.filter(Post.id > last_id).order_by(Post.id) \
+            .options(db.joinedload(Post.category), db.subqueryload(Post.labels)).limit(batch_size).all()
+        if not posts:
+            break
+        last_id = posts[-1].id
+        for post in posts:
+            _write_entry(post)
+        db.session.commit()
+        total += len(posts)
+    post_ids = [row[0] for row in db.session.query(Post.id)]
+    _rebuild_documents(post_ids, [row[0] for row in db.session.query(Category.id)],
+                       [row[0] for row in db.session.query(Label.id)])
+    db.session.commit()
+    versions.bump('feeds')
+    return total
+
+
+_documents = {}
+_documents_lock = threading.Lock()
+
+
+def get_document(name):
+    """(body, etag, updated), 不存在时返回 None; 每个 worker 按 feeds tag 的版本号缓存"""
+    version = versions.get('feeds')
+    with _documents_lock:
+        cached = _documents.get(name)
+    if cached is not None and cached[0] == version:
+        return cached[1]
+    row = db.session.query(FeedDocument.body, FeedDocument.etag, FeedDocument.updated).filter_by(name=name).first()
+    document = tuple(row) if row is not None else None
+    if replica_settled(versions, ['feeds']):
+        with _documents_lock:
+            _documents[name] = (version, document)
+    return document
@@ -0,0 +1,123 @@
+# coding=utf-8
+import json
+import logging
+import os
+import threading
+import time
+from collections import defaultdict, deque
+from flask import g, request, has_request_context
+from flask_sqlalchemy import get_debug_queries
+from jinja2 import Template
+
+# 每个请求的查询次数、数据库耗时、模板渲染耗时、Markdown 渲染耗时
+# 写进 Server-Timing 响应头和一行 JSON 日志, 超过 SLOW_QUERY_THRESHOLD 秒的查询带上语句和调用位置单独记录
+# 各 endpoint 最近 PERF_SAMPLE_SIZE 次请求的耗时留在进程内, 用来算 p50/p95/p99
+
+logger = logging.getLogger('dexcode.perf')
+
+
+def add_timing(name, seconds):
+    # 在请求里累加一项耗时, 请求之外(后台线程、命令行)调用时什么都不做
+    if has_request_context() and 'perf' in g:
+        g.perf[name] += seconds
+
+
+class TimedTemplate(Template):
+    # extends / include 的子模板不经过 render, 这里计入的是整个页面的渲染时间
+    def render(self, *args, **kwargs):
+        start = time.time()
+        try:
+            return Template.render(self, *args, **kwargs)
+        finally:
+            add_timing('template', time.time() - start)
+
+
+def percentile(values, p):
+    # values 需要已经排好序
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+class Instrumentation(object):
+    def __init__(self, app=None):
+        self.slow_query = 0.5
+        self.sample_size = 1000
+        self._samples = {}
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.slow_query = app.config.get('SLOW_QUERY_THRESHOLD', 0.5)
+        self.sample_size = app.config.get('PERF_SAMPLE_SIZE', 1000)
+        if not app.config.get('PERF_ENABLED', True):
+            return
+        # get_debug_queries 依赖 SQLALCHEMY_RECORD_QUERIES
+        app.config.setdefault('SQLALCHEMY_RECORD_QUERIES', True)
+        app.jinja_env.template_class = TimedTemplate
+        if app.config.get('PERF_LOG') and not logger.handlers:
+            handler = logging.StreamHandler() if app.config['PERF_LOG'] == '-' \
+                else logging.FileHandler(app.config['PERF_LOG'])
+            handler.setFormatter(logging.Formatter('%(message)s'))
+            logger.addHandler(handler)
+            logger.setLevel(logging.INFO)
+            logger.propagate = False
+        app.before_request(self._before_request)
+        app.after_request(self._after_request)
+
+    def _before_request(self):
+        g.perf = defaultdict(float)
+        g.perf_start = time.time()
+
+    def _after_request(self, response):
+        if 'perf' not in g:
+            return response
+        total = time.time() - g.perf_start
+        queries = get_debug_queries()
+        db_time = sum(q.duration for q in queries)
+        endpoint = request.endpoint or 'none'
+        timings = [('db', db_time), ('tpl', g.perf['template']), ('md', g.perf['markdown']),
+                   ('total', total)]
+        # Server-Timing 的 dur 单位是毫秒; 查询次数放在 db 的 desc 里
+        response.headers['Server-Timing'] = ', '.join(
+            '%s;dur=%.2f' % (name, seconds * 1000) if name != 'db' else
+            'db;dur=%.2f;desc="%d queries"' % (seconds * 1000, len(queries))
+            for name, seconds in timings)
+        for query in queries:
+            if query.duration >= self.slow_query:
+                logger.warning(json.dumps({
+                    'event': 'slow_query', 'endpoint': endpoint, 'path': request.path,
+                    'ms': round(query.duration * 1000, 2), 'statement': query.statement,
+                    'context': query.context}))
+        logger.info(json.dumps({
+            'event': 'request', 'endpoint': endpoint, 'method': request.method,
+            'path': request.path, 'status': response.status_code,
+            'cache': response.headers.get('X-Page-Cache'), 'queries': len(queries),
+            'ms': round(total * 1000, 2), 'db_ms': round(db_time * 1000, 2),
+            'template_ms': round(g.perf['template'] * 1000, 2),
+            'markdown_ms': round(g.perf['markdown'] * 1000, 2)}))
+        self.record(endpoint, total)
+        return response
+
+    def record(self, endpoint, seconds):
+        with self._lock:
+            samples = self._samples.get(endpoint)
+            if samples is None:
+                samples = self._samples[endpoint] = deque(maxlen=self.sample_size)
+            samples.append(seconds)
+
+    def stats(self):
+        """当前 worker 里各 endpoint 的请求数和 p50/p95/p99(毫秒)"""
+        with self._lock:
+            samples = dict((endpoint, sorted(values)) for endpoint, values in self._samples.items())
+        result = {}
+        for endpoint, values in samples.items():
+            result[endpoint] = {
+                'count': len(values),
+                'p50': round(percentile(values, 0.5) * 1000, 2),
+                'p95': round(percentile(values, 0.95) * 1000, 2),
+                'p99': round(percentile(values, 0.99) * 1000, 2),
+                'max': round(values[-1] * 1000, 2),
+            }
+        return {'pid': os.getpid(), 'endpoints': result}
@@ -0,0 +1,80 @@
+# coding=utf-8
+from . import db, counters
+from .models import Post, Comment, LikePost, LikeComment, DislikeComment
+
+
+class Interaction(object):
+    """点赞/踩一类的 (目标, 用户) 关系, 同一个用户对同一个目标最多一行
+
+    add/remove 是幂等的, 只有真正插入或删除了一行才会产生计数增量
+    """
+
+    def __init__(self, model, target, counter, touch_post=False):
+        self.model = model
+        self.table = model.__table__
+        self.target = target
+        self.counter = counter
+        # 目标不是文章本身时(评论), 计数写回时也要更新所在文章的修改时间
+        self.touch_post = touch_post
+
+    def _count_delta(self, target_id, delta, post_id):
+        counters.add(self.counter, target_id, delta, 'post:%d' % post_id,
+                     (Post, post_id) if self.touch_post else None)
+
+    def _insert(self):
+        # 重复插入时静默忽略, 依赖 (target, user_id) 上的唯一约束
+        return self.table.insert().prefix_with('IGNORE', dialect='mysql') \
+            .prefix_with('OR IGNORE', dialect='sqlite')
+
+    def add(self, user_id, target_id, post_id):
+        # post_id 是目标所在的文章, 计数写回后失效这篇文章的页面缓存
+        values = {self.target: target_id, 'user_id': user_id}
+        # 文章的点赞目标列就是 post_id
+        if self.target != 'post_id':
+            values['post_id'] = post_id
+        result = db.session.execute(self._insert(), values)
+        db.session.commit()
+        if result.rowcount == 1:
+            self._count_delta(target_id, 1, post_id)
+            return True
+        return False
+
+    def remove(self, user_id, target_id, post_id):
+        result = db.session.execute(self.table.delete().where(db.and_(
+            self.table.c[self.target] == target_id, self.table.c.user_id == user_id)))
+        db.session.commit()
+        if result.rowcount:
+            self._count_delta(target_id, -result.rowcount, post_id)
+            return True
+        return False
+
+    def count(self, target_id):
+        # 精确计数直接数关系表, 走 (target, user_id) 唯一索引的前缀
+        return db.session.query(db.func.count(self.table.c.user_id)) \
+            .filter(self.table.c[self.target] == target_id).scalar()
+
+    def states(self, user_id, target_ids):
+        """target_ids 中 user_id 点过的那些, 一条查询, 走 (user_id, target) 索引"""
+        target_ids = set(target_ids)
+        if user_id is None or not target_ids:
+            return set()
+        column = self.table.c[self.target]
+        return set(row[0] for row in db.session.query(column).filter(
+            self.table.c.user_id == user_id, column.in_(target_ids)))
+
+
+post_likes = Interaction(LikePost, 'post_id', Post.like_num)
+comment_likes = Interaction(LikeComment, 'comment_id', Comment.like_num, touch_post=True)
+comment_dislikes = Interaction(DislikeComment, 'comment_id', Comment.dislike_num, touch_post=True)
+
+# 一次最多查询的文章/评论数
+MAX_STATE_IDS = 200
+
+
+def interaction_state(user_id, post_ids=(), comment_ids=()):
+    """用户对一组文章和评论的点赞/踩状态, 每张表最多一条查询, 返回的都是 id 的集合"""
+    return {
+        'posts': {'liked': post_likes.states(user_id, post_ids)},
+        'comments': {'liked': comment_likes.states(user_id, comment_ids),
+                     'disliked': comment_dislikes.states(user_id, comment_ids)},
+    }
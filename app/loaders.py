@@ -0,0 +1,155 @@
+# coding=utf-8
+import base64
+import binascii
+import threading
+from collections import defaultdict
+from datetime import datetime
+from flask import current_app, g
+from flask_sqlalchemy import Pagination
+from sqlalchemy.orm.attributes import set_committed_value
+from . import db, versions
+from .routing import replica_settled
+from .models import Post, Comment, Label, registrations
+
+
+# 列表页和文章页的数据加载
+# 一页文章连同它们的 Category 和 Label, 一页评论连同评论者, 查询次数都是固定的
+# 默认按 (timestamp, id) 做 keyset 分页, 翻页靠游标而不是 OFFSET, 总数取缓存或计数列
+
+
+class KeysetPagination(Pagination):
+    """和 Flask-SQLAlchemy 的 Pagination 接口一致, 多了 prev_cursor / next_cursor
+
+    游标里带着页码, 所以页码链接(OFFSET 分页)仍然可以作为后备使用
+    """
+
+    def __init__(self, page, per_page, total, items, has_prev, has_next,
+                 prev_cursor=None, next_cursor=None):
+        Pagination.__init__(self, None, page, per_page, total, items)
+        self._has_prev = has_prev
+        self._has_next = has_next
+        self.prev_cursor = prev_cursor
+        self.next_cursor = next_cursor
+
+    @property
+    def has_prev(self):
+        return self._has_prev
+
+    @property
+    def has_next(self):
+        return self._has_next
+
+
+_ts_format = '%Y%m%d%H%M%S%f'
+
+
+def encode_cursor(direction, timestamp, id, page):
+    raw = '%s:%s:%d:%d' % (direction, timestamp.strftime(_ts_format), id, page)
+    return base64.urlsafe_b64encode(raw.encode('ascii')).decode('ascii').rstrip('=')
+
+
+def decode_cursor(cursor):
+    # 无法解析的游标返回 None, 当作第一页处理
+    try:
+        raw = base64.urlsafe_b64decode(str(cursor) + '=' * (-len(cursor) % 4)).decode('ascii')
+        direction, timestamp, id, page = raw.split(':')
+        if direction not in ('n', 'p'):
+            return None
+        return direction, datetime.strptime(timestamp, _ts_format), int(id), max(int(page), 1)
+    except (ValueError, TypeError, UnicodeDecodeError, binascii.Error):
+        return None
+
+
+def _paginate(query, ts_col, id_col, per_page, cursor, page, total):
+    keyset = current_app.config.get('KEYSET_PAGINATION', True)
+    decoded = decode_cursor(cursor) if keyset and cursor else None
+    if decoded is not None:
+        direction, ts, id, page = decoded
+        if direction == 'n':
+            # 游标之后(更旧)的一页; 单独的 ts_col <= ts 让数据库可以在索引上做范围查找
+            query = query.filter(ts_col <= ts, db.or_(ts_col < ts, id_col < id))
+            rows = query.order_by(ts_col.desc(), id_col.desc()).limit(per_page + 1).all()
+            has_prev, has_next = True, len(rows) > per_page
+            items = rows[:per_page]
+        else:
+            # 游标之前(更新)的一页, 反向取出后再倒过来
+            query = query.filter(ts_col >= ts, db.or_(ts_col > ts, id_col > id))
+            rows = query.order_by(ts_col.asc(), id_col.asc()).limit(per_page + 1).all()
+            has_prev, has_next = len(rows) > per_page, True
+            items = rows[:per_page][::-1]
+    else:
+        # 没有游标时按页码取, 第一页等价于 keyset 的起点
+        page = max(page or 1, 1)
+        query = query.order_by(ts_col.desc(), id_col.desc())
+        rows = query.limit(per_page + 1).offset((page - 1) * per_page).all()
+        has_prev, has_next = page > 1, len(rows) > per_page
+        items = rows[:per_page]
+    prev_cursor = next_cursor = None
+    # 静态页面的上一页/下一页用页码链接, 才能对应到导出的文件
+    if keyset and items and not g.get('static_export'):
+        if has_prev:
+            prev_cursor = encode_cursor('p', items[0].timestamp, items[0].id, page - 1)
+        if has_next:
+            next_cursor = encode_cursor('n', items[-1].timestamp, items[-1].id, page + 1)
+    return KeysetPagination(page, per_page, total, items, has_prev, has_next,
+                            prev_cursor, next_cursor)
+
+
+_counts = {}
+_counts_lock = threading.Lock()
+
+
+def cached_count(tag, query):
+    """COUNT(*) 的结果按 tag 的版本号缓存, 只有 tag 被 invalidate 之后才重新计数"""
+    version = versions.get(tag)
+    with _counts_lock:
+        cached = _counts.get(tag)
+    if cached is not None and cached[0] == version:
+        return cached[1]
+    count = query.order_by(None).count()
+    if replica_settled(versions, [tag]):
+        with _counts_lock:
+            _counts[tag] = (version, count)
+    return count
+
+
+def load_labels(posts):
+    """一条 IN 查询取出这些文章的 Label, 填进 post.labels
+
+    不用 subqueryload: 它把整个分页查询再套一层子查询, SQLAlchemy 1.1 还会加上 ORDER BY anon_1.posts_id,
+    数据库要为它建临时表排序; 这里按主键 (post_id, label_id) 查找, 不排序, 在 Python 里分组
+    """
+    if not posts:
+        return posts
+    labels = defaultdict(list)
+    for post_id, label in db.session.query(registrations.c.post_id, Label) \
+            .join(Label, Label.id == registrations.c.label_id) \
+            .filter(registrations.c.post_id.in_([post.id for post in posts])):
+        labels[post_id].append(label)
+    for post in posts:
+        set_committed_value(post, 'labels', labels[post.id])
+    return posts
+
+
+def post_page(query, per_page, cursor=None, page=1, total=0):
+    # Category 用 JOIN 一起取出, Label 用一条 IN 查询按整页取出
+    query = query.options(db.joinedload(Post.category))
+    pagination = _paginate(query, Post.timestamp, Post.id, per_page, cursor, page, total)
+    load_labels(pagination.items)
+    return pagination
+
+
+def comment_page(post, per_page, cursor=None, page=1):
+    # 评论总数直接用 Post.comment_num, 不再 COUNT
+    query = post.comments.options(db.joinedload(Comment.user))
+    return _paginate(query, Comment.timestamp, Comment.id, per_page, cursor, page,
+                     post.comment_num or 0)
+
+
+def posts_by_ids(ids):
+    # 按给定的 id 顺序返回文章, 比如搜索结果
+    if not ids:
+        return []
+    posts = load_labels(Post.query.filter(Post.id.in_(ids)).options(db.joinedload(Post.category)).all())
+    posts = dict((post.id, post) for post in posts)
+    return [posts[id] for id in ids if id in posts]
@@ -1,6 +1,7 @@
 # coding=utf-8
 from flask import render_template
 from . import main
+from .. import sidebar
 from .forms import LoginForm, CategoryForm
 
 
@@ -8,4 +9,5 @@ from .forms import LoginForm, CategoryForm
 def page_not_found(error):
     loginform = LoginForm()
     categoryForm = CategoryForm()
-    return render_template("404.html", loginform=loginform, categoryForm=categoryForm), 404
\ No newline at end of file
+    return render_template("404.html", loginform=loginform, categoryForm=categoryForm,
+                           categories=sidebar.categories()), 404
\ No newline at end of file
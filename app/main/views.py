@@ -1,12 +1,18 @@
 # coding=utf-8
-from datetime import datetime
-from flask import render_template, request, current_app, redirect, url_for, flash, jsonify, g
+from flask import render_template, request, current_app, redirect, url_for, flash, jsonify, g, abort
+from flask_wtf.csrf import generate_csrf
 from flask_login import login_required, login_user, logout_user, current_user
+from flask_sqlalchemy import Pagination
 from . import main
 from .forms import PostForm, EditForm, CommentForm, LoginForm, CategoryForm
-from .. import db
-from ..models import Category, Post, Label, Comment, User, LikePost
-from ..decorators import dexter_required
+from .. import db, page_cache, services, sidebar, instrument, events, feeds, users, pageviews
+from ..models import Post, Comment, User
+from ..decorators import dexter_required, replica_reads
+from ..loaders import post_page, comment_page, cached_count, posts_by_ids
+from ..search import search_posts
+from ..related import related_posts
+from ..conditional import conditional, list_validators, post_validators
+from ..likes import post_likes, comment_likes, comment_dislikes, interaction_state, MAX_STATE_IDS
 
 
 def login():
@@ -22,80 +28,158 @@ def login():
 def add_category():
     g.categoryForm = CategoryForm()
     if g.categoryForm.is_submitted():
-        category = Category.query.filter_by(tag=g.categoryForm.category.data).first()
-        if category is None:
-            category = Category(tag=g.categoryForm.category.data, count=0)
-            db.session.add(category)
-            db.session.commit()
+        services.create_category(g.categoryForm.category.data)
     return redirect(url_for('main.write', user=current_user))
 
 
 @main.route('/', methods=['GET', 'POST'])
+@replica_reads
+@conditional(list_validators)
+@page_cache.cached('index')
 def index():
-    categories = Category.query.all()
-    labels = Label.query.all()
+    categories = sidebar.categories()
+    labels = sidebar.labels()
     page = request.args.get('page', 1, type=int)
-    pagination = Post.query.order_by(Post.timestamp.desc()).paginate(
-        page, per_page=current_app.config['POSTS_PER_PAGE'], error_out=False)
+    cursor = request.args.get('cursor')
+    pagination = post_page(Post.query, current_app.config['POSTS_PER_PAGE'], cursor, page,
+                           cached_count('index', Post.query))
     posts = pagination.items
+    page_cache.tag(*['post:%d' % p.id for p in posts])
+    views = pageviews.stats([p.id for p in posts])
     # 登录表单
     login()
     add_category()
     return render_template('index.html', posts=posts, pagination=pagination, categories=categories,
-                           loginform=g.loginform, categoryForm=g.categoryForm, labels=labels)
+                           loginform=g.loginform, categoryForm=g.categoryForm, labels=labels, views=views)
 
 
 @main.route('/category/<category>', methods=['GET'])
+@replica_reads
+@conditional(list_validators)
+@page_cache.cached()
 def category(category):
-    categories = Category.query.all()
-    category = Category.query.filter_by(tag=category).first_or_404()
+    categories = sidebar.categories()
+    category = sidebar.category(category)
+    if category is None:
+        abort(404)
     page = request.args.get('page', 1, type=int)
-    pagination = category.posts.order_by(Post.timestamp.desc()).paginate(
-        page, per_page=current_app.config['POSTS_PER_PAGE'], error_out=False)
+    cursor = request.args.get('cursor')
+    # 分类下的文章数直接用 Category.count
+    pagination = post_page(Post.query.filter_by(category_id=category.id), current_app.config['POSTS_PER_PAGE'],
+                           cursor, page, category.count or 0)
     posts = pagination.items
+    page_cache.tag('category:%d' % category.id, *['post:%d' % p.id for p in posts])
+    views = pageviews.stats([p.id for p in posts])
     # 登录表单
     login()
     add_category()
     return render_template('category.html', category=category, posts=posts, pagination=pagination,
-                           loginform=g.loginform, categoryForm=g.categoryForm, categories=categories)
+                           loginform=g.loginform, categoryForm=g.categoryForm, categories=categories, views=views)
 
 
 @main.route('/post/<int:id>', methods=['GET', 'POST'])
+@replica_reads
+@conditional(post_validators)
+@page_cache.cached()
 def post(id):
-    categories = Category.query.all()
+    categories = sidebar.categories()
     form = CommentForm()
     post = Post.query.get_or_404(id)
-    # 区别用户是否对该文章点赞
+    if form.validate_on_submit():
+        services.add_comment(post.id, current_user.id, form.comment.data)
+        return redirect(url_for('main.post', id=id))
+    # 区别用户是否对该文章点赞, 评论的点赞/踩状态由页面通过 /interactions 获取
     like = False
     # 确定用户已经登陆在进行判断，否则为 False
     if current_user.is_authenticated:
-        if LikePost.query.filter_by(post=post, user=current_user).first() is not None:
-            like = True
+        page_cache.tag('like:%d:%s' % (post.id, current_user.id))
+        like = post.id in post_likes.states(current_user.id, [post.id])
     page = request.args.get('page', 1, type=int)
-    pagination = post.comments.order_by(Comment.timestamp.desc()).paginate(
-        page, per_page=current_app.config['COMMENTS_PER_PAGE'], error_out=False)
+    cursor = request.args.get('cursor')
+    pagination = comment_page(post, current_app.config['COMMENTS_PER_PAGE'], cursor, page)
     comments = pagination.items
-    if form.validate_on_submit():
-        comment = Comment(comment=form.comment.data, post=post, user=current_user)
-        #  P增加一个评论的同时将评论所在的 post 的评论数 +1
-        post.comment_num += 1
-        db.session.add(post)
-        db.session.commit()
-        db.session.add(comment)
-        db.session.commit()
-        return redirect(url_for('main.post', id=id))
+    related = related_posts(post.id)
+    views = pageviews.stats([post.id])[post.id]
+    page_cache.tag('post:%d' % post.id, *['label:%d' % l.id for l in post.labels])
     # 登录表单
     login()
     add_category()
     return render_template("post.html", post=post, form=form, comments=comments, pagination=pagination
-                           , loginform=g.loginform, categoryForm=g.categoryForm, categories=categories, like=like)
+                           , loginform=g.loginform, categoryForm=g.categoryForm, categories=categories, like=like,
+                           related=related, views=views)
+
+
+@main.route('/search', methods=['GET', 'POST'])
+@replica_reads
+def search():
+    categories = sidebar.categories()
+    q = request.args.get('q', '').strip()
+    page = max(request.args.get('page', 1, type=int), 1)
+    per_page = current_app.config['POSTS_PER_PAGE']
+    ranked, total = search_posts(q, page * per_page)
+    posts = posts_by_ids([post_id for post_id, score in ranked[(page - 1) * per_page:]])
+    pagination = Pagination(None, page, per_page, total, posts)
+    # 登录表单
+    login()
+    add_category()
+    return render_template('search.html', q=q, posts=posts, pagination=pagination,
+                           loginform=g.loginform, categoryForm=g.categoryForm, categories=categories)
+
+
+def _document(name, mimetype):
+    # feeds.py 预先拼好的 Atom / sitemap 文档, 公开缓存, 过期后用 ETag 验证
+    document = feeds.get_document(name)
+    if document is None:
+        abort(404)
+    body, etag, updated = document
+    response = current_app.response_class(body, mimetype=mimetype)
+    response.set_etag(etag)
+    response.last_modified = updated
+    response.headers['Cache-Control'] = 'public, max-age=300'
+    return response.make_conditional(request)
+
+
+@main.route('/feed.atom')
+@replica_reads
+def feed():
+    return _document('atom', 'application/atom+xml')
+
+
+@main.route('/category/<category>/feed.atom')
+@replica_reads
+def category_feed(category):
+    category = sidebar.category(category)
+    if category is None:
+        abort(404)
+    return _document('atom:category:%d' % category.id, 'application/atom+xml')
+
+
+@main.route('/label/<label>/feed.atom')
+@replica_reads
+def label_feed(label):
+    label = sidebar.label(label)
+    if label is None:
+        abort(404)
+    return _document('atom:label:%d' % label.id, 'application/atom+xml')
+
+
+@main.route('/sitemap.xml')
+@replica_reads
+def sitemap():
+    return _document('sitemap', 'application/xml')
+
+
+@main.route('/sitemap-<part>.xml')
+@replica_reads
+def sitemap_part(part):
+    return _document('sitemap:%s' % part, 'application/xml')
 
 
 @main.route('/write', methods=['GET', 'POST'])
 @login_required
 @dexter_required
 def write():
-    categories = Category.query.all()
+    categories = sidebar.categories()
     form = PostForm()
     login()
     add_category()
@@ -105,34 +189,8 @@ def write():
         choices.append((category.tag, category.tag))
     form.category.choices = choices
     if form.validate_on_submit():
-        labels = []
-        category = form.category.data
-        labels_post = form.labels.data.split(',')
-        for l in labels_post:
-            label = Label.query.filter_by(label=l).first()
-            if label is None:
-                label = Label(label=l, count=0)
-                db.session.add(label)
-                db.session.commit()
-            labels.append(label)
-        post = Post(title=form.title.data,
-                    summery=form.summery.data,
-                    body=form.body.data,
-                    category=Category.query.filter_by(tag=category).first(),
-                    labels=labels,
-                    comment_num=0,
-                    like_num=0)
-        # 增加一篇文章的同时将其所在的 Category 的文章数 +1
-        post.category.count += 1
-        db.session.add(post.category)
-        db.session.commit()
-        # 增加一篇文章的同时将其所包含的的 Label 的文章数 +1
-        for label in labels:
-            label.count += 1
-            db.session.add(label)
-            db.session.commit()
-        db.session.add(post)
-        db.session.commit()
+        post = services.create_post(form.title.data, form.summery.data, form.body.data,
+                                    form.category.data, services.split_labels(form.labels.data))
         return redirect(url_for('main.post', id=post.id))
     return render_template("write.html", form=form, loginform=g.loginform, categories=categories, categoryForm=g.categoryForm)
 
@@ -141,60 +199,20 @@ def write():
 @login_required
 @dexter_required
 def edit(id):
-    categories = Category.query.all()
+    categories = sidebar.categories()
     post = Post.query.get_or_404(id)
     form = EditForm()
     login()
     add_category()
     if form.validate_on_submit():
-        add = False
-        labels = []
-        labels_post = form.labels.data.split(',')
-        for l in labels_post:
-            label = Label.query.filter_by(label=l).first()
-            if label is None:
-                add = True
-                label = Label(label=l, count=0)
-                db.session.add(label)
-                db.session.commit()
-            # 此时的 label 是 Label 对象
-            labels.append(label)
-        post.title = form.title.data
-        post.summery = form.summery.data
-        post.body = form.body.data
-        post.timestamp_update = datetime.utcnow()
-        # 在更新 post 的 label 之前先分出修改之前已经有的 Label 和修改后的 label
-        # 这样在更新该 label 的文章数仅更新修改过的 Label 的文章数
-        # 避免发生同一篇文章在一个 Label 上算成两篇甚至多篇文章这种情况
-        # 1.修改文章时增加了 Label
-        if add:
-            for label in labels:
-                if label not in post.labels:
-                    label.count += 1
-                    db.session.add(label)
-                    db.session.commit()
-        # 2.修改文章时删除了某些 Label
-        else:
-            # 遍历未修改之前的 Label
-            for label in post.labels:
-                if label not in labels:
-                    label.count -= 1
-                    db.session.add(label)
-                    db.session.commit()
-        # 更新 post 的 label
-        post.labels = labels
-        db.session.add(post)
-        db.session.commit()
+        services.update_post(post, form.title.data, form.summery.data, form.body.data,
+                             services.split_labels(form.labels.data))
         return redirect(url_for('main.post', id=post.id))
     # 显示已有的信息
     form.title.data = post.title
     form.summery.data = post.summery
     form.body.data = post.body
-    str = ''
-    for label in post.labels:
-        str += label.label
-        str += ','
-    form.labels.data = str
+    form.labels.data = ','.join(label.label for label in post.labels)
     return render_template("edit.html", form=form, category=post.category, loginform=g.loginform
                            , categoryForm=g.categoryForm, categories=categories)
 
@@ -204,21 +222,7 @@ def edit(id):
 @dexter_required
 def delete_article(id):
     post = Post.query.get_or_404(id)
-    # 删除一篇文章的同时将其所在的 Category 的文章数 -1
-    post.category.count -= 1
-    db.session.add(post.category)
-    db.session.commit()
-    # 删除一篇文章的同时将其所包含的 Label 的文章数 -1
-    for label in post.labels:
-        label.count -= 1
-        db.session.add(label)
-        db.session.commit()
-    # 删除一篇文章的同时将其所有的 Comment
-    for comment in post.comments:
-        db.session.delete(comment)
-        db.session.commit()
-    db.session.delete(post)
-    db.session.commit()
+    services.delete_post(post)
     return redirect(url_for('main.index'))
 
 
@@ -228,49 +232,149 @@ def delete_article(id):
 def delete_comment(id):
     comment = Comment.query.get_or_404(id)
     # 保留comment 所在的 Post 的 id 方便重定向
-    id = comment.post.id
-    # 删除一个评论的同时将其所在的 Post 的评论数 -1
-    comment.post.comment_num -= 1
-    db.session.add(comment.post)
-    db.session.commit()
-    db.session.delete(comment)
-    db.session.commit()
+    id = services.delete_comment(comment)
     return redirect(url_for('main.post', id=id))
 
 
 @main.route('/logout')
 @login_required
 def logout():
+    users.invalidate(current_user.id)
     logout_user()
     return redirect(url_for('main.index'))
 
 
+def _post_exists(post_id):
+    if db.session.query(Post.id).filter_by(id=post_id).scalar() is None:
+        abort(404)
+
+
 @main.route('/like_post')
 @login_required
 def like_post():
-    # 通过 url 得到 post_id
+    # 通过 url 得到 post_id, 重复点赞不会重复计数
     post_id = request.args.get('post_id', 0, type=int)
-    post = Post.query.get_or_404(post_id)
-    like_post = LikePost(post=post, user=current_user)
-    db.session.add(like_post)
-    db.session.commit()
-    post.like_num += 1
-    db.session.add(post)
-    db.session.commit()
-    return jsonify(likes=post.like_num)
+    _post_exists(post_id)
+    post_likes.add(current_user.id, post_id, post_id)
+    page_cache.invalidate('like:%d:%s' % (post_id, current_user.id))
+    likes = post_likes.count(post_id)
+    events.publish(post_id, 'likes', {'likes': likes})
+    return jsonify(likes=likes, like=True)
 
 
 @main.route('/undo_like_post')
 @login_required
 def undo_like_post():
     post_id = request.args.get('post_id', 0, type=int)
-    post = Post.query.get_or_404(post_id)
-    like_post = LikePost.query.filter_by(post=post, user=current_user)
-    db.session.delete(like_post)
-    db.session.commit()
-    post.like_num -= 1
-    db.session.add(post)
-    db.session.commit()
-    return jsonify(likes=post.like_num)
+    _post_exists(post_id)
+    post_likes.remove(current_user.id, post_id, post_id)
+    page_cache.invalidate('like:%d:%s' % (post_id, current_user.id))
+    likes = post_likes.count(post_id)
+    events.publish(post_id, 'likes', {'likes': likes})
+    return jsonify(likes=likes, like=False)
+
+
+@main.route('/post/<int:id>/events')
+@replica_reads
+def post_events(id):
+    # 新评论、评论删除和点赞数变化的 server-sent events
+    _post_exists(id)
+    subscriber = events.subscribe(id)
+    if subscriber is None:
+        abort(503)
+    # 连接会保持很久, 不要一直占着数据库连接
+    db.session.remove()
+    response = current_app.response_class(events.stream(id, subscriber), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    # 让 nginx 不要缓冲这个响应
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
 
 
+def _comment_post_id(comment_id):
+    post_id = db.session.query(Comment.post_id).filter_by(id=comment_id).scalar()
+    if post_id is None:
+        abort(404)
+    return post_id
+
+
+def _comment_vote(interaction, opposite, add):
+    # 点赞和踩互斥, 点赞时取消踩, 反之亦然
+    comment_id = request.args.get('comment_id', 0, type=int)
+    post_id = _comment_post_id(comment_id)
+    if add:
+        opposite.remove(current_user.id, comment_id, post_id)
+        interaction.add(current_user.id, comment_id, post_id)
+    else:
+        interaction.remove(current_user.id, comment_id, post_id)
+    return jsonify(likes=comment_likes.count(comment_id), dislikes=comment_dislikes.count(comment_id),
+                   like=add and interaction is comment_likes, dislike=add and interaction is comment_dislikes)
+
+
+@main.route('/like_comment')
+@login_required
+def like_comment():
+    return _comment_vote(comment_likes, comment_dislikes, True)
+
+
+@main.route('/undo_like_comment')
+@login_required
+def undo_like_comment():
+    return _comment_vote(comment_likes, comment_dislikes, False)
+
+
+@main.route('/dislike_comment')
+@login_required
+def dislike_comment():
+    return _comment_vote(comment_dislikes, comment_likes, True)
+
+
+@main.route('/undo_dislike_comment')
+@login_required
+def undo_dislike_comment():
+    return _comment_vote(comment_dislikes, comment_likes, False)
+
+
+def _id_list(name):
+    # 逗号分隔的 id 列表, 忽略无法解析的部分
+    ids = [int(id) for id in request.args.get(name, '').split(',') if id.strip().isdigit()]
+    return ids[:MAX_STATE_IDS]
+
+
+@main.route('/session')
+def session_state():
+    # 静态页面里不带和 session 相关的内容, 由页面通过这个接口取回 CSRF token 和登录状态
+    user = current_user.username if current_user.is_authenticated else None
+    response = jsonify(user=user, dexter=current_user.is_dexter(), csrf_token=generate_csrf())
+    response.headers['Cache-Control'] = 'private, no-store'
+    return response
+
+
+@main.route('/post/<int:id>/view', methods=['POST'])
+def post_view(id):
+    # nginx 直接返回的静态文章页不经过 main.post, 由页面在加载后调用这个接口计数, 顺便取回最新的浏览数
+    _post_exists(id)
+    if pageviews.enabled:
+        pageviews.record(id)
+    stats = pageviews.stats([id])[id]
+    response = jsonify(views=stats.views + pageviews.pending(id), visitors=stats.visitors)
+    response.headers['Cache-Control'] = 'private, no-store'
+    return response
+
+
+@main.route('/interactions')
+@replica_reads
+def interactions():
+    # 当前用户对一组文章和评论的点赞/踩状态: /interactions?posts=1,2&comments=3,4
+    user_id = current_user.id if current_user.is_authenticated else None
+    state = interaction_state(user_id, _id_list('posts'), _id_list('comments'))
+    return jsonify(posts=dict((k, sorted(v)) for k, v in state['posts'].items()),
+                   comments=dict((k, sorted(v)) for k, v in state['comments'].items()))
+
+
+@main.route('/admin/perf')
+@login_required
+@dexter_required
+def perf():
+    # 当前 worker 里各 endpoint 最近的请求耗时分布
+    return jsonify(instrument.stats())
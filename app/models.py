@@ -1,5 +1,6 @@
 # coding=utf-8
 from datetime import datetime
+from sqlalchemy.dialects import mysql
 from werkzeug.security import generate_password_hash, check_password_hash
 from flask_login import UserMixin, AnonymousUserMixin
 
@@ -42,14 +43,10 @@ class AnonymousUser(AnonymousUserMixin):
         return False
 
 
+# user_loader 见 users.py, 已登录用户是缓存的 SessionUser
 login_manager.anonymous_user = AnonymousUser
 
 
-@login_manager.user_loader
-def load_user(user_id):
-    return User.query.get(int(user_id))
-
-
 class Category(db.Model):
     __tablename__ = 'categories'
     id = db.Column(db.Integer, primary_key=True)
@@ -58,14 +55,17 @@ class Category(db.Model):
     posts = db.relationship('Post', backref='category', lazy='dynamic')
 
 
-# Post 和 Label 的关联表
+# Post 和 Label 的关联表, (label_id, post_id) 用来取一个 Label 下的文章
 registrations = db.Table('registrations',
-                         db.Column('post_id', db.Integer, db.ForeignKey('posts.id')),
-                         db.Column('label_id', db.Integer, db.ForeignKey('labels.id')))
+                         db.Column('post_id', db.Integer, db.ForeignKey('posts.id'), primary_key=True),
+                         db.Column('label_id', db.Integer, db.ForeignKey('labels.id'), primary_key=True),
+                         db.Index('ix_registrations_label_post', 'label_id', 'post_id'))
 
 
 class Post(db.Model):
     __tablename__ = 'posts'
+    # 分类页按 (timestamp, id) 倒序分页
+    __table_args__ = (db.Index('ix_posts_category_timestamp', 'category_id', 'timestamp', 'id'),)
     id = db.Column(db.Integer, primary_key=True)
     title = db.Column(db.String(128))
     body = db.Column(db.Text)
@@ -73,6 +73,8 @@ class Post(db.Model):
     summery = db.Column(db.Text)
     summery_html = db.Column(db.Text)
     timestamp = db.Column(db.DateTime, index=True, default=datetime.utcnow)
+    # 最后修改时间: 编辑、评论、点赞数写回、后台渲染完成时更新, 用于 Last-Modified / ETag
+    timestamp_update = db.Column(db.DateTime, index=True, default=datetime.utcnow)
     category_id = db.Column(db.Integer, db.ForeignKey('categories.id'))
     comments = db.relationship('Comment', backref='post', lazy='dynamic')
     likes = db.relationship('LikePost', backref='post', lazy='dynamic')
@@ -80,16 +82,15 @@ class Post(db.Model):
     like_num = db.Column(db.Integer, default=0)
     labels = db.relationship('Label',
                              secondary=registrations,
-                             backref=db.backref('posts', lazy='dynamic'),
-                             lazy='dynamic')
+                             backref=db.backref('posts', lazy='dynamic'))
 
     @staticmethod
     def on_changed_body(target, value, oldvalue, initiator):
-        target.body_html = markdown(value)
+        markdown.set_html(target, 'body', value)
 
     @staticmethod
     def on_changed_summery(target, value, oldvalue, initiator):
-        target.summery_html = markdown(value)
+        markdown.set_html(target, 'summery', value)
 
 db.event.listen(Post.body, 'set', Post.on_changed_body)
 db.event.listen(Post.summery, 'set', Post.on_changed_summery)
@@ -115,6 +116,8 @@ class Label(db.Model):
 
 class Comment(db.Model):
     __tablename__ = 'comments'
+    # 文章页的评论按 (timestamp, id) 倒序分页
+    __table_args__ = (db.Index('ix_comments_post_timestamp', 'post_id', 'timestamp', 'id'),)
     id = db.Column(db.Integer, primary_key=True)
     comment = db.Column(db.Text)
     comment_html = db.Column(db.Text)
@@ -129,12 +132,15 @@ class Comment(db.Model):
 
     @staticmethod
     def on_changed_comment(target, value, oldvalue, initiator):
-        target.comment_html = markdown(value)
+        markdown.set_html(target, 'comment', value)
 db.event.listen(Comment.comment, 'set', Comment.on_changed_comment)
 
 
 class LikePost(db.Model):
     __tablename__ = "like_post"
+    # (user_id, post_id) 用来一次查出一个用户对一页文章的点赞状态
+    __table_args__ = (db.UniqueConstraint('post_id', 'user_id', name='uq_like_post_post_user'),
+                      db.Index('ix_like_post_user_post', 'user_id', 'post_id'))
     id = db.Column(db.Integer, primary_key=True)
     post_id = db.Column(db.Integer, db.ForeignKey('posts.id'))
     user_id = db.Column(db.Integer, db.ForeignKey('users.id'))
@@ -142,6 +148,8 @@ class LikePost(db.Model):
 
 class LikeComment(db.Model):
     __tablename__ = "like_comment"
+    __table_args__ = (db.UniqueConstraint('comment_id', 'user_id', name='uq_like_comment_comment_user'),
+                      db.Index('ix_like_comment_user_comment', 'user_id', 'comment_id'))
     id = db.Column(db.Integer, primary_key=True)
     post_id = db.Column(db.Integer, db.ForeignKey('posts.id'))
     user_id = db.Column(db.Integer, db.ForeignKey('users.id'))
@@ -150,7 +158,70 @@ class LikeComment(db.Model):
 
 class DislikeComment(db.Model):
     __tablename__ = "dislike_comment"
+    __table_args__ = (db.UniqueConstraint('comment_id', 'user_id', name='uq_dislike_comment_comment_user'),
+                      db.Index('ix_dislike_comment_user_comment', 'user_id', 'comment_id'))
     id = db.Column(db.Integer, primary_key=True)
     post_id = db.Column(db.Integer, db.ForeignKey('posts.id'))
     user_id = db.Column(db.Integer, db.ForeignKey('users.id'))
     comment_id = db.Column(db.Integer, db.ForeignKey('comments.id'))
+
+
+# 全文搜索的倒排索引, 见 search.py
+class SearchTerm(db.Model):
+    __tablename__ = 'search_terms'
+    term = db.Column(db.String(64), primary_key=True)
+    post_id = db.Column(db.Integer, db.ForeignKey('posts.id'), primary_key=True, index=True)
+    # 按字段权重加权后的词频
+    tf = db.Column(db.Float)
+
+
+class SearchDoc(db.Model):
+    __tablename__ = 'search_docs'
+    post_id = db.Column(db.Integer, db.ForeignKey('posts.id'), primary_key=True)
+    length = db.Column(db.Float)
+
+
+# 全站内容的版本号, 文章或 Category 增删改时 +1, 只有 id = 1 一行
+class SiteVersion(db.Model):
+    __tablename__ = 'site_version'
+    id = db.Column(db.Integer, primary_key=True)
+    version = db.Column(db.Integer, default=0)
+    timestamp = db.Column(db.DateTime, default=datetime.utcnow)
+
+
+# 每篇文章最相似的几篇, 按 rank 排序, 见 related.py
+class RelatedPost(db.Model):
+    __tablename__ = 'related_posts'
+    post_id = db.Column(db.Integer, db.ForeignKey('posts.id'), primary_key=True)
+    rank = db.Column(db.SmallInteger, primary_key=True, autoincrement=False)
+    related_id = db.Column(db.Integer, db.ForeignKey('posts.id'), index=True)
+    score = db.Column(db.Float)
+
+
+# 文章的浏览数和独立访客数, 由 pageviews.py 批量写回
+class PostStats(db.Model):
+    __tablename__ = 'post_stats'
+    post_id = db.Column(db.Integer, db.ForeignKey('posts.id'), primary_key=True)
+    views = db.Column(db.BigInteger, default=0)
+    # sketch 是独立访客的 HyperLogLog(见 hll.py), visitors 是写回时按它估计的人数
+    visitors = db.Column(db.Integer, default=0)
+    sketch = db.Column(db.LargeBinary)
+    updated = db.Column(db.DateTime)
+
+
+# Atom 和 sitemap, 见 feeds.py
+class FeedEntry(db.Model):
+    __tablename__ = 'feed_entries'
+    post_id = db.Column(db.Integer, db.ForeignKey('posts.id'), primary_key=True)
+    # 这篇文章在 Atom 里的 <entry> 和在 sitemap 里的 <url>
+    atom = db.Column(db.Text)
+    sitemap = db.Column(db.Text)
+
+
+class FeedDocument(db.Model):
+    __tablename__ = 'feed_documents'
+    name = db.Column(db.String(64), primary_key=True)
+    # 拼好的完整文档(utf-8), sitemap 可能有几 MB
+    body = db.Column(db.LargeBinary().with_variant(mysql.LONGBLOB(), 'mysql'))
+    etag = db.Column(db.String(40))
+    updated = db.Column(db.DateTime)
@@ -0,0 +1,169 @@
+# coding=utf-8
+import atexit
+import threading
+from collections import defaultdict, namedtuple
+from datetime import datetime
+from flask import g, request
+from flask_login import current_user
+from sqlalchemy import select, bindparam
+from .hll import HyperLogLog, hash64
+
+ViewStats = namedtuple('ViewStats', 'views visitors')
+
+_no_views = ViewStats(0, 0)
+
+
+class PageViews(object):
+    """文章的浏览数和独立访客数
+
+    main.post 的每次浏览只在进程内累加: 浏览数 +1, 访客加进这篇文章的 HyperLogLog;
+    每 VIEW_FLUSH_INTERVAL 秒或攒够 VIEW_FLUSH_SIZE 次浏览时在后台线程里合并写回 post_stats,
+    一个事务里每批文章一条 SELECT ... FOR UPDATE、一条批量 UPDATE 和一条批量 INSERT.
+    worker 正常退出时写回剩下的部分, 被强制杀掉时最多丢失一个写回周期的浏览
+    """
+
+    CHUNK = 500
+
+    def __init__(self, db, page_cache, app=None):
+        self.db = db
+        self.page_cache = page_cache
+        self.app = None
+        self.enabled = False
+        self.interval = 10
+        self.threshold = 1000
+        self.cache_ttl = 60
+        self._views = defaultdict(int)
+        self._sketches = {}
+        self._hits = 0
+        self._timer = None
+        self._urgent = False
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        self.enabled = app.config.get('VIEW_COUNTING', True)
+        self.interval = app.config.get('VIEW_FLUSH_INTERVAL', 10)
+        self.threshold = app.config.get('VIEW_FLUSH_SIZE', 1000)
+        self.cache_ttl = app.config.get('VIEW_CACHE_TTL', 60)
+        app.after_request(self._count_view)
+        atexit.register(self.flush)
+
+    def _count_view(self, response):
+        # 在 after_request 里计数, 页面缓存命中和 304 也算一次浏览; 评论翻页和静态导出不算
+        if self.enabled and request.endpoint == 'main.post' and request.method == 'GET' \
+                and response.status_code in (200, 304) and not g.get('static_export') \
+                and 'page' not in request.args and 'cursor' not in request.args:
+            self.record(request.view_args['id'])
+        return response
+
+    @staticmethod
+    def visitor():
+        # 登录用户按 id, 匿名访客按 IP + User-Agent
+        if current_user.is_authenticated:
+            return 'u:%s' % current_user.get_id()
+        address = request.access_route[0] if request.access_route else request.remote_addr
+        return 'a:%s:%s' % (address, request.headers.get('User-Agent', ''))
+
+    def record(self, post_id, visitor=None):
+        value = hash64(visitor or self.visitor())
+        with self._lock:
+            self._views[post_id] += 1
+            sketch = self._sketches.get(post_id)
+            if sketch is None:
+                sketch = self._sketches[post_id] = HyperLogLog()
+            sketch.add_hash(value)
+            self._hits += 1
+            # 写回放在后台线程, 不占用请求的时间
+            if self._hits >= self.threshold and not self._urgent:
+                if self._timer is not None:
+                    self._timer.cancel()
+                self._urgent = True
+                self._schedule(0)
+            elif self._timer is None:
+                self._schedule(self.interval)
+
+    def _schedule(self, delay):
+        self._timer = threading.Timer(delay, self.flush)
+        self._timer.daemon = True
+        self._timer.start()
+
+    def pending(self, post_id):
+        with self._lock:
+            return self._views.get(post_id, 0)
+
+    def flush(self):
+        with self._lock:
+            views, self._views = self._views, defaultdict(int)
+            sketches, self._sketches = self._sketches, {}
+            self._hits = 0
+            self._urgent = False
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+        if not views or self.app is None:
+            return
+        try:
+            with self.app.app_context():
+                with self.db.engine.begin() as conn:
+                    ids = sorted(views)
+                    for start in range(0, len(ids), self.CHUNK):
+                        self._write(conn, ids[start:start + self.CHUNK], views, sketches)
+        except Exception:
+            # 写回失败时把这一批放回去, 下次再写; 比如两个 worker 同时插入同一篇文章的第一行
+            with self._lock:
+                for post_id, count in views.items():
+                    self._views[post_id] += count
+                    if post_id in self._sketches:
+                        self._sketches[post_id].merge(sketches[post_id])
+                    else:
+                        self._sketches[post_id] = sketches[post_id]
+                if self._timer is None:
+                    self._schedule(self.interval)
+            raise
+
+    def _write(self, conn, ids, views, sketches):
+        table = self.db.metadata.tables['post_stats']
+        now = datetime.utcnow()
+        # 按 post_id 顺序锁住已有的行, 别的 worker 写回同一篇文章时等这边提交, 访客 sketch 不会互相覆盖
+        stored = dict(conn.execute(select([table.c.post_id, table.c.sketch])
+                                   .where(table.c.post_id.in_(ids))
+                                   .order_by(table.c.post_id).with_for_update()).fetchall())
+        updates, inserts = [], []
+        for post_id in ids:
+            if post_id in stored:
+                sketch = HyperLogLog.from_bytes(stored[post_id]).merge(sketches[post_id])
+                updates.append({'_id': post_id, '_views': views[post_id], '_visitors': sketch.count(),
+                                '_sketch': sketch.to_bytes()})
+            else:
+                sketch = sketches[post_id]
+                inserts.append({'post_id': post_id, 'views': views[post_id], 'visitors': sketch.count(),
+                                'sketch': sketch.to_bytes(), 'updated': now})
+        if updates:
+            conn.execute(table.update().where(table.c.post_id == bindparam('_id'))
+                         .values(views=table.c.views + bindparam('_views'), visitors=bindparam('_visitors'),
+                                 sketch=bindparam('_sketch'), updated=now), updates)
+        if inserts:
+            # 计数期间被删掉的文章不再插入
+            posts = self.db.metadata.tables['posts']
+            existing = set(row[0] for row in conn.execute(select([posts.c.id])
+                                                          .where(posts.c.id.in_([r['post_id'] for r in inserts]))))
+            inserts = [row for row in inserts if row['post_id'] in existing]
+            if inserts:
+                conn.execute(table.insert(), inserts)
+
+    def stats(self, post_ids):
+        """{post_id: ViewStats}, 一条按主键的查询; 还没有记录的文章是 (0, 0)
+
+        显示浏览数的页面在页面缓存里最多保留 VIEW_CACHE_TTL 秒, 浏览不会让页面缓存失效
+        """
+        ids = sorted(set(post_ids))
+        if not ids:
+            return {}
+        self.page_cache.max_age(self.cache_ttl)
+        table = self.db.metadata.tables['post_stats']
+        rows = self.db.session.execute(select([table.c.post_id, table.c.views, table.c.visitors])
+                                       .where(table.c.post_id.in_(ids)))
+        found = dict((row[0], ViewStats(row[1] or 0, row[2] or 0)) for row in rows)
+        return dict((post_id, found.get(post_id, _no_views)) for post_id in ids)
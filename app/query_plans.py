@@ -0,0 +1,143 @@
+# coding=utf-8
+import re
+from sqlalchemy import event
+from . import db, page_cache, login_manager
+from .loaders import encode_cursor
+from .models import Post, Category, Label, User
+
+# manage.py explain: 用测试客户端请求访问量大的页面, 记下它们发出的 SELECT,
+# 再对每条语句做 EXPLAIN, 出现全表扫描或者额外排序(filesort / temp b-tree)时报告出来
+# 按索引顺序读整个索引只在没有 WHERE 的语句里允许(首页按时间取前几篇、COUNT), 有条件时应该是范围查找
+#
+# 侧边栏本来就读整张 categories / labels 表, site_version 只有一行,
+# search_docs 的总数和平均长度按版本号缓存, 这几张表的全表扫描不算
+
+WHOLE_TABLES = ('categories', 'labels', 'site_version', 'search_docs')
+
+_select_re = re.compile(r'\s*SELECT\b.*\bFROM\b', re.IGNORECASE | re.DOTALL)
+_where_re = re.compile(r'\bWHERE\b', re.IGNORECASE)
+_sqlite_scan_re = re.compile(r'^SCAN (?:TABLE )?(\w+)')
+
+
+def hot_urls():
+    """要检查的页面, 用数据库里现有的文章、分类和 Label 填上参数"""
+    urls = ['/', '/?page=2', '/feed.atom', '/sitemap.xml', '/sitemap-pages.xml']
+    post = Post.query.order_by(Post.timestamp.desc(), Post.id.desc()).first()
+    if post is not None:
+        urls += ['/?cursor=%s' % encode_cursor('n', post.timestamp, post.id, 2),
+                 '/?cursor=%s' % encode_cursor('p', post.timestamp, post.id, 1),
+                 '/post/%d' % post.id, '/post/%d?page=2' % post.id,
+                 '/interactions?posts=%d' % post.id]
+        comment = post.comments.order_by(None).first()
+        if comment is not None:
+            urls.append('/interactions?posts=%d&comments=%d' % (post.id, comment.id))
+    category = Category.query.order_by(Category.count.desc()).first()
+    if category is not None:
+        urls += ['/category/%s' % category.tag, '/category/%s?page=2' % category.tag,
+                 '/category/%s/feed.atom' % category.tag]
+    label = Label.query.order_by(Label.count.desc()).first()
+    if label is not None:
+        urls += ['/label/%s/feed.atom' % label.label, '/search?q=%s' % label.label]
+    return urls
+
+
+def _login(client, user_id):
+    # 和 flask_login.login_user 写进 session 的内容一样, 检查期间关掉了 session_protection, 不需要 _id
+    with client.session_transaction() as session:
+        session['user_id'] = str(user_id)
+        session['_fresh'] = True
+
+
+def capture(app, urls, user_id=None):
+    """依次请求 urls, 给出 user_id 时以这个用户登录; 返回 [(url, engine, 语句, 参数)], 同样的语句只留第一次"""
+    engines = [db.get_engine(app)] + [db.get_engine(app, bind=bind) for bind in app.config.get('SQLALCHEMY_BINDS') or ()]
+    seen = set()
+    statements = []
+    current = [None]
+
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        # 连接池 ping 的 SELECT 1 没有 FROM
+        if executemany or not _select_re.match(statement):
+            return
+        if statement not in seen:
+            seen.add(statement)
+            statements.append((current[0], conn.engine, statement, parameters))
+
+    for engine in engines:
+        event.listen(engine, 'before_cursor_execute', before_cursor_execute)
+    # 页面缓存命中时不会查询
+    enabled, page_cache.enabled = page_cache.enabled, False
+    protection, login_manager.session_protection = login_manager.session_protection, None
+    try:
+        client = app.test_client()
+        if user_id is not None:
+            _login(client, user_id)
+        for url in urls:
+            current[0] = url
+            client.get(url)
+    finally:
+        page_cache.enabled = enabled
+        login_manager.session_protection = protection
+        for engine in engines:
+            event.remove(engine, 'before_cursor_execute', before_cursor_execute)
+    return statements
+
+
+def _explain_sqlite(cursor, statement, parameters):
+    cursor.execute('EXPLAIN QUERY PLAN ' + statement, parameters)
+    problems = []
+    for row in cursor.fetchall():
+        detail = row[-1]
+        match = _sqlite_scan_re.match(detail)
+        if match and match.group(1) in db.metadata.tables and match.group(1) not in WHOLE_TABLES \
+                and ('INDEX' not in detail or _where_re.search(statement)):
+            problems.append(detail)
+        elif detail.startswith('USE TEMP B-TREE FOR') and 'ORDER BY' in detail:
+            problems.append(detail)
+    return problems
+
+
+def _explain_mysql(cursor, statement, parameters):
+    cursor.execute('EXPLAIN ' + statement, parameters)
+    names = [column[0].lower() for column in cursor.description]
+    problems = []
+    for row in cursor.fetchall():
+        row = dict(zip(names, row))
+        table, extra = row.get('table') or '', row.get('extra') or ''
+        if table in db.metadata.tables and table not in WHOLE_TABLES:
+            if row.get('type') == 'ALL':
+                problems.append('full scan of %s' % table)
+            elif row.get('type') == 'index' and _where_re.search(statement):
+                problems.append('full index scan of %s' % table)
+        if 'Using filesort' in extra:
+            problems.append('filesort on %s' % table)
+    return problems
+
+
+def check(app, urls=None):
+    """匿名和登录(取一个普通用户)各请求一遍, 返回 [(url, 语句, [问题])], 只包含有问题的语句"""
+    explainers = {'sqlite': _explain_sqlite, 'mysql': _explain_mysql}
+    urls = urls or hot_urls()
+    statements = capture(app, urls)
+    user_id = db.session.query(User.id).order_by(User.id.desc()).limit(1).scalar()
+    if user_id is not None:
+        statements += capture(app, urls, user_id)
+    results = []
+    seen = set()
+    for url, engine, statement, parameters in statements:
+        if statement in seen:
+            continue
+        seen.add(statement)
+        explain = explainers.get(engine.dialect.name)
+        if explain is None:
+            raise ValueError('EXPLAIN is not supported for %s' % engine.dialect.name)
+        connection = engine.raw_connection()
+        try:
+            cursor = connection.cursor()
+            problems = explain(cursor, statement, parameters)
+            cursor.close()
+        finally:
+            connection.close()
+        if problems:
+            results.append((url, statement, problems))
+    return results
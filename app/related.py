@@ -0,0 +1,195 @@
+# coding=utf-8
+import math
+from collections import namedtuple
+from flask import current_app
+from . import db, page_cache, deferred, static_site
+from .models import Post, Label, RelatedPost, registrations
+
+# 相关文章: 每篇文章预先算好最相似的几篇存在 related_posts 里, 文章页一条查询取出
+# 相似度是 Label(按 IDF 加权)和 Category 组成的向量的余弦相似度, 至少有一个相同的 Label 才算相关
+# 文章的 Label 变化时只重新计算它自己和与它有相同 Label 的文章, 在写操作提交之后由后台线程完成(见 deferred.py);
+# 其他文章的 IDF 随之的细微变化不做处理, 由 manage.py related 全量重建时修正
+
+CATEGORY_WEIGHT = 0.5
+
+RelatedItem = namedtuple('RelatedItem', 'id title')
+
+
+def _size():
+    return current_app.config.get('RELATED_POSTS', 5)
+
+
+def _idf(count, total):
+    return math.log((1.0 + total) / (1.0 + count)) + 1.0
+
+
+def _norm(feature, idf):
+    category_id, label_ids = feature
+    return math.sqrt(sum(idf[l] ** 2 for l in label_ids) + (CATEGORY_WEIGHT ** 2 if category_id is not None else 0))
+
+
+def _score(a, b, idf, norms):
+    shared = a[1] & b[1]
+    if not shared:
+        return 0.0
+    dot = sum(idf[l] ** 2 for l in shared)
+    if a[0] is not None and a[0] == b[0]:
+        dot += CATEGORY_WEIGHT ** 2
+    return dot / (norms[a] * norms[b])
+
+
+def _top(scores, size):
+    # 得分保留 6 位小数, 相同时新文章在前, 和 rebuild 的排序一致
+    return sorted(((id, round(score, 6)) for id, score in scores if score > 0), key=lambda x: (-x[1], -x[0]))[:size]
+
+
+def _features(label_ids):
+    """和 label_ids 里任一 Label 有关联的文章: {post_id: (category_id, frozenset(label_ids))}"""
+    if not label_ids:
+        return {}
+    r1 = registrations.alias('r1')
+    r2 = registrations.alias('r2')
+    rows = db.session.query(r2.c.post_id, Post.category_id, r2.c.label_id) \
+        .select_from(r1).join(r2, r2.c.post_id == r1.c.post_id).join(Post, Post.id == r2.c.post_id) \
+        .filter(r1.c.label_id.in_(sorted(label_ids))).distinct()
+    found = {}
+    for post_id, category_id, label_id in rows:
+        found.setdefault(post_id, (category_id, set()))[1].add(label_id)
+    return dict((post_id, (category_id, frozenset(labels))) for post_id, (category_id, labels) in found.items())
+
+
+def _lists(condition):
+    lists = {}
+    for post_id, related_id, score in db.session.query(RelatedPost.post_id, RelatedPost.related_id, RelatedPost.score) \
+            .filter(condition).order_by(RelatedPost.post_id, RelatedPost.rank):
+        lists.setdefault(post_id, []).append((related_id, score))
+    return lists
+
+
+def _write(lists, chunk=500):
+    post_ids = sorted(lists)
+    for i in range(0, len(post_ids), chunk):
+        RelatedPost.query.filter(RelatedPost.post_id.in_(post_ids[i:i + chunk])).delete(synchronize_session=False)
+    rows = [{'post_id': post_id, 'rank': rank, 'related_id': related_id, 'score': score}
+            for post_id in post_ids for rank, (related_id, score) in enumerate(lists[post_id])]
+    for i in range(0, len(rows), chunk * 10):
+        db.session.execute(RelatedPost.__table__.insert(), rows[i:i + chunk * 10])
+
+
+def update_post(post_id, category_id, label_ids, old_label_ids=()):
+    """文章新增或 Label 变化之后调用, 在调用者的事务里执行, 由调用者提交; 返回需要失效的页面 tag"""
+    db.session.flush()
+    size = _size()
+    features = _features(set(label_ids) | set(old_label_ids))
+    features.pop(post_id, None)
+    me = (category_id, frozenset(label_ids))
+    all_labels = set(me[1])
+    for feature in features.values():
+        all_labels |= feature[1]
+    total = db.session.query(db.func.count(Post.id)).scalar()
+    idf = dict((id, _idf(count or 0, total)) for id, count in
+               db.session.query(Label.id, Label.count).filter(Label.id.in_(sorted(all_labels)))) if all_labels else {}
+    norms = dict((feature, _norm(feature, idf)) for feature in set(features.values()) | {me})
+    scores = dict((id, _score(me, feature, idf, norms)) for id, feature in features.items())
+    changed = {post_id: _top(scores.items(), size)}
+    # 其他文章的列表里去掉这篇文章, 再按新的得分决定要不要放回去
+    sharing = db.session.query(registrations.c.post_id) \
+        .filter(registrations.c.label_id.in_(sorted(set(label_ids) | set(old_label_ids)) or [0]))
+    old_lists = _lists(db.or_(RelatedPost.post_id.in_(sharing), RelatedPost.related_id == post_id))
+    for id in set(features) | set(old_lists):
+        if id == post_id:
+            continue
+        old = old_lists.get(id, [])
+        new = _top([(r, s) for r, s in old if r != post_id] + [(post_id, scores.get(id, 0.0))], size)
+        if new != old:
+            changed[id] = new
+    _write(changed)
+    return ['post:%d' % id for id in changed if id != post_id]
+
+
+def refresh_posts(post_ids, old_label_ids):
+    """写操作提交之后在后台线程里执行: 按现在的 Category 和 Label 重新计算这些文章, 提交之后失效页面缓存"""
+    # 几篇文章合并成一次任务时 old_label_ids 是它们的并集, 多算几篇没有共同 Label 的文章, 结果不变
+    rows = db.session.query(Post.id, Post.category_id).filter(Post.id.in_(sorted(post_ids))).all()
+    labels = {}
+    for post_id, label_id in db.session.query(registrations.c.post_id, registrations.c.label_id) \
+            .filter(registrations.c.post_id.in_(sorted(post_ids))):
+        labels.setdefault(post_id, set()).add(label_id)
+    tags = []
+    for post_id, category_id in rows:
+        tags += ['post:%d' % post_id] + update_post(post_id, category_id, labels.get(post_id, ()), old_label_ids)
+    db.session.commit()
+    page_cache.invalidate(*tags)
+    static_site.refresh([int(tag[len('post:'):]) for tag in set(tags)])
+
+
+def schedule_post(post_id, old_label_ids=()):
+    """文章新增或 Label 变化时在写操作的事务里调用, 提交之后重新计算"""
+    deferred.after_commit(refresh_posts, [post_id], old_label_ids)
+
+
+def remove_post(post_id):
+    """文章删除时调用, 文章那一行删掉之前调用; 返回需要失效的页面 tag"""
+    lists = _lists(RelatedPost.post_id.in_(db.session.query(RelatedPost.post_id)
+                                           .filter(RelatedPost.related_id == post_id)))
+    changed = dict((id, [(r, s) for r, s in entries if r != post_id]) for id, entries in lists.items())
+    changed[post_id] = []
+    _write(changed)
+    return ['post:%d' % id for id in changed if id != post_id]
+
+
+def related_posts(post_id):
+    """文章页用的相关文章, 一条走主键索引的查询"""
+    return [RelatedItem(*row) for row in db.session.query(Post.id, Post.title)
+            .join(RelatedPost, RelatedPost.related_id == Post.id)
+            .filter(RelatedPost.post_id == post_id).order_by(RelatedPost.rank)]
+
+
+def rebuild(batch_size=512):
+    """用 numpy 按块计算所有文章两两之间的相似度, 重写整张表; 返回处理的文章数
+
+    Label 矩阵是稠密的, 占用 文章数 x Label 数 x 8 字节内存
+    """
+    import numpy
+    size = _size()
+    post_ids = numpy.array([id for id, in db.session.query(Post.id).order_by(Post.id)], dtype=numpy.int64)
+    n = len(post_ids)
+    RelatedPost.query.delete(synchronize_session=False)
+    if n:
+        position = dict((id, i) for i, id in enumerate(post_ids.tolist()))
+        links = db.session.query(registrations.c.post_id, registrations.c.label_id).all()
+        label_index = dict((id, i) for i, id in enumerate(sorted(set(label_id for post_id, label_id in links))))
+        matrix = numpy.zeros((n, max(len(label_index), 1)))
+        if links:
+            matrix[[position[p] for p, l in links], [label_index[l] for p, l in links]] = 1.0
+        # 和 _idf 一样, 用的是关联表里的文章数, 也就是 Label.count
+        matrix *= numpy.log((1.0 + n) / (1.0 + matrix.sum(axis=0))) + 1.0
+        categories = numpy.full(n, -1, dtype=numpy.int64)
+        for id, category_id in db.session.query(Post.id, Post.category_id).filter(Post.category_id.isnot(None)):
+            categories[position[id]] = category_id
+        has_category = categories >= 0
+        norms = numpy.sqrt((matrix ** 2).sum(axis=1) + has_category * CATEGORY_WEIGHT ** 2)
+        norms[norms == 0] = 1.0
+        k = min(size, n - 1)
+        for start in range(0, n if k > 0 else 0, batch_size):
+            end = min(start + batch_size, n)
+            dot = matrix[start:end].dot(matrix.T)
+            shared = dot > 0
+            same = (categories[start:end, None] == categories[None, :]) & has_category[None, :]
+            scores = (dot + same * CATEGORY_WEIGHT ** 2) / (norms[start:end, None] * norms[None, :])
+            scores[~shared] = 0
+            scores[numpy.arange(end - start), numpy.arange(start, end)] = 0
+            # 和 _top 一样按 (6 位小数的得分, id) 排序, 得分相同时取 id 大的
+            keys = numpy.round(scores * 1e6).astype(numpy.int64) * n + numpy.arange(n)
+            top = numpy.argpartition(-keys, k - 1, axis=1)[:, :k]
+            rows = []
+            for i in range(end - start):
+                candidates = [(int(post_ids[j]), float(scores[i, j])) for j in top[i] if scores[i, j] > 0]
+                rows.extend({'post_id': int(post_ids[start + i]), 'rank': rank, 'related_id': id, 'score': score}
+                            for rank, (id, score) in enumerate(_top(candidates, size)))
+            if rows:
+                db.session.execute(RelatedPost.__table__.insert(), rows)
+    db.session.commit()
+    # 每个缓存页面都带有 sidebar tag, 借它让所有页面缓存失效
+    page_cache.invalidate('sidebar')
+    return n
@@ -0,0 +1,231 @@
+# coding=utf-8
+import hashlib
+from datetime import datetime
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+import mistune
+from .instrument import add_timing
+
+# 修改 Markdown 渲染方式(扩展、高亮等)时加 1, 缓存随之失效, 再用 manage.py rerender 重新渲染已有内容
+RENDERER_VERSION = 2
+
+# 代码块高亮用的 Pygments 样式, 对应的样式表由 manage.py assets --fetch 生成
+HIGHLIGHT_STYLE = 'default'
+HIGHLIGHT_CLASS = 'highlight'
+HIGHLIGHT_CACHE_SIZE = 256
+
+_local = threading.local()
+
+_highlighted = OrderedDict()
+_lexers = {}
+_highlight_lock = threading.Lock()
+
+
+def _lexer(lang):
+    # 不认识的语言也记下来, 返回 None; 语言名来自评论, 记录的个数有上限
+    if lang in _lexers:
+        return _lexers[lang]
+    from pygments.lexers import get_lexer_by_name
+    from pygments.util import ClassNotFound
+    try:
+        lexer = get_lexer_by_name(lang, stripnl=False, ensurenl=False)
+    except ClassNotFound:
+        lexer = None
+    if len(_lexers) < HIGHLIGHT_CACHE_SIZE:
+        _lexers[lang] = lexer
+    return lexer
+
+
+def highlight_code(code, lang):
+    """用 Pygments 把代码块渲染成带 span 的 HTML, 按 代码哈希 + 语言 缓存; 没装 Pygments 或者语言不认识时返回 None"""
+    key = hashlib.sha1(lang.encode('utf-8') + b'\0' + code.encode('utf-8')).hexdigest()
+    with _highlight_lock:
+        html = _highlighted.get(key)
+        if html is not None:
+            _highlighted.move_to_end(key)
+            return html
+    try:
+        from pygments import highlight
+        from pygments.formatters import HtmlFormatter
+    except ImportError:
+        return None
+    lexer = _lexer(lang.lower())
+    if lexer is None:
+        return None
+    html = highlight(code, lexer, HtmlFormatter(cssclass='%s lang-%s' % (HIGHLIGHT_CLASS, mistune.escape(lang, quote=True))))
+    with _highlight_lock:
+        _highlighted[key] = html
+        while len(_highlighted) > HIGHLIGHT_CACHE_SIZE:
+            _highlighted.popitem(last=False)
+    return html
+
+
+def highlight_css():
+    """代码块的样式表, 选择器都以 .highlight 开头"""
+    from pygments.formatters import HtmlFormatter
+    return HtmlFormatter(style=HIGHLIGHT_STYLE).get_style_defs('.' + HIGHLIGHT_CLASS)
+
+
+class HighlightRenderer(mistune.Renderer):
+    """代码块在渲染时就高亮好, 存进 *_html 里, 页面上不再需要 highlight.js"""
+
+    def block_code(self, code, lang=None):
+        html = highlight_code(code.rstrip('\n'), lang) if lang else None
+        if html is None:
+            return mistune.Renderer.block_code(self, code, lang)
+        return html
+
+
+def create_markdown():
+    return mistune.Markdown(renderer=HighlightRenderer())
+
+
+def render_text(text):
+    # mistune.Markdown 的实例在解析过程中会保存状态, 每个线程/进程各用一个
+    md = getattr(_local, 'markdown', None)
+    if md is None:
+        md = _local.markdown = create_markdown()
+    return md(text)
+
+
+def content_key(text):
+    return hashlib.sha1(('%d:' % RENDERER_VERSION).encode('ascii') + text.encode('utf-8')).hexdigest()
+
+
+class MarkdownRenderer(object):
+    """带缓存的 Markdown 渲染
+
+    结果按 内容哈希 + 渲染器版本 缓存; 超过 MARKDOWN_ASYNC_THRESHOLD 个字符的新内容
+    在事务提交之后交给后台线程渲染, 渲染完成前 *_html 为空, 模板显示原文
+    """
+
+    def __init__(self, db, page_cache, app=None):
+        self.db = db
+        self.page_cache = page_cache
+        self.app = None
+        self.max_size = 512
+        self.threshold = 0
+        self._executor = None
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        self.max_size = app.config.get('MARKDOWN_CACHE_SIZE', 512)
+        self.threshold = app.config.get('MARKDOWN_ASYNC_THRESHOLD', 0)
+        if self.threshold and self._executor is None:
+            self._executor = ThreadPoolExecutor(app.config.get('MARKDOWN_WORKERS', 2))
+        if not event.contains(Session, 'after_flush', self._after_flush):
+            event.listen(Session, 'after_flush', self._after_flush)
+            event.listen(Session, 'after_commit', self._after_commit)
+            event.listen(Session, 'after_soft_rollback', self._after_rollback)
+
+    def __call__(self, text):
+        if text is None:
+            return None
+        key = content_key(text)
+        with self._lock:
+            html = self._cache.get(key)
+            if html is not None:
+                self._cache.move_to_end(key)
+                return html
+        start = time.time()
+        html = render_text(text)
+        add_timing('markdown', time.time() - start)
+        with self._lock:
+            self._cache[key] = html
+            while len(self._cache) > self.max_size:
+                self._cache.popitem(last=False)
+        return html
+
+    def cached(self, text):
+        with self._lock:
+            return content_key(text) in self._cache
+
+    def set_html(self, target, source, text):
+        """给 target 的 source 字段设置 text 时同时设置 <source>_html, 在属性的 set 事件里调用"""
+        html_attr = source + '_html'
+        if self._executor is None or text is None or len(text) < self.threshold or self.cached(text):
+            setattr(target, html_attr, self(text))
+            return
+        # 大段新内容先置空, 等事务提交之后在后台渲染写回
+        setattr(target, html_attr, None)
+        self.db.session().info.setdefault('markdown_pending', []).append((target, source, text))
+
+    def _after_flush(self, session, context):
+        pending = session.info.pop('markdown_pending', None)
+        if not pending:
+            return
+        ready = session.info.setdefault('markdown_ready', [])
+        for target, source, text in pending:
+            # 评论所在的文章 id 用来失效页面缓存, 文章就是它自己
+            post_id = getattr(target, 'post_id', target.id)
+            ready.append((target.__table__, target.id, source, text, post_id))
+
+    def _after_commit(self, session):
+        for job in session.info.pop('markdown_ready', []):
+            self._executor.submit(self._render_job, *job)
+
+    def _after_rollback(self, session, previous_transaction):
+        session.info.pop('markdown_pending', None)
+        session.info.pop('markdown_ready', None)
+
+    def _render_job(self, table, id, source, text, post_id):
+        try:
+            html = self(text)
+            with self.app.app_context():
+                # 渲染期间内容又被修改过的话这条 UPDATE 不会生效
+                result = self.db.engine.execute(table.update()
+                                                .where(table.c.id == id)
+                                                .where(table.c[source] == text)
+                                                .values({source + '_html': html}))
+                if result.rowcount:
+                    # 页面内容变了, 更新所在文章的修改时间
+                    posts = self.db.metadata.tables['posts']
+                    self.db.engine.execute(posts.update().where(posts.c.id == post_id)
+                                           .values(timestamp_update=datetime.utcnow()))
+            self.page_cache.invalidate('post:%d' % post_id)
+        except Exception:
+            self.app.logger.exception('markdown render of %s %d failed', table.name, id)
+
+
+def _render_batch(items):
+    return [(id, [render_text(text) if text is not None else None for text in texts])
+            for id, texts in items]
+
+
+def rerender(db, model, sources, batch_size=200, workers=None):
+    """用进程池按批重新渲染 model 的所有 sources 字段, 返回处理的行数"""
+    table = model.__table__
+    columns = [table.c.id] + [table.c[source] for source in sources]
+    update = table.update().where(table.c.id == db.bindparam('_id')) \
+        .values(dict((source + '_html', db.bindparam('_' + source)) for source in sources))
+    total = 0
+    last_id = 0
+    with ProcessPoolExecutor(workers) as executor:
+        while True:
+            rows = db.session.execute(db.select(columns).where(table.c.id > last_id)
+                                      .order_by(table.c.id).limit(batch_size)).fetchall()
+            if not rows:
+                break
+            last_id = rows[-1][0]
+            items = [(row[0], list(row[1:])) for row in rows]
+            # 每批再切成几块交给各个进程
+            chunk = max(1, len(items) // ((workers or 4) * 2))
+            chunks = [items[i:i + chunk] for i in range(0, len(items), chunk)]
+            params = []
+            for result in executor.map(_render_batch, chunks):
+                for id, htmls in result:
+                    values = {'_id': id}
+                    values.update(('_' + source, html) for source, html in zip(sources, htmls))
+                    params.append(values)
+            db.session.execute(update, params)
+            db.session.commit()
+            total += len(rows)
+    return total
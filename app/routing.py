@@ -0,0 +1,107 @@
+# coding=utf-8
+import time
+from flask import g, session, has_request_context, current_app
+from flask_sqlalchemy import SQLAlchemy, SignallingSession
+from sqlalchemy import event, exc, select
+from sqlalchemy.sql.dml import UpdateBase
+
+# 读写分离: 配置了 SQLALCHEMY_BINDS['replica'] 时, 标记为只读的 GET 请求读从库,
+# 写操作、写过之后同一事务里的读、以及刚写过数据的客户端在 READ_AFTER_WRITE_SECONDS 秒内的请求都走主库
+#
+# 按 tag 版本号缓存的数据(页面缓存、侧边栏、计数、订阅文档、搜索统计、登录用户)在主库提交之后才递增版本号,
+# 从库这时可能还没同步, 读了从库的请求在 tag 刚失效的这段时间里不把结果存进缓存, 见 replica_settled
+
+REPLICA = 'replica'
+
+
+def _ping_connection(connection, branch):
+    # 每次从连接池取出连接时先 SELECT 1, 连接已经被 MySQL 的 wait_timeout 断开的话重新连接
+    if branch:
+        return
+    save_should_close_with_result = connection.should_close_with_result
+    connection.should_close_with_result = False
+    try:
+        connection.scalar(select([1]))
+    except exc.DBAPIError as err:
+        if err.connection_invalidated:
+            connection.scalar(select([1]))
+        else:
+            raise
+    finally:
+        connection.should_close_with_result = save_should_close_with_result
+
+
+def pin_to_primary(app):
+    # 写完之后的一段时间内这个客户端的请求都读主库, 避免读到从库上还没同步的旧数据
+    if has_request_context():
+        session['_primary_until'] = int(time.time()) + app.config.get('READ_AFTER_WRITE_SECONDS', 5)
+
+
+def replica_allowed():
+    # 静态站点的页面在写操作提交之后马上生成, 要读主库
+    if not has_request_context() or not g.get('replica_reads') or g.get('static_export'):
+        return False
+    return session.get('_primary_until', 0) < time.time()
+
+
+def replica_settled(versions, tags):
+    """这次请求查到的数据能不能按 tags 现在的版本号缓存
+
+    没有读过从库时总是可以; 读过从库并且其中某个 tag 在 READ_AFTER_WRITE_SECONDS 秒内失效过时,
+    从库可能还是修改之前的数据, 存下来的话在下一次修改之前会一直被当成新的版本
+    """
+    if not has_request_context() or not g.get('replica_used'):
+        return True
+    return not versions.bumped_within(tags, current_app.config.get('READ_AFTER_WRITE_SECONDS', 5))
+
+
+class RoutingSession(SignallingSession):
+    def __init__(self, db, **options):
+        self.db = db
+        self._wrote = False
+        SignallingSession.__init__(self, db, **options)
+        event.listen(self, 'after_flush', self._on_write)
+        event.listen(self, 'after_bulk_update', self._on_write)
+        event.listen(self, 'after_bulk_delete', self._on_write)
+        event.listen(self, 'after_commit', self._after_commit)
+        event.listen(self, 'after_soft_rollback', self._after_rollback)
+
+    def _on_write(self, *args):
+        self._wrote = True
+
+    def _after_commit(self, session):
+        if self._wrote:
+            pin_to_primary(self.app)
+        self._wrote = False
+
+    def _after_rollback(self, session, previous_transaction):
+        self._wrote = False
+
+    def get_bind(self, mapper=None, clause=None):
+        if isinstance(clause, UpdateBase) or self._flushing:
+            self._wrote = True
+        elif not self._wrote and REPLICA in (self.app.config.get('SQLALCHEMY_BINDS') or ()) \
+                and replica_allowed():
+            g.replica_used = True
+            return self.db.get_engine(self.app, bind=REPLICA)
+        return SignallingSession.get_bind(self, mapper, clause)
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    """SQLAlchemy 扩展: 连接池参数、取连接前的 ping 和主从路由"""
+
+    def __init__(self, *args, **kwargs):
+        SQLAlchemy.__init__(self, *args, **kwargs)
+        self._pinged = set()
+
+    def create_session(self, options):
+        return RoutingSession(self, **options)
+
+    def get_engine(self, app, bind=None):
+        engine = SQLAlchemy.get_engine(self, app, bind)
+        if app.config.get('SQLALCHEMY_POOL_PRE_PING') and engine not in self._pinged:
+            with self._engine_lock:
+                if engine not in self._pinged:
+                    event.listen(engine, 'engine_connect', _ping_connection)
+                    self._pinged.add(engine)
+        return engine
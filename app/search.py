@@ -0,0 +1,197 @@
+# coding=utf-8
+import heapq
+import math
+import re
+import threading
+from collections import defaultdict, OrderedDict
+from flask import current_app
+from . import db, versions
+from .routing import replica_settled
+from .models import Post, Comment, SearchTerm, SearchDoc
+
+# 数据库里的倒排索引: search_terms 保存 (词, 文章, 加权词频), search_docs 保存文章的加权长度
+# 文章的增删改在同一个事务里更新索引, 排序用 BM25
+
+# 标题、摘要、正文、评论的权重
+FIELD_WEIGHTS = (('title', 3.0), ('summery', 1.5), ('body', 1.0))
+COMMENT_WEIGHT = 0.5
+K1 = 1.2
+B = 0.75
+# 每个 worker 缓存排好序的结果的查询数; 每次至少排出前 RANK_DEPTH 篇, 翻前几页不用重新排序
+RANKED_CACHE_SIZE = 256
+RANK_DEPTH = 100
+
+# 拉丁字母和数字按单词切分; 中日韩文字没有空格, 连续的一段按相邻两个字(bigram)切分
+_token_re = re.compile(u'[a-z0-9_]+|[\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af\uf900-\ufaff]+')
+_latin_re = re.compile(u'[a-z0-9_]')
+MAX_TERM_LENGTH = 64
+
+
+def tokenize(text):
+    if not text:
+        return
+    for match in _token_re.finditer(text.lower()):
+        token = match.group()
+        if _latin_re.match(token):
+            if len(token) <= MAX_TERM_LENGTH:
+                yield token
+        elif len(token) == 1:
+            yield token
+        else:
+            for i in range(len(token) - 1):
+                yield token[i:i + 2]
+
+
+def _weighted_terms(post, comments=()):
+    terms = defaultdict(float)
+    for field, weight in FIELD_WEIGHTS:
+        for token in tokenize(getattr(post, field)):
+            terms[token] += weight
+    for text in comments:
+        for token in tokenize(text):
+            terms[token] += COMMENT_WEIGHT
+    return terms
+
+
+def _include_comments():
+    return current_app.config.get('SEARCH_INCLUDE_COMMENTS', False)
+
+
+def _comment_texts(post_ids):
+    texts = defaultdict(list)
+    if post_ids and _include_comments():
+        rows = db.session.query(Comment.post_id, Comment.comment).filter(Comment.post_id.in_(post_ids))
+        for post_id, text in rows:
+            texts[post_id].append(text)
+    return texts
+
+
+def _insert(rows):
+    terms = []
+    docs = []
+    for post_id, weighted in rows:
+        terms.extend({'term': term, 'post_id': post_id, 'tf': tf} for term, tf in weighted.items())
+        docs.append({'post_id': post_id, 'length': sum(weighted.values())})
+    if terms:
+        db.session.execute(SearchTerm.__table__.insert(), terms)
+    if docs:
+        db.session.execute(SearchDoc.__table__.insert(), docs)
+
+
+def remove_post(post_id):
+    SearchTerm.query.filter_by(post_id=post_id).delete(synchronize_session=False)
+    SearchDoc.query.filter_by(post_id=post_id).delete(synchronize_session=False)
+
+
+def index_post(post):
+    """重建一篇文章的索引, 在调用者的事务里执行, 由调用者提交"""
+    db.session.flush()
+    remove_post(post.id)
+    _insert([(post.id, _weighted_terms(post, _comment_texts([post.id])[post.id]))])
+
+
+def index_posts(posts):
+    # 批量导入的新文章还没有索引和评论, 一次插入
+    _insert([(post.id, _weighted_terms(post)) for post in posts])
+
+
+def reindex_comments(post_id):
+    # 索引包含评论时, 评论增删后重建所在文章的索引; 返回 True 表示索引变了, 调用者要让 search tag 失效
+    if _include_comments():
+        index_post(Post.query.get(post_id))
+        return True
+    return False
+
+
+def rebuild(batch_size=500):
+    """清空并批量重建整个索引, 返回索引的文章数"""
+    SearchTerm.query.delete(synchronize_session=False)
+    SearchDoc.query.delete(synchronize_session=False)
+    db.session.commit()
+    total = 0
+    last_id = 0
+    columns = [Post.id] + [getattr(Post, field) for field, weight in FIELD_WEIGHTS]
+    while True:
+        posts = db.session.query(*columns).filter(Post.id > last_id) \
+            .order_by(Post.id).limit(batch_size).all()
+        if not posts:
+            break
+        last_id = posts[-1].id
+        comments = _comment_texts([p.id for p in posts])
+        _insert([(p.id, _weighted_terms(p, comments[p.id])) for p in posts])
+        db.session.commit()
+        total += len(posts)
+    versions.bump('search')
+    return total
+
+
+_stats = {}
+_stats_lock = threading.Lock()
+
+
+def _collection_stats():
+    # 文档数和平均长度按 search tag 的版本号缓存
+    version = versions.get('search')
+    with _stats_lock:
+        cached = _stats.get('stats')
+    if cached is not None and cached[0] == version:
+        return cached[1]
+    count, avg = db.session.query(db.func.count(SearchDoc.post_id), db.func.avg(SearchDoc.length)).one()
+    stats = (count or 0, float(avg or 0) or 1.0)
+    if replica_settled(versions, ['search']):
+        with _stats_lock:
+            _stats['stats'] = (version, stats)
+    return stats
+
+
+def _rank(terms, limit):
+    # 取出所有查询词的倒排记录算 BM25, 只把前 limit 篇排序; 返回 ([(post_id, score)], 命中的文章数)
+    n, avgdl = _collection_stats()
+    if not n:
+        return [], 0
+    rows = db.session.query(SearchTerm.term, SearchTerm.post_id, SearchTerm.tf, SearchDoc.length) \
+        .join(SearchDoc, SearchDoc.post_id == SearchTerm.post_id) \
+        .filter(SearchTerm.term.in_(terms)).all()
+    postings = defaultdict(list)
+    for term, post_id, tf, length in rows:
+        postings[term].append((post_id, tf, length))
+    scores = defaultdict(float)
+    for term, docs in postings.items():
+        df = len(docs)
+        idf = math.log(1 + (n - df + 0.5) / (df + 0.5))
+        for post_id, tf, length in docs:
+            scores[post_id] += idf * tf * (K1 + 1) / (tf + K1 * (1 - B + B * length / avgdl))
+    # 得分相同时新文章(id 大)在前
+    key = lambda item: (item[1], item[0])
+    if limit is None:
+        return sorted(scores.items(), key=key, reverse=True), len(scores)
+    return heapq.nlargest(limit, scores.items(), key=key), len(scores)
+
+
+_ranked = OrderedDict()
+_ranked_lock = threading.Lock()
+
+
+def search_posts(query, limit=None):
+    """返回 (按 BM25 得分排好序的前 limit 篇 [(post_id, score)], 命中的文章总数)
+
+    排好的结果按 (查询词, search tag 的版本号) 缓存, 翻页时不再重新取倒排记录和排序
+    """
+    terms = tuple(sorted(set(tokenize(query))))
+    if not terms:
+        return [], 0
+    version = versions.get('search')
+    with _ranked_lock:
+        cached = _ranked.get(terms)
+        if cached is not None and cached[0] == version \
+                and (len(cached[1]) == cached[2] or limit is not None and len(cached[1]) >= limit):
+            _ranked.move_to_end(terms)
+            return cached[1][:limit], cached[2]
+    ranked, total = _rank(list(terms), None if limit is None else max(limit, RANK_DEPTH))
+    if replica_settled(versions, ['search']):
+        with _ranked_lock:
+            _ranked[terms] = (version, ranked, total)
+            _ranked.move_to_end(terms)
+            while len(_ranked) > RANKED_CACHE_SIZE:
+                _ranked.popitem(last=False)
+    return ranked[:limit], total
@@ -0,0 +1,245 @@
+# coding=utf-8
+from datetime import datetime
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm.attributes import set_committed_value
+from . import db, page_cache, search, events, feeds, related, users, static_site
+from .models import Category, Post, Label, Comment, LikePost, LikeComment, DislikeComment, \
+    registrations, SiteVersion, PostStats
+
+
+# 写操作都放在这里, 每个操作只提交一次事务; Atom / sitemap 文档和相关文章在提交之后由后台线程更新
+# Category.count / Label.count / Post.comment_num 都用 UPDATE ... SET x = x + n 原子更新,
+# 避免多个 worker 同时读改写造成计数丢失
+
+
+def split_labels(text):
+    # 表单里的 Label 用逗号分隔, 去掉空白和重复
+    labels = []
+    for name in text.split(','):
+        name = name.strip()
+        if name and name not in labels:
+            labels.append(name)
+    return labels
+
+
+def _incr(model, ids, delta):
+    ids = sorted(set(ids))
+    if ids and delta:
+        model.query.filter(model.id.in_(ids)).update({model.count: model.count + delta},
+                                                     synchronize_session=False)
+
+
+def _touch_post(post_id, comments=0):
+    # 评论数变化和修改时间一起更新
+    values = {Post.timestamp_update: datetime.utcnow()}
+    if comments:
+        values[Post.comment_num] = Post.comment_num + comments
+    Post.query.filter_by(id=post_id).update(values, synchronize_session=False)
+
+
+def _lock_post(post_id):
+    # 先 UPDATE 文章这一行拿到写锁, 同一篇文章的并发修改排队执行; 返回 False 表示文章已经被删掉
+    return bool(Post.query.filter_by(id=post_id).update({Post.timestamp_update: datetime.utcnow()},
+                                                        synchronize_session=False))
+
+
+def _post_label_ids(post_id):
+    # 加锁读, MySQL 的可重复读下也能读到别的事务刚提交的 Label
+    return set(row[0] for row in db.session.query(registrations.c.label_id)
+               .filter(registrations.c.post_id == post_id).with_for_update())
+
+
+def _bump_site():
+    # 全站版本号 +1, 第一次修改时插入这一行
+    now = datetime.utcnow()
+    if not SiteVersion.query.filter_by(id=1).update(
+            {SiteVersion.version: SiteVersion.version + 1, SiteVersion.timestamp: now},
+            synchronize_session=False):
+        db.session.add(SiteVersion(id=1, version=1, timestamp=now))
+
+
+def _post_ids(tags):
+    # 'post:<id>' tag 对应的文章页, 静态站点也要重新生成
+    return [int(tag[len('post:'):]) for tag in tags if tag.startswith('post:')]
+
+
+def resolve_labels(names):
+    """一条 IN 查询取出已有的 Label, 缺少的一次批量插入
+
+    必须是事务里的第一个写操作: 并发插入同名 Label 冲突时会回滚后重新查询
+    """
+    if not names:
+        return []
+    for attempt in range(3):
+        found = dict((l.label, l) for l in Label.query.filter(Label.label.in_(names)))
+        missing = [name for name in names if name not in found]
+        if not missing:
+            return [found[name] for name in names]
+        try:
+            db.session.execute(Label.__table__.insert(), [{'label': name, 'count': 0} for name in missing])
+        except IntegrityError:
+            db.session.rollback()
+    raise RuntimeError('could not resolve labels %r' % names)
+
+
+def rerendered():
+    """manage.py rerender 之后: 全站版本号 +1, 条件 GET 的 ETag / Last-Modified 和所有页面缓存一起失效"""
+    _bump_site()
+    db.session.commit()
+    # 每个缓存页面都带有 sidebar tag, 借它让所有页面缓存失效
+    page_cache.invalidate('sidebar')
+
+
+def create_category(tag):
+    """返回新建的或者已有的同名 Category"""
+    category = Category.query.filter_by(tag=tag).first()
+    if category is not None:
+        return category
+    category = Category(tag=tag, count=0)
+    db.session.add(category)
+    try:
+        db.session.flush()
+    except IntegrityError:
+        # 另一个请求同时建了同名的 Category
+        db.session.rollback()
+        return Category.query.filter_by(tag=tag).first()
+    category_id = category.id
+    feeds.update_pages()
+    _bump_site()
+    db.session.commit()
+    page_cache.invalidate('sidebar')
+    static_site.refresh(categories=[category_id], sidebar=True)
+    return category
+
+
+def create_post(title, summery, body, category_tag, label_names):
+    labels = resolve_labels(label_names)
+    category = Category.query.filter_by(tag=category_tag).first()
+    post = Post(title=title, summery=summery, body=body, category=category, labels=labels,
+                comment_num=0, like_num=0)
+    db.session.add(post)
+    db.session.flush()
+    search.index_post(post)
+    # 增加一篇文章的同时将其所在的 Category 和所包含的 Label 的文章数 +1
+    if category is not None:
+        _incr(Category, [category.id], 1)
+    _incr(Label, [l.id for l in labels], 1)
+    feeds.update_post(post)
+    related.schedule_post(post.id)
+    tags = ['index', 'sidebar', 'search'] + ['label:%d' % l.id for l in labels]
+    if category is not None:
+        tags.append('category:%d' % category.id)
+    position = (post.category_id, post.timestamp, post.id, True)
+    _bump_site()
+    db.session.commit()
+    page_cache.invalidate(*tags)
+    static_site.refresh(_post_ids(tags) + [position[2]], [position], sidebar=True)
+    return post
+
+
+def update_post(post, title, summery, body, label_names):
+    labels = resolve_labels(label_names)
+    if not _lock_post(post.id):
+        db.session.rollback()
+        return post
+    # 只更新修改前后有变化的 Label 的文章数, 避免同一篇文章在一个 Label 上被算成多篇;
+    # 修改前的 Label 在拿到锁之后重新读, 不用请求开始时加载的 post.labels
+    old = _post_label_ids(post.id)
+    new = set(l.id for l in labels)
+    post.title = title
+    post.summery = summery
+    post.body = body
+    post.timestamp_update = datetime.utcnow()
+    if old - new:
+        db.session.execute(registrations.delete().where(registrations.c.post_id == post.id)
+                           .where(registrations.c.label_id.in_(sorted(old - new))))
+    if new - old:
+        db.session.execute(registrations.insert(), [{'post_id': post.id, 'label_id': id} for id in sorted(new - old)])
+    # 关联表已经改好, 只更新内存里的 post.labels, flush 时不再处理
+    set_committed_value(post, 'labels', labels)
+    search.index_post(post)
+    _incr(Label, new - old, 1)
+    _incr(Label, old - new, -1)
+    feeds.update_post(post, old)
+    tags = ['post:%d' % post.id, 'search'] + ['label:%d' % i for i in old | new]
+    if old != new:
+        # 侧边栏只显示 Label 的文章数, Label 没变时不用让所有页面缓存失效
+        tags.append('sidebar')
+        related.schedule_post(post.id, old)
+    position = (post.category_id, post.timestamp, post.id, False)
+    _bump_site()
+    db.session.commit()
+    page_cache.invalidate(*tags)
+    static_site.refresh(_post_ids(tags), [position], sidebar=old != new)
+    return post
+
+
+def delete_post(post):
+    post_id = post.id
+    category_id = post.category_id
+    timestamp = post.timestamp
+    db.session.expunge(post)
+    # 同时删除同一篇文章时只有一个请求修改计数
+    if not _lock_post(post_id):
+        db.session.rollback()
+        return
+    label_ids = sorted(_post_label_ids(post_id))
+    # 文章的评论、点赞和 Label 关联都用批量 DELETE 删除
+    LikeComment.query.filter_by(post_id=post_id).delete(synchronize_session=False)
+    DislikeComment.query.filter_by(post_id=post_id).delete(synchronize_session=False)
+    Comment.query.filter_by(post_id=post_id).delete(synchronize_session=False)
+    LikePost.query.filter_by(post_id=post_id).delete(synchronize_session=False)
+    db.session.execute(registrations.delete().where(registrations.c.post_id == post_id))
+    PostStats.query.filter_by(post_id=post_id).delete(synchronize_session=False)
+    search.remove_post(post_id)
+    feeds.remove_post(post_id, category_id, label_ids)
+    tags = ['index', 'sidebar', 'search', 'post:%d' % post_id] + ['label:%d' % i for i in label_ids]
+    tags += related.remove_post(post_id)
+    Post.query.filter_by(id=post_id).delete(synchronize_session=False)
+    # 删除一篇文章的同时将其所在的 Category 和所包含的 Label 的文章数 -1
+    if category_id is not None:
+        _incr(Category, [category_id], -1)
+        tags.append('category:%d' % category_id)
+    _incr(Label, label_ids, -1)
+    _bump_site()
+    db.session.commit()
+    page_cache.invalidate(*tags)
+    static_site.refresh(_post_ids(tags), [(category_id, timestamp, post_id, True)], sidebar=True)
+
+
+def add_comment(post_id, user_id, text):
+    comment = Comment(comment=text, post_id=post_id, user_id=user_id)
+    db.session.add(comment)
+    db.session.flush()
+    # 增加一个评论的同时将评论所在的 post 的评论数 +1
+    _touch_post(post_id, 1)
+    tags = ['post:%d' % post_id]
+    if search.reindex_comments(post_id):
+        tags.append('search')
+    # 提交之后对象会过期, 推送给读者的内容先取出来; 评论者就是当前用户, 不会再查询
+    event = {'id': comment.id, 'user': users.load(user_id).username, 'html': comment.comment_html}
+    db.session.commit()
+    page_cache.invalidate(*tags)
+    static_site.refresh([post_id])
+    events.publish(post_id, 'comment', event)
+    return comment
+
+
+def delete_comment(comment):
+    comment_id = comment.id
+    post_id = comment.post_id
+    db.session.expunge(comment)
+    LikeComment.query.filter_by(comment_id=comment_id).delete(synchronize_session=False)
+    DislikeComment.query.filter_by(comment_id=comment_id).delete(synchronize_session=False)
+    # 删除一个评论的同时将其所在的 Post 的评论数 -1, 同一个评论被同时删除两次时只减一次;
+    # 带上 post_id, SQLite 重用了这个 id 的话不会删到别的文章的评论上
+    deleted = Comment.query.filter_by(id=comment_id, post_id=post_id).delete(synchronize_session=False)
+    _touch_post(post_id, -deleted)
+    tags = ['post:%d' % post_id]
+    if search.reindex_comments(post_id):
+        tags.append('search')
+    db.session.commit()
+    page_cache.invalidate(*tags)
+    static_site.refresh([post_id])
+    events.publish(post_id, 'delete_comment', {'id': comment_id})
+    return post_id
@@ -0,0 +1,55 @@
+# coding=utf-8
+from collections import namedtuple
+from . import db, versions
+from .routing import replica_settled
+from .models import Category, Label, SiteVersion
+
+# 导航栏和侧边栏用到的 Category、Label 及其文章数
+# 每个 worker 缓存一份不可变的元组, 用 sidebar tag 的版本号判断是否过期,
+# 任何 worker 改动 Category/Label 或它们的文章数时都会 invalidate('sidebar')
+# 全站版本号(SiteVersion)和它们同时修改, 也一起缓存
+
+CategoryItem = namedtuple('CategoryItem', 'id tag count')
+LabelItem = namedtuple('LabelItem', 'id label count')
+
+_cache = None
+
+
+def _load():
+    global _cache
+    version = versions.get('sidebar')
+    cached = _cache
+    if cached is not None and cached[0] == version:
+        return cached
+    # 先读版本号再查询, 查询期间发生的修改会让下一次请求重新加载
+    categories = tuple(CategoryItem(*row) for row in
+                       db.session.query(Category.id, Category.tag, Category.count).order_by(Category.id))
+    labels = tuple(LabelItem(*row) for row in
+                   db.session.query(Label.id, Label.label, Label.count).order_by(Label.id))
+    site = db.session.query(SiteVersion.version, SiteVersion.timestamp).filter_by(id=1).first()
+    cached = (version, categories, dict((c.tag, c) for c in categories), labels,
+              tuple(site) if site is not None else (0, None), dict((l.label, l) for l in labels))
+    if replica_settled(versions, ['sidebar']):
+        _cache = cached
+    return cached
+
+
+def categories():
+    return _load()[1]
+
+
+def category(tag):
+    return _load()[2].get(tag)
+
+
+def labels():
+    return _load()[3]
+
+
+def label(name):
+    return _load()[5].get(name)
+
+
+def site_version():
+    # (版本号, 修改时间), 还没有修改过时是 (0, None)
+    return _load()[4]
@@ -15,16 +15,93 @@ $(document).ready(function(){
 });
 
 $(function() {
+    /*静态页面里的表单没有 CSRF token, 从 /session 取回后填上*/
+    if ($("body").is("[data-static-page]")) {
+        $.getJSON($SCRIPT_ROOT + '/session', function (data) {
+            $('input[name="csrf_token"]').val(data.csrf_token);
+        });
+        /*静态文章页不经过应用, 浏览在这里计数, 同时换上最新的浏览数*/
+        if ($("#view_num").length) {
+            $.post($SCRIPT_ROOT + '/post/' + $("#post_id").text() + '/view', function (data) {
+                $("#view_num").text(data.views);
+                $("#visitor_num").text(data.visitors);
+            }, 'json');
+        }
+    }
+
+    /*已经点过赞时再点一次取消点赞*/
     var like_post = function () {
-        $.getJSON($SCRIPT_ROOT + '/like_post', {
+        var url = $("#like").hasClass("liked") ? '/undo_like_post' : '/like_post';
+        $.getJSON($SCRIPT_ROOT + url, {
             post_id: $("#post_id").text(),
         }, function (data) {
             $("#likes_num").text(data.likes);
-            $("#like").css({ "color": '#28a0f6' });
+            $("#like").toggleClass("liked", data.like).css({ "color": data.like ? '#28a0f6' : '' });
         });
         return false;
     };
     $('a#like').bind("click", like_post);
+
+    /*评论的点赞/踩: 页面上所有评论的状态一次取回*/
+    var mark_comment = function (box, like, dislike) {
+        box.find(".comment-like").toggleClass("liked", like).css({ "color": like ? '#28a0f6' : '' });
+        box.find(".comment-dislike").toggleClass("disliked", dislike).css({ "color": dislike ? '#e74c3c' : '' });
+    };
+    var comment_ids = $(".comment-votes").has(".comment-like").map(function () {
+        return $(this).data("comment-id");
+    }).get();
+    if (comment_ids.length) {
+        $.getJSON($SCRIPT_ROOT + '/interactions', { comments: comment_ids.join(",") }, function (data) {
+            $.each(comment_ids, function (i, id) {
+                mark_comment($('.comment-votes[data-comment-id="' + id + '"]'),
+                    $.inArray(id, data.comments.liked) >= 0, $.inArray(id, data.comments.disliked) >= 0);
+            });
+        });
+    }
+    var vote_comment = function (kind) {
+        return function () {
+            var box = $(this).closest(".comment-votes");
+            var active = $(this).hasClass(kind + "d");
+            $.getJSON($SCRIPT_ROOT + (active ? '/undo_' : '/') + kind + '_comment', {
+                comment_id: box.data("comment-id")
+            }, function (data) {
+                box.find(".comment-like .num").text(data.likes);
+                box.find(".comment-dislike .num").text(data.dislikes);
+                mark_comment(box, data.like, data.dislike);
+            });
+            return false;
+        };
+    };
+    $('a.comment-like').bind("click", vote_comment("like"));
+    $('a.comment-dislike').bind("click", vote_comment("dislike"));
+
+    /*文章页订阅新评论和点赞数的实时推送*/
+    if (window.EventSource && $("#post_id").length) {
+        var source = new EventSource($SCRIPT_ROOT + '/post/' + $("#post_id").text() + '/events');
+        source.addEventListener("comment", function (e) {
+            var data = JSON.parse(e.data);
+            if ($('.comment-box[data-comment-id="' + data.id + '"]').length) {
+                return;
+            }
+            var box = $('<div class="comment-box" style="border-top:1px solid #EBEBEB;padding:5px 5px;margin-top:5px;">' +
+                '<div class="row"><div class="col-md-2 col-md-offset-1"><h3 style="margin: 5px 0px;"></h3></div>' +
+                '<div class="col-md-8 comment" style="margin-top: 25px"></div></div></div>');
+            box.attr("data-comment-id", data.id);
+            box.find("h3").text(data.user);
+            if (data.html) {
+                box.find(".comment").html(data.html);
+            } else {
+                box.find(".comment").append($('<a>').attr("href", window.location.href).text("有新评论, 刷新查看"));
+            }
+            $("#comments").prepend(box);
+        });
+        source.addEventListener("delete_comment", function (e) {
+            $('.comment-box[data-comment-id="' + JSON.parse(e.data).id + '"]').remove();
+        });
+        source.addEventListener("likes", function (e) {
+            $("#likes_num").text(JSON.parse(e.data).likes);
+        });
+    }
 });
 
 
@@ -0,0 +1,280 @@
+# coding=utf-8
+import glob
+import multiprocessing
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, wait
+from flask import g, request, render_template
+from flask_login import current_user
+from .cache import PageCache
+
+# 静态站点: 把匿名读者看到的首页、分类页、文章页和 404 页渲染成 STATIC_SITE_DIR 下的 HTML 文件,
+# 由 nginx 直接返回(见 conf/nginx/default), 导航栏和侧边栏是用 SSI 引入的片段
+#
+#   index.html, index/<页码>.html
+#   category/<tag>.html, category/<tag>/<页码>.html
+#   post/<id>.html            只有第一页评论, 评论翻页仍由应用处理
+#   404.html, _fragments/nav.html, _fragments/sidebar.html
+#
+# 页面里不带 CSRF token, 由 dexcode.js 通过 /session 取回后填上; 登录用户带着 STATIC_SITE_COOKIE,
+# nginx 看到这个 cookie 就转给应用. 写操作提交之后 services 调用 refresh, 在后台找出并重新生成受影响的页面
+
+EXPORT_ENVIRON = 'dexcode.static_export'
+
+# 全量导出时子进程通过 fork 继承这个对象
+_exporting = None
+
+
+def _export_chunk(paths):
+    with _exporting.app.app_context():
+        return _exporting.write_paths(paths)
+
+
+class StaticSite(object):
+    def __init__(self, db, app=None):
+        self.db = db
+        self.app = None
+        self.directory = None
+        self.cookie = 'dexcode_user'
+        self._executor = None
+        self._futures = set()
+        self._pending = set()
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        self.directory = app.config.get('STATIC_SITE_DIR')
+        self.cookie = app.config.get('STATIC_SITE_COOKIE', 'dexcode_user')
+        if self.directory and self._executor is None:
+            self._executor = ThreadPoolExecutor(app.config.get('STATIC_SITE_WORKERS', 2))
+
+        @app.before_request
+        def static_export_flag():
+            g.static_export = bool(request.environ.get(EXPORT_ENVIRON))
+
+        @app.context_processor
+        def static_export_context():
+            return {'static_export': g.get('static_export', False)}
+
+        @app.after_request
+        def static_site_cookie(response):
+            # 只是告诉 nginx 这个请求不能用静态页面, 本身不代表任何权限
+            if not self.directory or g.get('static_export'):
+                return response
+            logged_in = current_user.is_authenticated
+            if logged_in and not request.cookies.get(self.cookie):
+                response.set_cookie(self.cookie, '1', httponly=True)
+            elif not logged_in and request.cookies.get(self.cookie):
+                response.delete_cookie(self.cookie)
+            return response
+
+    # 路径和文件
+
+    def _file(self, path):
+        return os.path.join(self.directory, path.lstrip('/'))
+
+    @staticmethod
+    def list_file(prefix, page):
+        # prefix 是 'index' 或者 'category/<tag>'
+        return '%s.html' % prefix if page == 1 else '%s/%d.html' % (prefix, page)
+
+    @staticmethod
+    def _safe_tag(tag):
+        return tag and '/' not in tag and not tag.startswith('.')
+
+    def _write(self, name, body):
+        path = self._file(name)
+        directory = os.path.dirname(path)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        # 先写临时文件再改名, nginx 不会读到写了一半的页面
+        tmp = '%s.%d.%d.tmp' % (path, os.getpid(), threading.current_thread().ident)
+        with open(tmp, 'wb') as f:
+            f.write(body)
+        os.rename(tmp, path)
+
+    def _remove(self, name):
+        try:
+            os.unlink(self._file(name))
+        except OSError:
+            pass
+
+    # 渲染
+
+    def _render(self, url):
+        client = self.app.test_client()
+        response = client.get(url, environ_overrides={EXPORT_ENVIRON: True})
+        body = PageCache._csrf_re.sub(r'\g<1>\g<2>', response.get_data(as_text=True))
+        return response.status_code, body.encode('utf-8')
+
+    def _fragments(self):
+        from . import sidebar
+        with self.app.test_request_context():
+            categories = sidebar.categories()
+            return [('_fragments/nav.html', render_template('_nav_categories.html', categories=categories)),
+                    ('_fragments/sidebar.html', render_template('_sidebar.html', categories=categories,
+                                                                labels=sidebar.labels()))]
+
+    def write_path(self, name):
+        """name 是相对 STATIC_SITE_DIR 的文件名, 对应的页面不存在时删除文件"""
+        with self._lock:
+            self._pending.discard(name)
+        if name.startswith('_fragments/'):
+            for fragment, body in self._fragments():
+                self._write(fragment, body.encode('utf-8'))
+            return
+        if name == '404.html':
+            status, body = self._render('/__static_site_404__')
+            self._write(name, body)
+            return
+        url = self._url(name)
+        status, body = self._render(url)
+        if status == 200:
+            self._write(name, body)
+        elif status == 404:
+            self._remove(name)
+
+    def write_paths(self, names):
+        for name in names:
+            self.write_path(name)
+        return len(names)
+
+    @staticmethod
+    def _url(name):
+        # write_path 的反向: 文件名 -> URL
+        base = name[:-len('.html')]
+        parts = base.split('/')
+        if parts[0] == 'post':
+            return '/post/%s' % parts[1]
+        if parts[0] == 'index':
+            return '/' if len(parts) == 1 else '/?page=%s' % parts[1]
+        if parts[0] == 'category':
+            return '/category/%s' % parts[1] if len(parts) == 2 else '/category/%s?page=%s' % (parts[1], parts[2])
+        raise ValueError(name)
+
+    # 需要重新生成的页面
+
+    def _list_names(self, prefix, query, per_page, position=None, shifted=False):
+        from .models import Post
+        total = query.order_by(None).count()
+        last = max(1, (total + per_page - 1) // per_page)
+        if position is None:
+            pages = range(1, last + 1)
+        else:
+            timestamp, id = position
+            newer = query.filter(self.db.or_(Post.timestamp > timestamp,
+                                             self.db.and_(Post.timestamp == timestamp, Post.id > id))) \
+                .order_by(None).count()
+            first = newer // per_page + 1
+            pages = range(first, last + 1) if shifted else [first]
+        names = [self.list_file(prefix, page) for page in pages if page <= last]
+        # 文章减少之后多出来的页
+        for path in glob.glob(os.path.join(self._file(prefix), '*.html')):
+            page = os.path.basename(path)[:-len('.html')]
+            if page.isdigit() and int(page) > last:
+                self._remove('%s/%s' % (prefix, os.path.basename(path)))
+        return names
+
+    def refresh(self, post_ids=(), positions=(), categories=(), sidebar=False):
+        """写操作提交之后调用, 没有配置 STATIC_SITE_DIR 时什么都不做
+
+        请求里只把参数交给后台线程池, 找出受影响的页面(要查询计数、删除多出来的列表页)和渲染都在后台进行
+        positions: [(category_id, timestamp, id, shifted)], 文章在列表里的位置;
+        shifted 表示文章新增或删除, 这个位置之后的列表页都要重新生成
+        categories: 需要全部重新生成的分类 id
+        """
+        if not self.directory:
+            return
+        future = self._executor.submit(self._refresh_job, list(post_ids), list(positions), list(categories), sidebar)
+        with self._lock:
+            self._futures.add(future)
+        future.add_done_callback(self._done)
+
+    def _done(self, future):
+        with self._lock:
+            self._futures.discard(future)
+
+    def _refresh_names(self, post_ids, positions, categories, sidebar):
+        from .models import Post, Category
+        per_page = self.app.config['POSTS_PER_PAGE']
+        names = ['post/%d.html' % id for id in post_ids]
+        tags = dict(self.db.session.query(Category.id, Category.tag))
+        for category_id, timestamp, id, shifted in positions:
+            names += self._list_names('index', Post.query, per_page, (timestamp, id), shifted)
+            if category_id in tags and self._safe_tag(tags[category_id]):
+                names += self._list_names('category/%s' % tags[category_id],
+                                          Post.query.filter_by(category_id=category_id), per_page,
+                                          (timestamp, id), shifted)
+        for category_id in categories:
+            if category_id in tags and self._safe_tag(tags[category_id]):
+                names += self._list_names('category/%s' % tags[category_id],
+                                          Post.query.filter_by(category_id=category_id), per_page)
+        if sidebar:
+            names.append('_fragments/nav.html')
+        return names
+
+    def _refresh_job(self, post_ids, positions, categories, sidebar):
+        try:
+            with self.app.app_context():
+                try:
+                    names = self._refresh_names(post_ids, positions, categories, sidebar)
+                    # 别的任务已经排上但还没开始生成的页面不再重复生成, 它开始时会读到这次提交的数据
+                    with self._lock:
+                        names = [name for name in OrderedDict.fromkeys(names) if name not in self._pending]
+                        self._pending.update(names)
+                    for name in names:
+                        self._write_one(name)
+                finally:
+                    self.db.session.remove()
+        except Exception:
+            self.app.logger.exception('static site refresh failed')
+
+    def _write_one(self, name):
+        try:
+            self.write_path(name)
+        except Exception:
+            with self._lock:
+                self._pending.discard(name)
+            self.app.logger.exception('static site regeneration of %s failed', name)
+
+    def wait(self):
+        # 等后台的页面生成任务都执行完, 测试和命令行里用
+        while True:
+            with self._lock:
+                futures = list(self._futures)
+            if not futures:
+                return
+            wait(futures)
+
+    def all_names(self):
+        from .models import Post, Category
+        per_page = self.app.config['POSTS_PER_PAGE']
+        names = ['_fragments/nav.html', '404.html']
+        names += self._list_names('index', Post.query, per_page)
+        for id, tag in self.db.session.query(Category.id, Category.tag):
+            if self._safe_tag(tag):
+                names += self._list_names('category/%s' % tag, Post.query.filter_by(category_id=id), per_page)
+        names += ['post/%d.html' % id for id, in self.db.session.query(Post.id).order_by(Post.id)]
+        return names
+
+    def export(self, workers=None, chunk_size=50):
+        """全量导出, 用进程池并行渲染; 返回写出的页面数"""
+        global _exporting
+        names = self.all_names()
+        # 连接不能跨 fork 共用, fork 之前清空连接池, 子进程各自重新连接
+        self.db.session.remove()
+        self.db.get_engine(self.app).dispose()
+        for bind in self.app.config.get('SQLALCHEMY_BINDS') or ():
+            self.db.get_engine(self.app, bind=bind).dispose()
+        _exporting = self
+        pool = multiprocessing.get_context('fork').Pool(workers)
+        try:
+            total = sum(pool.map(_export_chunk, [names[i:i + chunk_size]
+                                                 for i in range(0, len(names), chunk_size)]))
+        finally:
+            pool.close()
+            pool.join()
+        return total
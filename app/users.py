@@ -0,0 +1,98 @@
+# coding=utf-8
+import threading
+import time
+from collections import OrderedDict
+from sqlalchemy import event, inspect
+from sqlalchemy.orm import Session
+from flask_login import UserMixin
+from .routing import replica_settled
+
+
+class SessionUser(UserMixin):
+    """已登录用户在请求里用到的几个字段, 代替 User 作为 current_user"""
+
+    def __init__(self, id, username):
+        self.id = id
+        self.username = username
+        self.dexter = username == 'Dexter' and id == 1
+
+    def is_dexter(self):
+        return self.dexter
+
+    def __repr__(self):
+        return '<SessionUser %r>' % self.username
+
+
+class UserCache(object):
+    """Flask-Login 的 user_loader: 每个 worker 用 LRU 缓存 SessionUser
+
+    缓存项在 USER_CACHE_TTL 秒后过期, user:<id> tag 的版本号变化时立即失效;
+    退出登录和 users 表的用户名、密码修改提交之后都会让这个 tag 失效
+    """
+
+    def __init__(self, db, versions, login_manager, app=None):
+        self.db = db
+        self.versions = versions
+        self.login_manager = login_manager
+        self.max_size = 1024
+        self.ttl = 300
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.max_size = app.config.get('USER_CACHE_SIZE', 1024)
+        self.ttl = app.config.get('USER_CACHE_TTL', 300)
+        self.login_manager.user_loader(self.load)
+        if not event.contains(Session, 'after_flush', self._after_flush):
+            event.listen(Session, 'after_flush', self._after_flush)
+            event.listen(Session, 'after_commit', self._after_commit)
+            event.listen(Session, 'after_soft_rollback', self._after_rollback)
+
+    def load(self, user_id):
+        try:
+            user_id = int(user_id)
+        except (TypeError, ValueError):
+            return None
+        version = self.versions.get('user:%d' % user_id)
+        now = time.time()
+        with self._lock:
+            cached = self._cache.get(user_id)
+            if cached is not None and cached[0] > now and cached[1] == version:
+                self._cache.move_to_end(user_id)
+                return cached[2]
+        users = self.db.metadata.tables['users']
+        row = self.db.session.execute(self.db.select([users.c.id, users.c.username])
+                                      .where(users.c.id == user_id)).first()
+        user = SessionUser(row[0], row[1]) if row is not None else None
+        if not replica_settled(self.versions, ['user:%d' % user_id]):
+            return user
+        with self._lock:
+            self._cache[user_id] = (now + self.ttl, version, user)
+            self._cache.move_to_end(user_id)
+            while len(self._cache) > self.max_size:
+                self._cache.popitem(last=False)
+        return user
+
+    def invalidate(self, *user_ids):
+        self.versions.bump(*['user:%d' % int(id) for id in user_ids])
+
+    def _after_flush(self, session, context):
+        changed = session.info.setdefault('users_changed', set())
+        for obj in session.dirty:
+            if getattr(obj, '__tablename__', None) == 'users':
+                state = inspect(obj)
+                if state.attrs.username.history.has_changes() or state.attrs.password_hash.history.has_changes():
+                    changed.add(obj.id)
+        for obj in session.deleted:
+            if getattr(obj, '__tablename__', None) == 'users':
+                changed.add(obj.id)
+
+    def _after_commit(self, session):
+        changed = session.info.pop('users_changed', None)
+        if changed:
+            self.invalidate(*changed)
+
+    def _after_rollback(self, session, previous_transaction):
+        session.info.pop('users_changed', None)
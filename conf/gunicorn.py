@@ -0,0 +1,14 @@
+# coding=utf-8
+import multiprocessing
+import os
+
+# gunicorn -c conf/gunicorn.py wsgi_gunicorn:app
+# 普通请求用线程 worker: 渲染线程池、静态站点的进程池和计数器的定时刷新都是真正的线程,
+# 不能放进会 monkeypatch 整个进程的 gevent worker; 文章页的 server-sent events 见 conf/gunicorn_events.py
+
+bind = os.environ.get('GUNICORN_BIND', '127.0.0.1:9000')
+workers = int(os.environ.get('GUNICORN_WORKERS', multiprocessing.cpu_count() * 2 + 1))
+worker_class = 'gthread'
+threads = int(os.environ.get('GUNICORN_THREADS', 4))
+timeout = 30
+keepalive = 5
@@ -0,0 +1,16 @@
+# coding=utf-8
+import multiprocessing
+import os
+
+# gunicorn -c conf/gunicorn_events.py wsgi_gunicorn:app
+# 只处理文章页的 server-sent events(nginx 把 /post/<id>/events 转到这里), 都是长连接,
+# 用 gevent worker, 一个 worker 可以同时挂着几千个空闲连接; 这个进程里不处理别的请求,
+# gevent 的 monkeypatch 不会影响普通请求用到的线程池和定时器
+
+bind = os.environ.get('GUNICORN_EVENTS_BIND', '127.0.0.1:9001')
+workers = int(os.environ.get('GUNICORN_EVENTS_WORKERS', multiprocessing.cpu_count()))
+worker_class = 'gevent'
+# 每个 worker 的最大并发连接数, 要大于 EVENTS_MAX_SUBSCRIBERS
+worker_connections = int(os.environ.get('GUNICORN_WORKER_CONNECTIONS', 6000))
+timeout = 30
+keepalive = 5
@@ -1,8 +1,9 @@
 # coding=utf-8
 import os
-from app import db, create_app
+from app import db, create_app, page_cache, pageviews
 from app.models import User, Category, Post, Label, Comment, LikePost, LikeComment, DislikeComment
-from flask_script import Manager, Shell
+from flask_script import Manager, Shell, Command, Option
+from flask_migrate import MigrateCommand
 
 
 app = create_app(os.getenv('FLASK_CONFIG') or 'default')
@@ -13,6 +14,211 @@ def make_shell_context():
     return dict(app=app, db=db, User=User, Category=Category, Post=Post, Label=Label, Comment=Comment,
                 LikePost=LikePost, LikeComment=LikeComment, DislikeComment=DislikeComment)
 manager.add_command("shell", Shell(make_context=make_shell_context))
+manager.add_command('db', MigrateCommand)
+
+
+@manager.option('-b', '--batch', dest='batch', type=int, default=200, help='rows per batch')
+@manager.option('-w', '--workers', dest='workers', type=int, default=None, help='render processes')
+def rerender(batch, workers):
+    """Re-render body_html, summery_html and comment_html after the renderer changes"""
+    from app.render import rerender as rerender_model
+    posts = rerender_model(db, Post, ['body', 'summery'], batch, workers)
+    comments = rerender_model(db, Comment, ['comment'], batch, workers)
+    from app.services import rerendered
+    rerendered()
+    print('re-rendered %d posts and %d comments' % (posts, comments))
+    # Atom 条目里存的是渲染好的 HTML, 静态站点的页面也一样, 都要重新生成
+    from app import feeds, static_site
+    print('rebuilt feeds for %d posts' % feeds.rebuild(batch))
+    if static_site.directory:
+        print('wrote %d pages to %s' % (static_site.export(workers), static_site.directory))
+
+
+class ImportPosts(Command):
+    """Import a directory of Markdown files with front matter as posts"""
+
+    option_list = (
+        Option('directory', help='directory of .md files'),
+        Option('-b', '--batch', dest='batch', type=int, default=200, help='posts per transaction'),
+        Option('-w', '--workers', dest='workers', type=int, default=None, help='render processes'),
+    )
+
+    def run(self, directory, batch, workers):
+        from app.archive import import_posts
+        errors = []
+        total = import_posts(directory, batch, workers, errors)
+        for path, error in errors:
+            print('skipped %s: %s' % (path, error))
+        print('imported %d posts, skipped %d files' % (total, len(errors)))
+        if total:
+            # 批量导入不逐篇维护相关文章, 导入完成后全量重建
+            from app.related import rebuild
+            rebuild()
+            # 导入的文章不逐篇生成静态页面, 配置了 STATIC_SITE_DIR 时全量导出一次
+            from app import static_site
+            if static_site.directory:
+                print('wrote %d pages to %s' % (static_site.export(workers), static_site.directory))
+manager.add_command('import', ImportPosts())
+
+
+@manager.option('directory', help='output directory')
+@manager.option('-b', '--batch', dest='batch', type=int, default=200, help='posts per query')
+def export(directory, batch):
+    """Export every post as a Markdown file with front matter"""
+    from app.archive import export_posts
+    print('exported %d posts' % export_posts(directory, batch))
+
+
+class ExportStatic(Command):
+    """Render every public page into STATIC_SITE_DIR for nginx to serve"""
+
+    option_list = (
+        Option('-d', '--dir', dest='directory', default=None, help='output directory (default STATIC_SITE_DIR)'),
+        Option('-w', '--workers', dest='workers', type=int, default=None, help='render processes'),
+    )
+
+    def run(self, directory, workers):
+        from app import static_site
+        if directory:
+            static_site.directory = directory
+        if not static_site.directory:
+            print('set STATIC_SITE_DIR or pass --dir')
+            return
+        print('wrote %d pages to %s' % (static_site.export(workers), static_site.directory))
+manager.add_command('export-static', ExportStatic())
+
+
+@manager.option('-b', '--batch', dest='batch', type=int, default=500, help='posts per batch')
+def search_index(batch):
+    """Rebuild the full-text search index from scratch"""
+    from app.search import rebuild
+    print('indexed %d posts' % rebuild(batch))
+
+
+@manager.option('-b', '--batch', dest='batch', type=int, default=500, help='posts per batch')
+def feeds(batch):
+    """Rebuild the stored Atom feeds and sitemaps from scratch"""
+    from app.feeds import rebuild
+    print('wrote feed entries for %d posts' % rebuild(batch))
+
+
+@manager.option('-b', '--batch', dest='batch', type=int, default=512, help='posts per block')
+def related(batch):
+    """Rebuild the related-posts index from label and category co-occurrence"""
+    from app.related import rebuild
+    print('computed related posts for %d posts' % rebuild(batch))
+
+
+@manager.option('-n', '--queries', dest='queries', type=int, default=500, help='number of queries')
+@manager.option('-t', '--terms', dest='terms', type=int, default=2, help='terms per query')
+def search_bench(queries, terms):
+    """Measure search latency with random queries drawn from the index"""
+    import random
+    import time
+    from app.models import SearchTerm, SearchDoc
+    from app.search import search_posts
+    vocabulary = [row[0] for row in db.session.query(SearchTerm.term).distinct().limit(20000)]
+    if not vocabulary:
+        print('the search index is empty, run "manage.py search_index" first')
+        return
+    timings = []
+    for i in range(queries):
+        q = ' '.join(random.choice(vocabulary) for j in range(terms))
+        start = time.time()
+        search_posts(q, app.config['POSTS_PER_PAGE'])
+        timings.append((time.time() - start) * 1000)
+    timings.sort()
+    pick = lambda p: timings[min(len(timings) - 1, int(len(timings) * p))]
+    print('%d docs, %d queries: p50 %.1fms p95 %.1fms p99 %.1fms max %.1fms' % (
+        db.session.query(db.func.count(SearchDoc.post_id)).scalar(), queries,
+        pick(0.5), pick(0.95), pick(0.99), timings[-1]))
+
+
+@manager.option('-v', '--verbose', dest='verbose', action='store_true', default=False, help='list the pages checked')
+def explain(verbose):
+    """EXPLAIN the queries behind the hot pages, exit 1 on a full table scan or filesort"""
+    import sys
+    from app.query_plans import check, hot_urls
+    urls = hot_urls()
+    if verbose:
+        print('\n'.join(urls))
+    problems = check(app, urls)
+    for url, statement, details in problems:
+        print('%s\n  %s\n  -> %s\n' % (url, ' '.join(statement.split()), '; '.join(details)))
+    if problems:
+        print('%d queries need an index' % len(problems))
+        sys.exit(1)
+    print('checked %d pages, no full scans or filesorts' % len(urls))
+
+
+@manager.option('-s', '--seed', dest='seed', type=int, default=0, help='seed this many synthetic posts first')
+@manager.option('-c', '--clients', dest='clients', type=int, default=8, help='concurrent clients')
+@manager.option('-n', '--requests', dest='requests', type=int, default=2000, help='total requests')
+@manager.option('-o', '--output', dest='output', default=None, help='write the JSON report here')
+@manager.option('--compare', dest='baseline', default=None, help='JSON report of an earlier run')
+@manager.option('--no-cache', dest='no_cache', action='store_true', default=False, help='disable the page cache')
+@manager.option('--no-views', dest='no_views', action='store_true', default=False, help='disable view counting')
+def bench(seed, clients, requests, output, baseline, no_cache, no_views):
+    """Seed synthetic data and load-test the real views with concurrent clients"""
+    import json
+    from app import bench as b
+    if seed:
+        print('seeding %d posts...' % seed)
+        b.seed(users=max(10, seed // 10), posts=seed, big_thread=max(100, seed * 2))
+    post_ids = [row[0] for row in db.session.query(Post.id)]
+    if not post_ids:
+        print('no posts, run with --seed first')
+        return
+    tags = [row[0] for row in db.session.query(Category.tag).filter(Category.count > 0)]
+    big_post = db.session.query(Post.id).order_by(Post.comment_num.desc()).first()[0]
+    # 压测用户都是 --seed 建的, 密码相同
+    usernames = [row[0] for row in db.session.query(User.username).filter(User.id != 1).limit(100)]
+    db.session.remove()
+    app.config['WTF_CSRF_ENABLED'] = False
+    page_cache.enabled = page_cache.enabled and not no_cache
+    pageviews.enabled = pageviews.enabled and not no_views
+    scenarios = b.default_scenarios(post_ids, tags, big_post, app.config['POSTS_PER_PAGE'])
+    report = b.run(app, scenarios, clients, requests, usernames)
+    report['page_cache'] = page_cache.enabled
+    report['view_counting'] = pageviews.enabled
+    pageviews.flush()
+    print(json.dumps(report, indent=2, sort_keys=True))
+    if baseline:
+        with open(baseline) as f:
+            print('\n'.join(b.compare(report, json.load(f))))
+    if output:
+        with open(output, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+
+
+@manager.option('-p', '--post', dest='post_id', type=int, required=True, help='post to listen on')
+@manager.option('-n', '--listeners', dest='listeners', type=int, default=1000, help='concurrent SSE connections')
+@manager.option('-e', '--events', dest='events', type=int, default=10, help='events to publish')
+@manager.option('-H', '--host', dest='host', default='127.0.0.1', help='events gunicorn host')
+@manager.option('-P', '--port', dest='port', type=int, default=9001,
+                help='events gunicorn port (default 9001, the gevent server of conf/gunicorn_events.py)')
+def sse_bench(post_id, listeners, events, host, port):
+    """Hold many /post/<id>/events connections open and measure event fan-out latency"""
+    import json
+    from app import events as broker
+    from app.bench import sse_bench as run
+    # 事件从本进程经 CACHE_DIR/events 下的 socket 发给服务器的各个 worker, 需要在同一台机器上运行
+    report = run(host, port, post_id, listeners, events, broker.publish)
+    print(json.dumps(report, indent=2, sort_keys=True))
+
+
+@manager.option('--fetch', dest='fetch', action='store_true', default=False,
+                help='download the vendored libraries into app/static/vendor first')
+@manager.option('--force', dest='force', action='store_true', default=False,
+                help='download again even if the files exist')
+def assets(fetch, force):
+    """Bundle, fingerprint and precompress static files into app/static/dist"""
+    from app.assets import fetch_vendor, build
+    if fetch or force:
+        for path in fetch_vendor(app.static_folder, force):
+            print('fetched vendor/%s' % path)
+    manifest = build(app.static_folder)
+    print('wrote %d files, restart the app to pick up the new manifest' % len(manifest))
 
 
 @manager.command
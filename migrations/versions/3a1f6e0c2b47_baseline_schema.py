@@ -0,0 +1,104 @@
+"""baseline schema
+
+Revision ID: 3a1f6e0c2b47
+Revises: 
+Create Date: 2026-10-18 11:40:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '3a1f6e0c2b47'
+down_revision = None
+branch_labels = None
+depends_on = None
+
+# 以前由 create_app 里的 db.create_all() 建出来的表; 已有的数据库先运行
+# manage.py db stamp 3a1f6e0c2b47, 再 manage.py db upgrade
+
+
+def upgrade():
+    op.create_table('users',
+                    sa.Column('id', sa.Integer(), nullable=False),
+                    sa.Column('username', sa.String(length=64), nullable=True),
+                    sa.Column('password_hash', sa.String(length=128), nullable=True),
+                    sa.PrimaryKeyConstraint('id'),
+                    sa.UniqueConstraint('username'))
+    op.create_table('categories',
+                    sa.Column('id', sa.Integer(), nullable=False),
+                    sa.Column('tag', sa.String(length=64), nullable=True),
+                    sa.Column('count', sa.Integer(), nullable=True),
+                    sa.PrimaryKeyConstraint('id'))
+    op.create_index(op.f('ix_categories_tag'), 'categories', ['tag'], unique=True)
+    op.create_table('labels',
+                    sa.Column('id', sa.Integer(), nullable=False),
+                    sa.Column('label', sa.String(length=64), nullable=True),
+                    sa.Column('count', sa.Integer(), nullable=True),
+                    sa.PrimaryKeyConstraint('id'))
+    op.create_index(op.f('ix_labels_label'), 'labels', ['label'], unique=True)
+    op.create_table('posts',
+                    sa.Column('id', sa.Integer(), nullable=False),
+                    sa.Column('title', sa.String(length=128), nullable=True),
+                    sa.Column('body', sa.Text(), nullable=True),
+                    sa.Column('body_html', sa.Text(), nullable=True),
+                    sa.Column('summery', sa.Text(), nullable=True),
+                    sa.Column('summery_html', sa.Text(), nullable=True),
+                    sa.Column('timestamp', sa.DateTime(), nullable=True),
+                    sa.Column('category_id', sa.Integer(), nullable=True),
+                    sa.Column('comment_num', sa.Integer(), nullable=True),
+                    sa.Column('like_num', sa.Integer(), nullable=True),
+                    sa.ForeignKeyConstraint(['category_id'], ['categories.id']),
+                    sa.PrimaryKeyConstraint('id'))
+    op.create_index(op.f('ix_posts_timestamp'), 'posts', ['timestamp'], unique=False)
+    op.create_table('registrations',
+                    sa.Column('post_id', sa.Integer(), nullable=True),
+                    sa.Column('label_id', sa.Integer(), nullable=True),
+                    sa.ForeignKeyConstraint(['label_id'], ['labels.id']),
+                    sa.ForeignKeyConstraint(['post_id'], ['posts.id']))
+    op.create_table('comments',
+                    sa.Column('id', sa.Integer(), nullable=False),
+                    sa.Column('comment', sa.Text(), nullable=True),
+                    sa.Column('comment_html', sa.Text(), nullable=True),
+                    sa.Column('timestamp', sa.DateTime(), nullable=True),
+                    sa.Column('post_id', sa.Integer(), nullable=True),
+                    sa.Column('user_id', sa.Integer(), nullable=True),
+                    sa.Column('like_num', sa.Integer(), nullable=True),
+                    sa.Column('dislike_num', sa.Integer(), nullable=True),
+                    sa.ForeignKeyConstraint(['post_id'], ['posts.id']),
+                    sa.ForeignKeyConstraint(['user_id'], ['users.id']),
+                    sa.PrimaryKeyConstraint('id'))
+    op.create_index(op.f('ix_comments_timestamp'), 'comments', ['timestamp'], unique=False)
+    op.create_table('like_post',
+                    sa.Column('id', sa.Integer(), nullable=False),
+                    sa.Column('post_id', sa.Integer(), nullable=True),
+                    sa.Column('user_id', sa.Integer(), nullable=True),
+                    sa.ForeignKeyConstraint(['post_id'], ['posts.id']),
+                    sa.ForeignKeyConstraint(['user_id'], ['users.id']),
+                    sa.PrimaryKeyConstraint('id'))
+    for table in ('like_comment', 'dislike_comment'):
+        op.create_table(table,
+                        sa.Column('id', sa.Integer(), nullable=False),
+                        sa.Column('post_id', sa.Integer(), nullable=True),
+                        sa.Column('user_id', sa.Integer(), nullable=True),
+                        sa.Column('comment_id', sa.Integer(), nullable=True),
+                        sa.ForeignKeyConstraint(['comment_id'], ['comments.id']),
+                        sa.ForeignKeyConstraint(['post_id'], ['posts.id']),
+                        sa.ForeignKeyConstraint(['user_id'], ['users.id']),
+                        sa.PrimaryKeyConstraint('id'))
+
+
+def downgrade():
+    for table in ('dislike_comment', 'like_comment', 'like_post'):
+        op.drop_table(table)
+    op.drop_index(op.f('ix_comments_timestamp'), table_name='comments')
+    op.drop_table('comments')
+    op.drop_table('registrations')
+    op.drop_index(op.f('ix_posts_timestamp'), table_name='posts')
+    op.drop_table('posts')
+    op.drop_index(op.f('ix_labels_label'), table_name='labels')
+    op.drop_table('labels')
+    op.drop_index(op.f('ix_categories_tag'), table_name='categories')
+    op.drop_table('categories')
+    op.drop_table('users')
@@ -0,0 +1,31 @@
+"""post view counts
+
+Revision ID: 5d09c7e3a2f4
+Revises: e47a90b3c618
+Create Date: 2026-10-18 12:30:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5d09c7e3a2f4'
+down_revision = 'e47a90b3c618'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('post_stats',
+                    sa.Column('post_id', sa.Integer(), nullable=False),
+                    sa.Column('views', sa.BigInteger(), nullable=True),
+                    sa.Column('visitors', sa.Integer(), nullable=True),
+                    sa.Column('sketch', sa.LargeBinary(), nullable=True),
+                    sa.Column('updated', sa.DateTime(), nullable=True),
+                    sa.ForeignKeyConstraint(['post_id'], ['posts.id']),
+                    sa.PrimaryKeyConstraint('post_id'))
+
+
+def downgrade():
+    op.drop_table('post_stats')
@@ -0,0 +1,101 @@
+"""counters, search, feeds and related posts
+
+Revision ID: 8c2d4b91e5f0
+Revises: 3a1f6e0c2b47
+Create Date: 2026-10-18 11:45:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import mysql
+
+
+# revision identifiers, used by Alembic.
+revision = '8c2d4b91e5f0'
+down_revision = '3a1f6e0c2b47'
+branch_labels = None
+depends_on = None
+
+# (表, 唯一约束名, 唯一约束的列, 按用户查询的索引名, 索引的列)
+LIKE_TABLES = [
+    ('like_post', 'uq_like_post_post_user', ['post_id', 'user_id'],
+     'ix_like_post_user_post', ['user_id', 'post_id']),
+    ('like_comment', 'uq_like_comment_comment_user', ['comment_id', 'user_id'],
+     'ix_like_comment_user_comment', ['user_id', 'comment_id']),
+    ('dislike_comment', 'uq_dislike_comment_comment_user', ['comment_id', 'user_id'],
+     'ix_dislike_comment_user_comment', ['user_id', 'comment_id']),
+]
+
+
+def upgrade():
+    with op.batch_alter_table('posts') as batch_op:
+        batch_op.add_column(sa.Column('timestamp_update', sa.DateTime(), nullable=True))
+        batch_op.create_index(batch_op.f('ix_posts_timestamp_update'), ['timestamp_update'], unique=False)
+    op.execute('UPDATE posts SET timestamp_update = timestamp')
+
+    for table, constraint, columns, index, index_columns in LIKE_TABLES:
+        # 加唯一约束之前删掉重复点赞, 每组留 id 最小的一行; 多包一层子查询 MySQL 才允许
+        op.execute('DELETE FROM %s WHERE id NOT IN (SELECT id FROM (SELECT MIN(id) AS id FROM %s GROUP BY %s) AS keep)'
+                   % (table, table, ', '.join(columns)))
+        with op.batch_alter_table(table) as batch_op:
+            batch_op.create_unique_constraint(constraint, columns)
+            batch_op.create_index(index, index_columns, unique=False)
+
+    op.create_table('search_terms',
+                    sa.Column('term', sa.String(length=64), nullable=False),
+                    sa.Column('post_id', sa.Integer(), nullable=False),
+                    sa.Column('tf', sa.Float(), nullable=True),
+                    sa.ForeignKeyConstraint(['post_id'], ['posts.id']),
+                    sa.PrimaryKeyConstraint('term', 'post_id'))
+    op.create_index(op.f('ix_search_terms_post_id'), 'search_terms', ['post_id'], unique=False)
+    op.create_table('search_docs',
+                    sa.Column('post_id', sa.Integer(), nullable=False),
+                    sa.Column('length', sa.Float(), nullable=True),
+                    sa.ForeignKeyConstraint(['post_id'], ['posts.id']),
+                    sa.PrimaryKeyConstraint('post_id'))
+    op.create_table('site_version',
+                    sa.Column('id', sa.Integer(), nullable=False),
+                    sa.Column('version', sa.Integer(), nullable=True),
+                    sa.Column('timestamp', sa.DateTime(), nullable=True),
+                    sa.PrimaryKeyConstraint('id'))
+    op.create_table('related_posts',
+                    sa.Column('post_id', sa.Integer(), nullable=False),
+                    sa.Column('rank', sa.SmallInteger(), autoincrement=False, nullable=False),
+                    sa.Column('related_id', sa.Integer(), nullable=True),
+                    sa.Column('score', sa.Float(), nullable=True),
+                    sa.ForeignKeyConstraint(['post_id'], ['posts.id']),
+                    sa.ForeignKeyConstraint(['related_id'], ['posts.id']),
+                    sa.PrimaryKeyConstraint('post_id', 'rank'))
+    op.create_index(op.f('ix_related_posts_related_id'), 'related_posts', ['related_id'], unique=False)
+    op.create_table('feed_entries',
+                    sa.Column('post_id', sa.Integer(), nullable=False),
+                    sa.Column('atom', sa.Text(), nullable=True),
+                    sa.Column('sitemap', sa.Text(), nullable=True),
+                    sa.ForeignKeyConstraint(['post_id'], ['posts.id']),
+                    sa.PrimaryKeyConstraint('post_id'))
+    op.create_table('feed_documents',
+                    sa.Column('name', sa.String(length=64), nullable=False),
+                    sa.Column('body', sa.LargeBinary().with_variant(mysql.LONGBLOB(), 'mysql'), nullable=True),
+                    sa.Column('etag', sa.String(length=40), nullable=True),
+                    sa.Column('updated', sa.DateTime(), nullable=True),
+                    sa.PrimaryKeyConstraint('name'))
+    # 搜索索引、订阅和相关文章是空的, 升级之后运行
+    # manage.py search_index, manage.py feeds, manage.py related
+
+
+def downgrade():
+    op.drop_table('feed_documents')
+    op.drop_table('feed_entries')
+    op.drop_index(op.f('ix_related_posts_related_id'), table_name='related_posts')
+    op.drop_table('related_posts')
+    op.drop_table('site_version')
+    op.drop_table('search_docs')
+    op.drop_index(op.f('ix_search_terms_post_id'), table_name='search_terms')
+    op.drop_table('search_terms')
+    for table, constraint, columns, index, index_columns in reversed(LIKE_TABLES):
+        with op.batch_alter_table(table) as batch_op:
+            batch_op.drop_index(index)
+            batch_op.drop_constraint(constraint, type_='unique')
+    with op.batch_alter_table('posts') as batch_op:
+        batch_op.drop_index(batch_op.f('ix_posts_timestamp_update'))
+        batch_op.drop_column('timestamp_update')
@@ -0,0 +1,50 @@
+"""indexes for the hot queries
+
+Revision ID: e47a90b3c618
+Revises: 8c2d4b91e5f0
+Create Date: 2026-10-18 11:50:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e47a90b3c618'
+down_revision = '8c2d4b91e5f0'
+branch_labels = None
+depends_on = None
+
+# 对应的查询见 app/query_plans.py, manage.py explain 检查它们的执行计划
+
+
+def _copy_registrations(primary_key):
+    # registrations 原来没有主键, SQLite 不能给已有的表加主键, 建一张新表把去重后的数据复制过去
+    columns = [sa.Column('post_id', sa.Integer(), nullable=not primary_key),
+               sa.Column('label_id', sa.Integer(), nullable=not primary_key),
+               sa.ForeignKeyConstraint(['label_id'], ['labels.id']),
+               sa.ForeignKeyConstraint(['post_id'], ['posts.id'])]
+    if primary_key:
+        columns.append(sa.PrimaryKeyConstraint('post_id', 'label_id'))
+    op.create_table('registrations_new', *columns)
+    op.execute('INSERT INTO registrations_new (post_id, label_id) '
+               'SELECT DISTINCT post_id, label_id FROM registrations '
+               'WHERE post_id IS NOT NULL AND label_id IS NOT NULL')
+    op.drop_table('registrations')
+    op.rename_table('registrations_new', 'registrations')
+
+
+def upgrade():
+    # 文章的 Label 按 (post_id, label_id) 主键取, 一个 Label 下的文章按 (label_id, post_id) 取
+    _copy_registrations(True)
+    op.create_index('ix_registrations_label_post', 'registrations', ['label_id', 'post_id'], unique=False)
+    # 分类页和评论列表按 (timestamp, id) 倒序分页
+    op.create_index('ix_posts_category_timestamp', 'posts', ['category_id', 'timestamp', 'id'], unique=False)
+    op.create_index('ix_comments_post_timestamp', 'comments', ['post_id', 'timestamp', 'id'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_comments_post_timestamp', table_name='comments')
+    op.drop_index('ix_posts_category_timestamp', table_name='posts')
+    op.drop_index('ix_registrations_label_post', table_name='registrations')
+    _copy_registrations(False)
@@ -0,0 +1,40 @@
+# coding=utf-8
+import unittest
+from app import create_app, db, versions, page_cache, counters, pageviews, deferred, static_site
+from app.models import User
+
+
+class AppTestCase(unittest.TestCase):
+    """testing 配置的应用和一个空数据库
+
+    进程内的各种缓存按 tag 版本号判断是否有效, 建表之后让所有 tag 失效, 上一个测试留下的缓存不会再被用到
+    """
+
+    def setUp(self):
+        self.app = create_app('testing')
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.drop_all()
+        db.create_all()
+        versions.bump_all()
+        page_cache.clear()
+        self.client = self.app.test_client()
+
+    def tearDown(self):
+        deferred.wait()
+        static_site.wait()
+        counters.flush()
+        pageviews.flush()
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def add_user(self, username, password='cat'):
+        user = User(username=username)
+        user.password = password
+        db.session.add(user)
+        db.session.commit()
+        return user.id
+
+    def login(self, username, password='cat'):
+        return self.client.post('/', data={'username': username, 'password': password})
@@ -0,0 +1,43 @@
+# coding=utf-8
+import time
+from app import page_cache, pageviews, services
+from tests.base import AppTestCase
+
+
+class ViewCountValidatorsTestCase(AppTestCase):
+    """文章页的浏览数不进 ETag, 304 最多让读者看到 VIEW_CACHE_TTL 秒之前的浏览数"""
+
+    def setUp(self):
+        AppTestCase.setUp(self)
+        # 只看条件 GET, 不让页面缓存返回旧的页面
+        page_cache.enabled = False
+        self.add_user('Dexter')
+        services.create_category('python')
+        self.url = '/post/%d' % services.create_post('title', 'summery', 'body', 'python', []).id
+
+    def next_period(self):
+        ttl = pageviews.cache_ttl
+        time.sleep(ttl - time.time() % ttl + 0.05)
+
+    def test_views_within_period(self):
+        pageviews.cache_ttl = 60
+        if time.time() % 60 > 55:
+            self.next_period()
+        response = self.client.get(self.url)
+        pageviews.flush()
+        # 这段时间里浏览数变了也还是 304
+        response = self.client.get(self.url, headers={'If-None-Match': response.headers['ETag']})
+        self.assertEqual(response.status_code, 304)
+
+    def test_views_refreshed_after_period(self):
+        pageviews.cache_ttl = 1
+        self.next_period()
+        response = self.client.get(self.url)
+        self.assertIn('id="view_num">0<', response.get_data(as_text=True))
+        etag, last_modified = response.headers['ETag'], response.headers['Last-Modified']
+        pageviews.flush()
+        self.next_period()
+        for headers in ({'If-None-Match': etag}, {'If-Modified-Since': last_modified}):
+            response = self.client.get(self.url, headers=headers)
+            self.assertEqual(response.status_code, 200)
+            self.assertNotIn('id="view_num">0<', response.get_data(as_text=True))
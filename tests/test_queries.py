@@ -0,0 +1,63 @@
+# coding=utf-8
+from flask_sqlalchemy import get_debug_queries
+from app import page_cache, services
+from tests.base import AppTestCase
+
+
+class QueryCountTestCase(AppTestCase):
+    """列表页和文章页的查询次数不随文章数、Label 数和评论数增长"""
+
+    def setUp(self):
+        AppTestCase.setUp(self)
+        # 页面缓存命中时不会查询, 这里数的是渲染一次页面实际发出的查询
+        page_cache.enabled = False
+        self.add_user('Dexter')
+        self.readers = [self.add_user('reader%d' % i) for i in range(3)]
+        services.create_category('python')
+
+    def add_posts(self, n):
+        for i in range(n):
+            post = services.create_post('title %d' % i, 'summery %d' % i, 'body %d' % i, 'python',
+                                        ['label%d' % i, 'common'])
+        return post.id
+
+    def add_comments(self, post_id, n):
+        for i in range(n):
+            services.add_comment(post_id, self.readers[i % len(self.readers)], 'comment %d' % i)
+
+    def queries(self, url):
+        # 第一次请求先把侧边栏、计数这些按版本号缓存的数据加载好, 数第二次请求的查询
+        self.assertEqual(self.client.get(url).status_code, 200)
+        before = len(get_debug_queries())
+        self.assertEqual(self.client.get(url).status_code, 200)
+        return len(get_debug_queries()) - before
+
+    def test_index(self):
+        self.add_posts(1)
+        one = self.queries('/')
+        self.add_posts(self.app.config['POSTS_PER_PAGE'] * 2)
+        self.assertEqual(self.queries('/'), one)
+        self.assertEqual(self.queries('/?page=2'), one)
+
+    def test_category(self):
+        self.add_posts(1)
+        one = self.queries('/category/python')
+        self.add_posts(self.app.config['POSTS_PER_PAGE'] * 2)
+        self.assertEqual(self.queries('/category/python'), one)
+
+    def test_post(self):
+        post_id = self.add_posts(1)
+        self.add_comments(post_id, 1)
+        one = self.queries('/post/%d' % post_id)
+        self.add_comments(post_id, self.app.config['COMMENTS_PER_PAGE'] * 2)
+        self.assertEqual(self.queries('/post/%d' % post_id), one)
+        self.assertEqual(self.queries('/post/%d?page=2' % post_id), one)
+
+    def test_post_logged_in(self):
+        # 登录之后还要查点赞状态, 同样是固定的次数
+        post_id = self.add_posts(1)
+        self.add_comments(post_id, 1)
+        self.login('reader0')
+        one = self.queries('/post/%d' % post_id)
+        self.add_comments(post_id, self.app.config['COMMENTS_PER_PAGE'] * 2)
+        self.assertEqual(self.queries('/post/%d' % post_id), one)
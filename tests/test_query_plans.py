@@ -0,0 +1,32 @@
+# coding=utf-8
+from datetime import datetime, timedelta
+from app import db, services, deferred
+from app.models import Post
+from app.query_plans import check, hot_urls
+from tests.base import AppTestCase
+
+
+class QueryPlansTestCase(AppTestCase):
+    """manage.py explain 的检查: 访问量大的页面发出的查询都不全表扫描、不额外排序"""
+
+    def setUp(self):
+        AppTestCase.setUp(self)
+        reader = self.add_user('reader')
+        self.add_user('Dexter')
+        for tag in ('python', 'go'):
+            services.create_category(tag)
+        start = datetime(2017, 1, 1)
+        for i in range(30):
+            post = services.create_post('title %d' % i, 'summery', 'body', ('python', 'go')[i % 2],
+                                        ['label%d' % (i % 5), 'common'])
+            Post.query.filter_by(id=post.id).update({Post.timestamp: start + timedelta(hours=i)},
+                                                    synchronize_session=False)
+            db.session.commit()
+            services.add_comment(post.id, reader, 'comment')
+        deferred.wait()
+
+    def test_hot_pages(self):
+        urls = hot_urls()
+        self.assertIn('/category/python', urls)
+        problems = check(self.app, urls)
+        self.assertEqual([(url, ' '.join(statement.split()), details) for url, statement, details in problems], [])
@@ -0,0 +1,85 @@
+# coding=utf-8
+import os
+import shutil
+import tempfile
+import time
+from app import db, services, deferred
+from tests.base import AppTestCase
+
+
+class ReplicaTestCase(AppTestCase):
+    """用两个 SQLite 文件模拟主库和从库, 复制主库文件就是从库同步"""
+
+    def setUp(self):
+        AppTestCase.setUp(self)
+        if db.engine.url.get_backend_name() != 'sqlite':
+            self.skipTest('replica is simulated with SQLite files')
+        self.directory = tempfile.mkdtemp()
+        self.app.config['SQLALCHEMY_BINDS'] = {'replica': 'sqlite:///' + os.path.join(self.directory, 'replica.sqlite')}
+        self.add_user('Dexter')
+        services.create_category('python')
+        services.create_post('first post', 'summery', 'body', 'python', ['flask'])
+        deferred.wait()
+        self.sync()
+        self.reader = self.app.test_client()
+
+    def tearDown(self):
+        AppTestCase.tearDown(self)
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def sync(self):
+        db.session.remove()
+        db.get_engine(self.app, bind='replica').dispose()
+        shutil.copyfile(db.engine.url.database, os.path.join(self.directory, 'replica.sqlite'))
+
+    def get(self, url):
+        response = self.reader.get(url)
+        self.assertEqual(response.status_code, 200)
+        return response.get_data(as_text=True)
+
+    def test_reads_replica(self):
+        self.assertIn('first post', self.get('/'))
+        services.create_post('second post', 'summery', 'body', 'python', ['flask'])
+        # 读者没有写过数据, 读的是还没同步的从库
+        self.assertNotIn('second post', self.get('/'))
+
+    def test_stale_replica_not_cached(self):
+        # 从库落后时读到的页面、侧边栏、计数和订阅文档不能按新的版本号缓存下来, 否则同步之后也一直是旧的
+        self.get('/')
+        self.get('/feed.atom')
+        services.create_post('second post', 'summery', 'body', 'python', ['flask'])
+        deferred.wait()
+        self.assertNotIn('second post', self.get('/'))
+        self.assertNotIn('second post', self.get('/category/python'))
+        self.assertNotIn('second post', self.get('/feed.atom'))
+        self.sync()
+        for url in ('/', '/category/python', '/feed.atom'):
+            self.assertIn('second post', self.get(url))
+        self.assertIn('<span class="badge">2</span>', self.get('/category/python'))
+
+    def test_settled_replica_cached(self):
+        # 最近没有修改时读从库的页面照常缓存
+        self.app.config['READ_AFTER_WRITE_SECONDS'] = 0
+        time.sleep(1.1)
+        self.get('/')
+        self.assertEqual(self.reader.get('/').headers.get('X-Page-Cache'), 'HIT')
+
+    def test_writer_reads_primary(self):
+        self.login('Dexter')
+        response = self.client.post('/write', data={'title': 'second post', 'summery': 'summery', 'body': 'body',
+                                                    'category': 'python', 'labels': 'flask'})
+        self.assertEqual(response.status_code, 302)
+        self.assertIn('second post', self.client.get('/').get_data(as_text=True))
+
+    def test_static_export_reads_primary(self):
+        # 静态页面在写操作提交之后马上生成, 从库还没同步也要是新的内容
+        from app import static_site
+        services.create_post('second post', 'summery', 'body', 'python', ['flask'])
+        static_site.directory = self.directory
+        try:
+            static_site.write_path('index.html')
+        finally:
+            static_site.directory = self.app.config.get('STATIC_SITE_DIR')
+        with open(os.path.join(self.directory, 'index.html'), encoding='utf-8') as f:
+            self.assertIn('second post', f.read())
+        self.assertNotIn('second post', self.get('/'))
@@ -0,0 +1,42 @@
+# coding=utf-8
+from flask_sqlalchemy import get_debug_queries
+from app import page_cache, services
+from app.search import search_posts
+from tests.base import AppTestCase
+
+
+class SearchTestCase(AppTestCase):
+    """搜索只排序需要的前几篇, 翻页用缓存的排序结果, 文章变化后重新排序"""
+
+    def setUp(self):
+        AppTestCase.setUp(self)
+        page_cache.enabled = False
+        self.add_user('Dexter')
+        services.create_category('python')
+        self.per_page = self.app.config['POSTS_PER_PAGE']
+        for i in range(self.per_page * 2 + 3):
+            services.create_post(u'数据库 %d' % i, 'summery', u'数据库' * (i % 4 + 1), 'python', [])
+
+    def test_limit_and_total(self):
+        full, total = search_posts(u'数据库')
+        self.assertEqual(total, self.per_page * 2 + 3)
+        self.assertEqual(len(full), total)
+        top, top_total = search_posts(u'数据库', 3)
+        self.assertEqual(top_total, total)
+        self.assertEqual(top, full[:3])
+
+    def test_paging_uses_cached_ranking(self):
+        self.assertEqual(self.client.get('/search?q=数据库').status_code, 200)
+        before = len(get_debug_queries())
+        response = self.client.get('/search?q=数据库&page=3')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(u'数据库 0', response.get_data(as_text=True))
+        statements = [query.statement for query in get_debug_queries()[before:]]
+        self.assertEqual([s for s in statements if 'search_terms' in s], [])
+
+    def test_new_post_reranked(self):
+        search_posts(u'数据库', 3)
+        post = services.create_post(u'数据库数据库数据库', 'summery', u'数据库' * 10, 'python', [])
+        ranked, total = search_posts(u'数据库', 3)
+        self.assertEqual(total, self.per_page * 2 + 4)
+        self.assertEqual(ranked[0][0], post.id)
@@ -0,0 +1,147 @@
+# coding=utf-8
+import os
+import random
+import shutil
+import tempfile
+import threading
+import traceback
+from app import db, services, counters, deferred
+from app.archive import format_post, import_posts
+from app.models import Category, Post, Label, Comment, registrations
+from tests.base import AppTestCase
+
+
+class ConcurrentWritesTestCase(AppTestCase):
+    """多个线程同时发文章、改 Label、评论和删评论, Category / Label 的文章数和评论数与实际的行数一致"""
+
+    THREADS = 6
+    ROUNDS = 12
+    LABELS = ['python', 'flask', 'mysql', 'nginx', 'redis']
+
+    def setUp(self):
+        AppTestCase.setUp(self)
+        self.add_user('Dexter')
+        self.readers = [self.add_user('reader%d' % i) for i in range(3)]
+        for tag in ('python', 'go'):
+            services.create_category(tag)
+        self.post_ids = []
+        for i in range(4):
+            post = services.create_post('title %d' % i, 'summery', 'body', ('python', 'go')[i % 2],
+                                        [self.LABELS[i], 'common'])
+            self.post_ids.append(post.id)
+
+    def run_threads(self, work):
+        errors = []
+
+        def run(n):
+            rnd = random.Random(n)
+            with self.app.app_context():
+                try:
+                    for i in range(self.ROUNDS):
+                        work(rnd)
+                except Exception:
+                    errors.append(traceback.format_exc())
+                finally:
+                    db.session.remove()
+
+        threads = [threading.Thread(target=run, args=(n,)) for n in range(self.THREADS)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+        deferred.wait()
+        counters.flush()
+        db.session.remove()
+
+    def assert_counts(self):
+        for id, count in db.session.query(Category.id, Category.count):
+            self.assertEqual(count, Post.query.filter_by(category_id=id).count())
+        for id, count in db.session.query(Label.id, Label.count):
+            self.assertEqual(count, db.session.query(registrations).filter_by(label_id=id).count())
+        for id, comment_num in db.session.query(Post.id, Post.comment_num):
+            self.assertEqual(comment_num, Comment.query.filter_by(post_id=id).count())
+
+    def test_mixed_writes(self):
+        def work(rnd):
+            post_id = rnd.choice(self.post_ids)
+            action = rnd.randint(0, 3)
+            if action == 0:
+                services.add_comment(post_id, rnd.choice(self.readers), 'comment')
+            elif action == 1:
+                comment = Comment.query.filter_by(post_id=post_id).first()
+                if comment is not None:
+                    services.delete_comment(comment)
+            elif action == 2:
+                post = Post.query.get(post_id)
+                services.update_post(post, post.title, post.summery, post.body,
+                                     rnd.sample(self.LABELS + ['new%d' % rnd.randint(0, 2)], rnd.randint(1, 3)))
+            else:
+                services.create_post('title', 'summery', 'body', rnd.choice(['python', 'go']),
+                                     ['new%d' % rnd.randint(0, 2), rnd.choice(self.LABELS)])
+        self.run_threads(work)
+        self.assert_counts()
+
+    def test_same_post(self):
+        # 所有线程都修改同一篇文章
+        def work(rnd):
+            if rnd.randint(0, 1):
+                services.add_comment(self.post_ids[0], rnd.choice(self.readers), 'comment')
+            else:
+                post = Post.query.get(self.post_ids[0])
+                services.update_post(post, post.title, post.summery, post.body,
+                                     rnd.sample(self.LABELS, rnd.randint(1, 3)))
+        self.run_threads(work)
+        self.assert_counts()
+
+    def test_delete_comment_twice(self):
+        services.add_comment(self.post_ids[0], self.readers[0], 'comment')
+        comment_id = Comment.query.first().id
+        db.session.remove()
+        # 所有线程都先加载到这个评论, 再一起删除
+        loaded = threading.Barrier(self.THREADS)
+
+        def work(rnd):
+            comment = Comment.query.get(comment_id)
+            if comment is not None:
+                loaded.wait(10)
+                services.delete_comment(comment)
+        self.run_threads(work)
+        self.assertEqual(Post.query.get(self.post_ids[0]).comment_num, 0)
+        self.assert_counts()
+
+    def test_create_category(self):
+        def work(rnd):
+            self.assertEqual(services.create_category('rust').tag, 'rust')
+        self.run_threads(work)
+        self.assertEqual(Category.query.filter_by(tag='rust').count(), 1)
+
+    def test_import_while_posting(self):
+        # 导入的同时其他线程在发文章, id 都由数据库分配, 不会冲突
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        for i in range(40):
+            with open(os.path.join(directory, '%02d.md' % i), 'w') as f:
+                f.write(format_post('imported %d' % i, 'summery', 'body', 'go', ['common'], None))
+        errors = []
+
+        def run():
+            with self.app.app_context():
+                try:
+                    import_posts(directory, batch_size=4, workers=1)
+                except Exception:
+                    errors.append(traceback.format_exc())
+                finally:
+                    db.session.remove()
+
+        importer = threading.Thread(target=run)
+        importer.start()
+
+        def work(rnd):
+            services.create_post('title', 'summery', 'body', 'python', [rnd.choice(self.LABELS)])
+        self.run_threads(work)
+        importer.join()
+        self.assertEqual(errors, [])
+        self.assertEqual(Post.query.filter(Post.title.like('imported %')).count(), 40)
+        self.assertEqual(Post.query.count(), 4 + 40 + self.THREADS * self.ROUNDS)
+        self.assert_counts()
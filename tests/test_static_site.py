@@ -0,0 +1,53 @@
+# coding=utf-8
+import os
+import shutil
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from sqlalchemy import event
+from app import db, services, static_site
+from tests.base import AppTestCase
+
+
+class StaticSiteRefreshTestCase(AppTestCase):
+    """写操作之后的静态页面更新: 请求里不查询, 受影响的页面和多出来的列表页在后台处理"""
+
+    def setUp(self):
+        AppTestCase.setUp(self)
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory, True)
+        directory, executor = static_site.directory, static_site._executor
+        static_site.directory = self.directory
+        if executor is None:
+            static_site._executor = ThreadPoolExecutor(1)
+        self.addCleanup(setattr, static_site, 'directory', directory)
+        self.addCleanup(setattr, static_site, '_executor', executor)
+        self.add_user('Dexter')
+        services.create_category('python')
+
+    def test_refresh_in_background(self):
+        post = services.create_post('first post', 'summery', 'body', 'python', [])
+        static_site.wait()
+        # 上次导出时多出来的一页, 文章变少之后应该删掉
+        os.makedirs(os.path.join(self.directory, 'index'))
+        surplus = os.path.join(self.directory, 'index', '2.html')
+        open(surplus, 'w').close()
+        position = (post.category_id, post.timestamp, post.id, True)
+        statements = []
+        caller = threading.current_thread()
+
+        def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+            if threading.current_thread() is caller:
+                statements.append(statement)
+        event.listen(db.engine, 'before_cursor_execute', before_cursor_execute)
+        try:
+            static_site.refresh([position[2]], [position], sidebar=True)
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', before_cursor_execute)
+        self.assertEqual(statements, [])
+        static_site.wait()
+        for name in ('index.html', 'category/python.html', 'post/%d.html' % position[2], '_fragments/nav.html'):
+            self.assertTrue(os.path.exists(os.path.join(self.directory, name)), name)
+        self.assertFalse(os.path.exists(surplus))
+        with open(os.path.join(self.directory, 'index.html'), encoding='utf-8') as f:
+            self.assertIn('first post', f.read())
@@ -1,8 +1,9 @@
 # coding=utf-8
+import os
 from werkzeug.contrib.fixers import ProxyFix
 from app import create_app
 
-app = create_app()
+app = create_app(os.getenv('FLASK_CONFIG') or 'default')
 
 app.wsgi_app = ProxyFix(app.wsgi_app)
 